@@ -71,6 +71,8 @@ INSTALLED_APPS = VENDOR_APPS + LOCAL_APPS
 
 # it has loading order!
 MIDDLEWARE = [
+    # 最先执行，请求太多的ip在读取session和用户之前就被拒绝
+    'account.middleware.IPThrottlingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -259,6 +261,8 @@ CACHES = {
 # this will be called in view to set the session of the website
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
+# session里面的last_activity最多多久（秒）更新一次，值越大session写入缓存的次数越少
+SESSION_ACTIVITY_GRANULARITY = 60
 
 CELERY_RESULT_BACKEND = f"{REDIS_URL}/2"
 BROKER_URL = f"{REDIS_URL}/3"
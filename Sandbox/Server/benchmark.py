@@ -0,0 +1,71 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+import psutil
+
+from worker_pool import JudgeWorkerPool
+
+# 评判服务器进程池的基准测试：对比每个提交新建一个进程池（之前的做法）和服务器共享常驻进程池（现在的做法）
+# 每秒能够处理的提交数。测试用例用一个固定耗时的假任务代替，这样不需要_judger和测试用例文件也能运行，
+# 测出来的差距就是进程池本身的开销。
+# 用法：python3 benchmark.py --submissions 200 --test-cases 10 --case-time 5 --concurrency 4
+
+
+# 模拟评判一个测试用例，占用CPU case_time毫秒，和真实的用户程序一样是计算密集的
+def _fake_judge_one(case_time):
+    end = time.perf_counter() + case_time / 1000
+    while time.perf_counter() < end:
+        pass
+    return case_time
+
+
+# 之前的做法：每个提交都实例化一个进程数为CPU核数的进程池，评判完成之后close和join
+def judge_with_pool_per_submission(test_cases, case_time):
+    pool = Pool(processes=psutil.cpu_count())
+    tmp_result = [pool.apply_async(_fake_judge_one, (case_time,)) for _ in range(test_cases)]
+    pool.close()
+    pool.join()
+    return [item.get() for item in tmp_result]
+
+
+# 现在的做法：所有提交共享服务器持有的进程池
+def judge_with_shared_pool(shared_pool, test_cases, case_time):
+    tmp_result = [shared_pool.apply_async(_fake_judge_one, (case_time,)) for _ in range(test_cases)]
+    return [item.get() for item in tmp_result]
+
+
+# 用concurrency个线程模拟并发的评判请求，返回每秒处理的提交数
+def run(judge, submissions, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: judge(), range(submissions)))
+    return submissions / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--submissions", type=int, default=200)
+    parser.add_argument("--test-cases", type=int, default=10)
+    parser.add_argument("--case-time", type=float, default=5, help="ms per test case")
+    parser.add_argument("--concurrency", type=int, default=psutil.cpu_count())
+    args = parser.parse_args()
+
+    before = run(lambda: judge_with_pool_per_submission(args.test_cases, args.case_time),
+                 args.submissions, args.concurrency)
+
+    shared_pool = JudgeWorkerPool()
+    shared_pool.start()
+    after = run(lambda: judge_with_shared_pool(shared_pool, args.test_cases, args.case_time),
+                args.submissions, args.concurrency)
+    shared_pool.close()
+
+    print("cpu_core: %d, submissions: %d, test_cases: %d, case_time: %sms, concurrency: %d" %
+          (psutil.cpu_count(), args.submissions, args.test_cases, args.case_time, args.concurrency))
+    print("pool per submission: %.2f submissions/sec" % before)
+    print("shared worker pool:  %.2f submissions/sec" % after)
+
+
+if __name__ == "__main__":
+    main()
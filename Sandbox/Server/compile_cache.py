@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+from collections import OrderedDict
+
+from config import COMPILE_CACHE_DIR, COMPILE_CACHE_MAX_SIZE, COMPILER_USER_UID, COMPILER_GROUP_GID
+from utils import logger
+
+
+# 编译结果缓存：重判和比赛中完全相同的提交（模板代码、复制粘贴）不再重复编译
+# 缓存的关键字是源码 + 编译配置（包括编译命令）+ 编译器版本的sha256，缓存内容就是编译之后提交目录里面除了源码之外的所有文件，
+# 例如c/c++的main，java的Main.class，python3的__pycache__/solution.cpython-35.pyc
+# 按照LRU淘汰，总大小不超过COMPILE_CACHE_MAX_SIZE
+class CompileCache(object):
+    def __init__(self, cache_dir=COMPILE_CACHE_DIR, max_size=COMPILE_CACHE_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        #关键字 -> 缓存文件大小，按照最近使用的顺序排列，最前面的是最久没有使用的
+        self._entries = OrderedDict()
+        #正在被复制出去的缓存，不能被淘汰掉
+        self._pinned = {}
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        #编译器路径 -> 版本信息
+        self._compiler_versions = {}
+        #处理请求的多个线程共享同一个缓存，索引的读写都要加锁，文件的复制在锁外面进行
+        self._lock = threading.Lock()
+        if self.enabled:
+            self._clear()
+
+    # 索引只保存在内存里面，工作进程被gunicorn重启之后，上一个进程留下的缓存目录和临时目录都不在索引里面，
+    # 大小也没有计入总大小，留着会占满磁盘，同名的目录还会让store的rename失败，所以启动的时候全部删除
+    def _clear(self):
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError as e:
+            logger.exception(e)
+            return
+        for name in names:
+            path = os.path.join(self._cache_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.exception(e)
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    # 获取编译器的版本信息，每个编译器只获取一次
+    def _compiler_version(self, compiler):
+        version = self._compiler_versions.get(compiler)
+        if version is None:
+            version = ""
+            # gcc，g++，python使用--version，旧版本的javac只支持-version
+            for flag in ("--version", "-version"):
+                try:
+                    proc = subprocess.run([compiler, flag], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                          timeout=10)
+                except Exception as e:
+                    logger.exception(e)
+                    break
+                if proc.returncode == 0:
+                    version = proc.stdout.decode("utf-8", "ignore").strip()
+                    break
+            self._compiler_versions[compiler] = version
+        return version
+
+    # 根据编译配置和源码生成缓存关键字
+    def make_key(self, compile_config, src):
+        compiler = compile_config["compile_command"].split(" ")[0]
+        key = hashlib.sha256()
+        key.update(json.dumps(compile_config, sort_keys=True).encode("utf-8"))
+        key.update(self._compiler_version(compiler).encode("utf-8"))
+        key.update(src.encode("utf-8"))
+        return key.hexdigest()
+
+    # 命中缓存就将编译好的文件复制到output_dir，返回True，否则返回False，需要重新编译
+    def restore(self, key, output_dir):
+        if not self.enabled:
+            return False
+        with self._lock:
+            if key not in self._entries:
+                self._misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+            self._hits += 1
+        try:
+            entry_dir = os.path.join(self._cache_dir, key)
+            for root, dirs, files in os.walk(entry_dir):
+                dst_root = os.path.join(output_dir, os.path.relpath(root, entry_dir))
+                for name in dirs:
+                    os.mkdir(os.path.join(dst_root, name))
+                    os.chown(os.path.join(dst_root, name), COMPILER_USER_UID, COMPILER_GROUP_GID)
+                for name in files:
+                    dst = os.path.join(dst_root, name)
+                    shutil.copy2(os.path.join(root, name), dst)
+                    #和编译器编译出来的文件的所有者保持一致
+                    os.chown(dst, COMPILER_USER_UID, COMPILER_GROUP_GID)
+            return True
+        except Exception as e:
+            #复制失败就当做没有命中，重新编译
+            logger.exception(e)
+            with self._lock:
+                self._hits -= 1
+                self._misses += 1
+            return False
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if not self._pinned[key]:
+                    del self._pinned[key]
+
+    # 编译成功之后，将output_dir里面除了源码src_name之外的文件放入缓存
+    def store(self, key, output_dir, src_name):
+        if not self.enabled:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+        #先复制到临时目录，完成之后再rename，其他线程不会看到复制了一半的缓存
+        tmp_dir = os.path.join(self._cache_dir, "tmp-" + uuid.uuid4().hex)
+        try:
+            shutil.copytree(output_dir, tmp_dir, ignore=lambda d, names: [src_name] if d == output_dir else [])
+            size = 0
+            for root, _, files in os.walk(tmp_dir):
+                for name in files:
+                    size += os.path.getsize(os.path.join(root, name))
+        except Exception as e:
+            logger.exception(e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        to_be_removed = [tmp_dir]
+        with self._lock:
+            if key not in self._entries and size <= self._max_size:
+                try:
+                    os.rename(tmp_dir, os.path.join(self._cache_dir, key))
+                except OSError as e:
+                    #改名失败（例如目标目录已经存在）就不缓存这次的结果，临时目录在锁外面删除
+                    logger.exception(e)
+                else:
+                    to_be_removed = []
+                    self._entries[key] = size
+                    self._size += size
+                    to_be_removed.extend(self._evict())
+        for item in to_be_removed:
+            shutil.rmtree(item, ignore_errors=True)
+
+    # 淘汰最久没有使用的缓存直到总大小不超过限制，在锁内调用，返回需要删除的目录
+    def _evict(self):
+        removed = []
+        for key in list(self._entries.keys()):
+            if self._size <= self._max_size:
+                break
+            if key in self._pinned:
+                continue
+            self._size -= self._entries.pop(key)
+            #先改名，删除目录的耗时操作放在锁外面
+            path = os.path.join(self._cache_dir, key)
+            trash = os.path.join(self._cache_dir, "trash-" + uuid.uuid4().hex)
+            os.rename(path, trash)
+            removed.append(trash)
+        return removed
+
+    # 缓存统计信息，通过ping返回
+    def stats(self):
+        with self._lock:
+            return {"hits": self._hits,
+                    "misses": self._misses,
+                    "entries": len(self._entries),
+                    "size": self._size,
+                    "max_size": self._max_size}
+
+
+compile_cache = CompileCache()
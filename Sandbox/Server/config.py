@@ -1,5 +1,6 @@
 import os
 import pwd
+from urllib.parse import urlsplit
 
 import grp
 
@@ -8,6 +9,25 @@ import grp
 #评判机基础工作空间
 JUDGER_WORKSPACE_BASE = "/judger/run"
 
+#tmpfs上的评判工作空间路径，为空就不使用tmpfs，所有的工作空间都在JUDGER_WORKSPACE_BASE
+#tmpfs的大小在挂载的时候指定，例如docker-compose里面的tmpfs: - /judger_tmpfs:size=1g
+JUDGER_TMPFS_WORKSPACE_BASE = os.environ.get("JUDGER_TMPFS_DIR", "")
+#预先创建好、可以重复使用的tmpfs工作空间个数，默认是CPU核数的2倍
+WORKSPACE_POOL_SIZE = int(os.environ.get("WORKSPACE_POOL_SIZE", 0)) or os.cpu_count() * 2
+#tmpfs剩余空间少于这个值的时候，新的工作空间退回到磁盘上，默认64M
+WORKSPACE_TMPFS_MIN_FREE = int(os.environ.get("WORKSPACE_TMPFS_MIN_FREE", 64 * 1024 * 1024))
+
+#编译结果缓存路径，按照源码和编译配置的摘要存放编译好的可执行文件
+COMPILE_CACHE_DIR = "/judger/compile_cache"
+#编译缓存最多占用的磁盘空间，默认1G，设置为0就是不使用编译缓存
+COMPILE_CACHE_MAX_SIZE = int(os.environ.get("COMPILE_CACHE_MAX_SIZE", 1024 * 1024 * 1024))
+
+#异步评判任务完成之后，结果保留的秒数，超时没有被后台取走就删除
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 600))
+#异步评判完成之后可以推送结果的主机（host:port，逗号分隔），默认只有心跳的后台BACKEND_URL的主机
+JOB_CALLBACK_HOSTS = set(filter(None, os.environ.get("JOB_CALLBACK_HOSTS", "").split(","))) or \
+    {urlsplit(os.environ.get("BACKEND_URL", "")).netloc} - {""}
+
 # 日志基础路径
 LOG_BASE = "/log"
 
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 rm -rf /judger/*
-mkdir -p /judger/run /judger/spj
+mkdir -p /judger/run /judger/spj /judger/compile_cache
 
 chown compiler:code /judger/run
 chmod 711 /judger/run
@@ -9,6 +9,20 @@ chmod 711 /judger/run
 chown compiler:spj /judger/spj
 chmod 710 /judger/spj
 
+# 编译缓存只有评判服务器自己能访问，用户的程序不能读取别人的提交
+chmod 700 /judger/compile_cache
+
+# 使用tmpfs存放评判工作空间，tmpfs由docker挂载，大小在挂载的时候指定
+if [ -n "$JUDGER_TMPFS_DIR" ]; then
+    mkdir -p $JUDGER_TMPFS_DIR
+    rm -rf $JUDGER_TMPFS_DIR/*
+    chown compiler:code $JUDGER_TMPFS_DIR
+    chmod 711 $JUDGER_TMPFS_DIR
+fi
+
 core=$(grep --count ^processor /proc/cpuinfo)
 n=$(($core*2))
-exec gunicorn --workers $n --threads $n --error-logfile /log/gunicorn.log --time 600 --bind 0.0.0.0:8080 server:app
+# 只启动一个gunicorn工作进程，由它持有常驻的评判进程池（进程数为CPU核数），请求由多个线程并发处理，
+# 这样所有正在评判的提交加起来同时运行的测试用例数就不会超过CPU核数
+# 后台通过/judge_async提交评判任务，处理请求的线程只负责入队和返回结果，同时评判的提交数由任务队列限制为CPU核数
+exec gunicorn --workers 1 --threads $n --error-logfile /log/gunicorn.log --time 600 --bind 0.0.0.0:8080 server:app
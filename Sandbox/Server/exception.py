@@ -1,7 +1,8 @@
 # 服务器异常类处理
 class JudgeServerException(Exception):
     def __init__(self, message):
-        super().__init__()
+        #message同时传给父类，这样异常才能被pickle，从进程池的工作进程传回到处理请求的线程
+        super().__init__(message)
         self.message = message
 
 #编译异常处理类
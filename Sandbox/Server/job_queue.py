@@ -0,0 +1,140 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from config import JOB_RESULT_TTL
+from utils import logger, token
+from worker_pool import judge_pool
+
+
+# 评判任务：后台提交之后马上拿到任务id，之后通过id查询结果，或者评判完成之后由服务器回调后台
+class JudgeJob(object):
+    PENDING = "pending"
+    RUNNING = "running"
+    FINISHED = "finished"
+
+    def __init__(self, callback_url=None):
+        self.id = uuid.uuid4().hex
+        self.status = self.PENDING
+        #和同步的/judge返回的格式一样：{"err": ..., "data": ...}
+        self.result = None
+        self.callback_url = callback_url
+        self.finished_time = None
+        #已经评判完成的测试用例的结果，评判过程中后台可以查询到评判进度
+        self.progress = []
+        #有新的测试用例结果或者评判完成的时候通知，等待结果的请求线程在这上面wait
+        self.changed = threading.Condition()
+
+    # JudgeClient每评判完一个测试用例就调用一次
+    def add_progress(self, run_result):
+        with self.changed:
+            self.progress.append(run_result)
+            self.changed.notify_all()
+
+    def finish(self, result):
+        with self.changed:
+            self.result = result
+            self.finished_time = time.time()
+            self.status = self.FINISHED
+            self.changed.notify_all()
+
+    # 等待评判完成，progress_offset不为None的话，测试用例结果数超过progress_offset也马上返回
+    def wait(self, timeout, progress_offset=None):
+        def ready():
+            if self.status == self.FINISHED:
+                return True
+            return progress_offset is not None and len(self.progress) > progress_offset
+        with self.changed:
+            self.changed.wait_for(ready, timeout=timeout)
+
+    def to_dict(self):
+        ret = {"job_id": self.id, "status": self.status, "result": self.result}
+        #评判完成之后结果里面已经有所有测试用例的结果，不需要再返回进度
+        if self.status != self.FINISHED:
+            ret["progress"] = list(self.progress)
+        return ret
+
+
+# 评判任务队列：处理http请求的线程只负责把任务放入队列，不再等待评判完成，
+# 同时评判的提交数由执行任务的线程数决定，和进程池大小（CPU核数）一样，而不是由gunicorn的线程数决定
+class JudgeJobQueue(object):
+    def __init__(self, workers=None, result_ttl=JOB_RESULT_TTL):
+        self._workers = workers or judge_pool.processes
+        self._result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        #任务id -> 任务，评判完成之后保留result_ttl秒，等待后台来取结果
+        self._jobs = {}
+        self._lock = threading.Lock()
+        #定期删除过期结果的线程，第一次提交任务的时候才启动，gunicorn fork之后的进程里面才有这个线程
+        self._cleaner = None
+
+    # 提交一个评判任务，func(on_result=..., **kwargs)返回评判结果，抛出异常的话由error_handler转换成错误信息
+    def submit(self, func, kwargs, error_handler, callback_url=None):
+        job = JudgeJob(callback_url=callback_url)
+        kwargs = dict(kwargs, on_result=job.add_progress)
+        with self._lock:
+            self._cleanup()
+            self._jobs[job.id] = job
+            if self._cleaner is None:
+                self._cleaner = threading.Thread(target=self._clean_forever, daemon=True)
+                self._cleaner.start()
+        self._executor.submit(self._run, job, func, kwargs, error_handler)
+        return job
+
+    def _run(self, job, func, kwargs, error_handler):
+        job.status = JudgeJob.RUNNING
+        try:
+            result = {"err": None, "data": func(**kwargs)}
+        except Exception as e:
+            logger.exception(e)
+            result = error_handler(e)
+        job.finish(result)
+        if job.callback_url:
+            self._callback(job)
+
+    # 评判完成之后将结果推送给后台，失败了也没关系，后台还可以通过任务id查询
+    def _callback(self, job):
+        try:
+            requests.post(job.callback_url, json=job.to_dict(),
+                          headers={"X-Judge-Server-Token": token}, timeout=5)
+        except Exception as e:
+            logger.exception(e)
+
+    # 获取任务，wait大于0的话最多等待wait秒直到评判完成或者有新的测试用例结果，没有这个任务返回None
+    def get(self, job_id, wait=0, progress_offset=None):
+        with self._lock:
+            self._cleanup()
+            job = self._jobs.get(job_id)
+        if job and wait:
+            job.wait(wait, progress_offset=progress_offset)
+        return job
+
+    # 删除已经过期的评判结果，在锁内调用
+    def _cleanup(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_time and now - job.finished_time > self._result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    # 不再收到新的评判任务和查询的时候，结果也会在过期之后被删除
+    def _clean_forever(self):
+        while True:
+            time.sleep(self._result_ttl)
+            with self._lock:
+                self._cleanup()
+
+    # 正在排队和正在评判的任务数，通过ping返回
+    def stats(self):
+        with self._lock:
+            self._cleanup()
+            jobs = list(self._jobs.values())
+        return {"workers": self._workers,
+                "pending": len([job for job in jobs if job.status == JudgeJob.PENDING]),
+                "running": len([job for job in jobs if job.status == JudgeJob.RUNNING])}
+
+
+judge_job_queue = JudgeJobQueue()
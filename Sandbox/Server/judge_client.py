@@ -2,22 +2,109 @@ import _judger
 import hashlib
 import json
 import os
-
-#本例使用python中的多进程线程池模块，例如里面包含的方法：apply_async(_run, (self, test_case_file_id))
-from multiprocessing import Pool
-
-import psutil
+import threading
+from collections import deque
 
 #可执行文件的运行和评判结果的对比在这里进行
 # 导入常量配置信息
 from config import TEST_CASE_DIR, JUDGER_RUN_LOG_PATH, RUN_GROUP_GID, RUN_USER_UID, SPJ_EXE_DIR, SPJ_USER_UID, SPJ_GROUP_GID, RUN_GROUP_GID
 from exception import JudgeClientError
+from utils import logger
+#评判服务器进程持有的常驻进程池，例如里面包含的方法：apply_async(_run, (self, test_case_file_id))
+from worker_pool import judge_pool
 
 # 设置特殊评判常量
 SPJ_WA = 1
 SPJ_AC = 0
 SPJ_ERROR = -1
 
+# 比较输出的时候每次读取的文件块大小，无论输出有多大，占用的内存都不超过这个大小
+COMPARE_CHUNK_SIZE = 64 * 1024
+
+
+# 文件去掉尾随空白字符之后的大小，和bytes.rstrip()的结果一致，从文件末尾往前分块读取，一般只需要读一块
+def _stripped_size(f):
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    while pos > 0:
+        size = min(COMPARE_CHUNK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        chunk = f.read(size).rstrip()
+        if chunk:
+            return pos + len(chunk)
+    return 0
+
+
+# 分块计算文件前size个字节的md5
+def _md5(f, size):
+    md5 = hashlib.md5()
+    f.seek(0)
+    while size > 0:
+        chunk = f.read(min(COMPARE_CHUNK_SIZE, size))
+        if not chunk:
+            break
+        md5.update(chunk)
+        size -= len(chunk)
+    return md5.hexdigest()
+
+
+# 测试用例信息缓存：比赛期间成千上万的提交都集中在几道题上面，不用每个提交都去打开并解析一次info文件
+# 缓存在评判服务器进程里面，info文件的inode或者修改时间变了（测试用例被重新上传）就重新加载
+# 加载的时候顺便算好每个测试用例的输入输出文件路径、max_output_size和标准输出去掉尾随空白字符之后的大小
+class TestCaseInfoCache(object):
+    def __init__(self):
+        #test_case_id -> (info文件的状态, 测试用例信息)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, test_case_id):
+        test_case_dir = os.path.join(TEST_CASE_DIR, test_case_id)
+        info_path = os.path.join(test_case_dir, "info")
+        try:
+            st = os.stat(info_path)
+        except OSError:
+            with self._lock:
+                self._entries.pop(test_case_id, None)
+            raise JudgeClientError("Test case not found")
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        entry = self._entries.get(test_case_id)
+        if entry and entry[0] == stamp:
+            return entry[1]
+        test_case_info = self._load(test_case_dir, info_path)
+        with self._lock:
+            self._entries[test_case_id] = (stamp, test_case_info)
+        return test_case_info
+
+    # 加载测试用例信息，使用json加载，返回的信息是多个提交共享的，使用的时候不能修改
+    @staticmethod
+    def _load(test_case_dir, info_path):
+        try:
+            with open(info_path) as f:
+                test_case_info = json.load(f)
+        except IOError:
+            raise JudgeClientError("Test case not found")
+        except ValueError:
+            raise JudgeClientError("Bad test case config")
+        for item in test_case_info["test_cases"].values():
+            # 输入文件路径，input_name:1.in，那么路径就是/test_case/test_case_id/1.in
+            item["input_path"] = os.path.join(test_case_dir, item["input_name"])
+            # 根据配置文件要求，比较选取最大的那个
+            item["max_output_size"] = max(item.get("output_size", 0) * 2, 1024 * 1024 * 16)
+            # 特殊评判没有标准输出文件，只有普通评判才需要比较输出
+            item["stripped_output_size"] = None
+            if item.get("output_name"):
+                try:
+                    with open(os.path.join(test_case_dir, item["output_name"]), "rb") as f:
+                        item["stripped_output_size"] = _stripped_size(f)
+                except IOError:
+                    pass
+        return test_case_info
+
+
+test_case_info_cache = TestCaseInfoCache()
+
+
 # 评判一个测试用例，其中instance（实例）就是值类JudgeClient的一个实例
 def _run(instance, test_case_file_id):
     return instance._judge_one(test_case_file_id)
@@ -26,7 +113,8 @@ def _run(instance, test_case_file_id):
 class JudgeClient(object):
     #构造函数初始化运行参数，这些参数都是前台传过来的
     def __init__(self, run_config, exe_path, max_cpu_time, max_memory, test_case_id,
-                 submission_dir, spj_version, spj_config, output=False):
+                 submission_dir, spj_version, spj_config, output=False, stop_on_first_failure=False,
+                 on_result=None):
         #_run_config是一个json的数据
         self._run_config = run_config
         self._exe_path = exe_path
@@ -39,14 +127,16 @@ class JudgeClient(object):
         self._test_case_dir = os.path.join(TEST_CASE_DIR, test_case_id)
         #_submission_dir=submission_dir=/judger/run/submission_id/
         self._submission_dir = submission_dir
-        #实例化一个多进程池，里面的进程数根据系统CPU逻辑个数开启
-        self._pool = Pool(processes=psutil.cpu_count())
         #加载测试用例信息
         self._test_case_info = self._load_test_case_info()
 
         self._spj_version = spj_version
         self._spj_config = spj_config
         self._output = output
+        #ACM模式只需要第一个出错的测试用例，有测试用例出错之后就不再评判剩下的测试用例
+        self._stop_on_first_failure = stop_on_first_failure
+        #每评判完一个测试用例就调用一次，用于向后台推送评判进度
+        self._on_result = on_result
 
         #如果特殊评判版本和配置不为空，则执行特殊评判
         #拼接配置特殊评判的执行文件的路径，注意这里是config的，非compile
@@ -57,32 +147,45 @@ class JudgeClient(object):
             if not os.path.exists(self._spj_exe):
                 raise JudgeClientError("spj exe not found")
 
+    # 实例会被pickle之后发送给进程池里面的工作进程，回调函数只在服务器进程里面使用，不需要发送
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_on_result"] = None
+        return state
+
+    # 报告一个测试用例的评判结果，回调出错不能影响评判
+    def _report(self, run_result):
+        if self._on_result:
+            try:
+                self._on_result(run_result)
+            except Exception as e:
+                logger.exception(e)
+
     # 注意，单杠'_'开头的不是表示私有的，双杠开头的才是表示私有的。
-    # 加载测试用例信息，使用json加载，被构造函数_test_case_info调用
+    # 加载测试用例信息，从服务器进程的缓存里面获取，被构造函数_test_case_info调用
     def _load_test_case_info(self):
-        try:
-            with open(os.path.join(self._test_case_dir, "info")) as f:
-                return json.load(f)
-        except IOError:
-            raise JudgeClientError("Test case not found")
-        except ValueError:
-            raise JudgeClientError("Bad test case config")
+        return test_case_info_cache.get(self._test_case_id)
 
     # 获取测试用例文件信息，被比较输出函数_compare_output调用
     def _get_test_case_file_info(self, test_case_file_id):
         return self._test_case_info["test_cases"][test_case_file_id]
 
     # 比较运行结果与标准的结果是否一致，被运行单个测试评判函数_judge_one中调用
+    # 不把整个输出文件读到内存，而是分块计算去掉尾随空白字符之后的md5，无论输出多大，内存占用都是固定的
+    # 去掉尾随空白字符之后的大小和标准输出不一样，肯定是答案错误，只需要从文件末尾往前读到最后一个非空白字符，
+    # 不用再读整个文件计算md5，这时候output_md5是None；要求返回输出内容（output）的时候，output_md5也一起计算
     def _compare_output(self, test_case_file_id):
+        test_case_info = self._get_test_case_file_info(test_case_file_id)
         user_output_file = os.path.join(self._submission_dir, str(test_case_file_id) + ".out")
         with open(user_output_file, "rb") as f:
-            content = f.read()
-        #文件内容去掉尾随空格之后提取摘要信息
-        output_md5 = hashlib.md5(content.rstrip()).hexdigest()
-        #将输出在.out文件中的信息使用摘要算法加密的结果与info文件中的已删除尾随空字符的输出文件的md5进行比较
-        result = output_md5 == self._get_test_case_file_info(test_case_file_id)["stripped_output_md5"]
+            output_size = _stripped_size(f)
+            expected_size = test_case_info["stripped_output_size"]
+            if expected_size is not None and output_size != expected_size:
+                return (_md5(f, output_size) if self._output else None), False
+            #文件内容去掉尾随空格之后提取摘要信息，和info文件中的已删除尾随空字符的输出文件的md5进行比较
+            output_md5 = _md5(f, output_size)
         # 返回的一个是字符串和一个布尔值
-        return output_md5, result
+        return output_md5, output_md5 == test_case_info["stripped_output_md5"]
 
     # 特殊评判运行特殊测试用例
     def _spj(self, in_file_path, user_out_file_path):
@@ -133,8 +236,8 @@ class JudgeClient(object):
     def _judge_one(self, test_case_file_id):
         # 找到测试用例信息
         test_case_info = self._get_test_case_file_info(test_case_file_id)
-        # 输入文件路径，input_name:1.in，那么路径就是/test_case/1.in
-        in_file = os.path.join(self._test_case_dir, test_case_info["input_name"])
+        # 输入文件路径，加载测试用例信息的时候已经算好了，例如/test_case/test_case_id/1.in
+        in_file = test_case_info["input_path"]
         # 输出文件路径:user_output_file=_submission_dir+test_case_file_id.out=/judger/run/submission_id/test_case_file_id.out
         user_output_file = os.path.join(self._submission_dir, test_case_file_id + ".out")
 
@@ -149,8 +252,8 @@ class JudgeClient(object):
                                  max_real_time=self._max_real_time,
                                  max_memory=self._max_memory,
                                  max_stack=128 * 1024 * 1024,
-                                 # 根据配置文件要求，比较选取最大的那个
-                                 max_output_size=max(test_case_info.get("output_size", 0) * 2, 1024 * 1024 * 16),
+                                 # 根据配置文件要求，比较选取最大的那个，加载测试用例信息的时候已经算好了
+                                 max_output_size=test_case_info["max_output_size"],
                                  max_process_number=_judger.UNLIMITED,
                                  #这里执行的是用户的编译好的代码
                                  exe_path=command[0],
@@ -219,31 +322,48 @@ class JudgeClient(object):
         return run_result
 
     def run(self):
+        if self._stop_on_first_failure:
+            return self._run_until_first_failure()
         tmp_result = []
         result = []
         #去调用_load_test_case_info()加载info文件的信息，就知道有多少个测试用例，例如本例中只有一个test_case，
         # '_'表示即使没有1，2，3这样的编号，也照样进行遍历
         for test_case_file_id, _ in self._test_case_info["test_cases"].items():
-            #循环添加到临时的结果列表中，调用进程池实例的apply_async函数，按照测试用例文件ID运行
+            #循环添加到临时的结果列表中，调度到服务器共享的进程池，按照测试用例文件ID运行
             #apply_async用于传递不定参数，是非阻塞且支持结果返回进行回调，返回一个列表
             #函数原型：apply_async(func[, args=()[, kwds={}[, callback=None]]])
-            tmp_result.append(self._pool.apply_async(_run, (self, test_case_file_id)))
-        # 关闭进程池，表示不能在往进程池中添加进程
-        self._pool.close()
-        # 等待进程池中的所有进程执行完毕以后再继续往下运行，通常用于进程间的同步，join方法必须在close或terminate之后使用
-        self._pool.join()
+            #进程池是所有提交共享的，不能close和join，直接在每个结果上面get()等待即可
+            tmp_result.append(judge_pool.apply_async(_run, (self, test_case_file_id)))
         for item in tmp_result:
             # 结果就是返回pool中所有进程的值的对象（注意是对象，不是值本身）。
             # 当调用get()函数的时候，会抛出异常，因为无论是对或是错，我都要返回的数据，最后由json解析
             # # http://stackoverflow.com/questions/22094852/how-to-catch-exceptions-in-workers-in-multiprocessing
             result.append(item.get())
+            self._report(result[-1])
         #最后返回结果到服务器，就是返回每个测试的结果堆在一起的一个列表
         return result
 
-    def __getstate__(self):
-        # http://stackoverflow.com/questions/25382455/python-notimplementederror-pool-objects-cannot-be-passed-between-processes
-        # 在使用pickle进行数据持久化的时候（要返回评判的结果：一个结果列表，而结果又在类里面，要打破类的封装就要使用pickle），_pool本身也是
-        # 一个实例化变量，_pool对象不能被pickle，所以就要实现__getstate__()方法，先删除_poor实例变量，再进行pickle。
-        self_dict = self.__dict__.copy()
-        del self_dict["_pool"]
-        return self_dict
+    # 出错即停止的评判模式：按照测试用例编号的顺序调度，同时最多只有进程池大小个测试用例在运行，
+    # 一旦有测试用例出错，就不再调度后面的测试用例，但是已经在运行的要等它们完成，
+    # 因为编号比出错的测试用例小的都已经调度过了，所以编号最小的出错测试用例的结果一定是准确的
+    def _run_until_first_failure(self):
+        result = []
+        test_case_file_ids = iter(sorted(self._test_case_info["test_cases"].keys(), key=int))
+        tmp_result = deque()
+        for test_case_file_id in test_case_file_ids:
+            tmp_result.append(judge_pool.apply_async(_run, (self, test_case_file_id)))
+            if len(tmp_result) >= judge_pool.processes:
+                break
+        failed = False
+        while tmp_result:
+            run_result = tmp_result.popleft().get()
+            result.append(run_result)
+            self._report(run_result)
+            if run_result["result"] != _judger.RESULT_SUCCESS:
+                failed = True
+            # 没有出错就补上一个测试用例，出错之后剩下没有调度的测试用例全部取消
+            if not failed:
+                test_case_file_id = next(test_case_file_ids, None)
+                if test_case_file_id is not None:
+                    tmp_result.append(judge_pool.apply_async(_run, (self, test_case_file_id)))
+        return result
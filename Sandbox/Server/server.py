@@ -1,17 +1,21 @@
 import json
 import os
-import shutil
-import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 
 #基于一个小型的flask的应用
 #首先导入flask类。这个类的实例将会是我们的 WSGI 应用程序。和一些其他的模块
 from flask import Flask, request, Response
 
+from compile_cache import compile_cache
 from compiler import Compiler
-from config import JUDGER_WORKSPACE_BASE, SPJ_SRC_DIR, SPJ_EXE_DIR, COMPILER_USER_UID, SPJ_USER_UID, RUN_USER_UID, RUN_GROUP_GID
+from config import SPJ_SRC_DIR, SPJ_EXE_DIR, COMPILER_USER_UID, SPJ_USER_UID, RUN_USER_UID, JOB_CALLBACK_HOSTS
 from exception import TokenVerificationFailed, CompileError, SPJCompileError, JudgeClientError
-from judge_client import JudgeClient
+from job_queue import judge_job_queue
+from judge_client import JudgeClient, test_case_info_cache
 from utils import server_info, logger, token
+from worker_pool import judge_pool
+from workspace import workspace_pool
 
 
 #创建app应用实例,__name__是python预定义变量，被设置为使用本模块.'__main__'会找到这里。
@@ -21,37 +25,31 @@ app = Flask(__name__)
 DEBUG = os.environ.get("judger_debug") == "1"
 app.debug = DEBUG
 
+#长轮询最多等待的秒数，避免处理请求的线程被长时间占用
+MAX_JOB_WAIT = 30
+
 
 #初始化提交环境，
 class InitSubmissionEnv(object):
     
     #以下的三个函数（__init__， __enter__，__exit__）是with...as的执行机制
     # 在下面的with...as函数中被调用，
-    #根据提交的ID初始化工作空间路径
-    def __init__(self, judger_workspace, submission_id):
-        self.path = os.path.join(judger_workspace, submission_id)
+    #工作空间从工作空间池获取：tmpfs上预先创建好的目录，或者磁盘上新建的目录
+    def __init__(self, pool=workspace_pool):
+        self.pool = pool
+        self.path = None
+        self.in_tmpfs = False
 
-    #紧接着执行with的入口第一个函数，创建对应的文件夹，更改目录所有者和权限，此函数被调用之后先
+    #紧接着执行with的入口第一个函数，获取工作空间，目录的所有者和权限已经设置好，此函数被调用之后先
     # 返回下面with...as主函数继续执行
     def __enter__(self):
-        try:
-            #创建，更改用户和组ID，赋予所有者所有权限，组用户和其他用户执行权限
-            os.mkdir(self.path)
-            os.chown(self.path, COMPILER_USER_UID, RUN_GROUP_GID)
-            os.chmod(self.path, 0o711)
-        except Exception as e:
-            logger.exception(e)
-            raise JudgeClientError("failed to create runtime dir")
+        self.path, self.in_tmpfs = self.pool.acquire()
         return self.path
     
-    #with...as的最后操作退出，非调试模式下并删除工作空间路径文件夹
+    #with...as的最后操作退出，非调试模式下清空并归还工作空间
     def __exit__(self, exc_type, exc_val, exc_tb):
         if not DEBUG:
-            try:
-                shutil.rmtree(self.path)
-            except Exception as e:
-                logger.exception(e)
-                raise JudgeClientError("failed to clean runtime dir")
+            self.pool.release(self.path, self.in_tmpfs)
 
 #根据请求：/ping,/judge,/compile_spj三个不同的映射来进行选择
 class JudgeServer:
@@ -60,6 +58,12 @@ class JudgeServer:
     def ping(cls):
         data = server_info()
         data["action"] = "pong"
+        #编译缓存的命中和未命中次数等信息
+        data["compile_cache"] = compile_cache.stats()
+        #异步评判任务的排队情况
+        data["jobs"] = judge_job_queue.stats()
+        #工作空间的准备和清理耗时
+        data["workspace"] = workspace_pool.stats()
         return data
 
 
@@ -68,31 +72,21 @@ class JudgeServer:
     # 传入的language_config,spj_version,spj_config,spj_compile_config等参数的格式都是json格式的
     @classmethod
     def judge(cls, language_config, src, max_cpu_time, max_memory, test_case_id,
-              spj_version=None, spj_config=None, spj_compile_config=None, spj_src=None, output=False):
+              spj_version=None, spj_config=None, spj_compile_config=None, spj_src=None, output=False,
+              stop_on_first_failure=False, on_result=None):
         # 初始化
         # 根据语言配置，获得language_config里面的compile下的编译参数配置：编译源文件名称，执行文件名称，最大CPU使用时间，评判实际用时，最大内存，编译命令
         compile_config = language_config.get("compile")
         # 根据语言配置，获得language_config里面的run下的运行参数配置：执行文件的路径，安全运行模式名称，运行环境
         run_config = language_config["run"]
-        # 使用python内置模块uuid在此生成对应的提交ID
-        submission_id = uuid.uuid4().hex
-
         # 如果特殊评判版本和评判配置不为空,就要进行特殊评判，否则才执行下面的操作
-        if spj_version and spj_config:
-            # 拼接设置特殊评判执行文件的路径
-            spj_exe_path = os.path.join(SPJ_EXE_DIR, spj_config["exe_name"].format(spj_version=spj_version))
-            # 如果特殊评判之前没有被编译成功，找不到可执行文件，日志抛出警告，然后先编译
-            if not os.path.isfile(spj_exe_path):
-                logger.warning("%s does not exists, spj src will be recompiled")
-                #类本身调用编译方法进行编译
-                cls.compile_spj(spj_version=spj_version, src=spj_src,
-                                spj_compile_config=spj_compile_config)
-        
+        cls._ensure_spj(spj_version, spj_config, spj_compile_config, spj_src)
+
         #特殊评判编译成功，或者不用执行特殊评判之后，执行正常的普通代码评判
         #要注意with...as的运行机制的好处，和执行过程
-        # 返回上面调用机制，先将工作空间拼接好，然后赋值给submission_dir(提交文件目录)
-        #初始化提交源码文件的环境:submission_dir=/judger/run/submission_id/
-        with InitSubmissionEnv(JUDGER_WORKSPACE_BASE, submission_id=str(submission_id)) as submission_dir:
+        # 返回上面调用机制，先获取工作空间，然后赋值给submission_dir(提交文件目录)
+        #初始化提交源码文件的环境:submission_dir=/judger/run/随机的目录名/，使用tmpfs的话在JUDGER_TMPFS_DIR下面
+        with InitSubmissionEnv() as submission_dir:
             #如果编译配置非空，说明需要编译源码，否则说明源码已经被编译好了，设置运行源码
             if compile_config:
                 #每种语言的submission_dir都是不同放入，c,c++为main.c等
@@ -104,10 +98,16 @@ class JudgeServer:
                 os.chown(src_path, COMPILER_USER_UID, 0)
                 os.chmod(src_path, 0o400)
 
-                # 编译用户提交的源代码并返回可执行文件路径
-                exe_path = Compiler().compile(compile_config=compile_config,
-                                              src_path=src_path,
-                                              output_dir=submission_dir)
+                # 相同的源码和编译配置之前已经编译过，直接从编译缓存复制编译好的文件，不用再编译
+                cache_key = compile_cache.make_key(compile_config, src)
+                if compile_cache.restore(cache_key, submission_dir):
+                    exe_path = os.path.join(submission_dir, compile_config["exe_name"])
+                else:
+                    # 编译用户提交的源代码并返回可执行文件路径，编译成功之后放入编译缓存
+                    exe_path = Compiler().compile(compile_config=compile_config,
+                                                  src_path=src_path,
+                                                  output_dir=submission_dir)
+                    compile_cache.store(cache_key, submission_dir, src_name=compile_config["src_name"])
                 try:
                     #编译后Java的可执行文件是SOME_PATH/Main，但是真实的文件是SOME_PATH/Main.class
                     #可以先忽略这个
@@ -133,11 +133,88 @@ class JudgeServer:
                                        submission_dir=submission_dir,
                                        spj_version=spj_version,
                                        spj_config=spj_config,
-                                       output=output)
+                                       output=output,
+                                       #ACM题目只需要第一个出错的测试用例，出错之后就不再评判剩下的
+                                       stop_on_first_failure=stop_on_first_failure,
+                                       #异步评判的时候，每评判完一个测试用例就记录到评判任务的进度里面
+                                       on_result=on_result)
             run_result = judge_client.run()
 
             return run_result
 
+    # 异步评判：参数和judge一样，放入评判任务队列之后马上返回任务id，不占用处理请求的线程
+    # 后台之后通过job_result查询结果，或者传入callback_url，评判完成之后由服务器把结果推送过去
+    @classmethod
+    def judge_async(cls, callback_url=None, **kwargs):
+        #回调地址来自请求，只能推送到配置的主机，不能让评测机去请求任意的地址
+        if callback_url:
+            url = urlsplit(callback_url)
+            if url.scheme not in ("http", "https") or url.netloc not in JOB_CALLBACK_HOSTS:
+                raise JudgeClientError("callback_url host is not allowed")
+        job = judge_job_queue.submit(cls.judge, kwargs, error_handler=_error_response, callback_url=callback_url)
+        return {"job_id": job.id}
+
+    # 查询异步评判任务的状态和结果，wait大于0的话最多等待wait秒直到评判完成（长轮询）
+    # 评判还没有完成的时候返回progress：已经评判完成的测试用例的结果
+    # progress_offset是后台已经拿到的测试用例结果数，有新的测试用例结果的时候就马上返回，不用等到评判完成
+    @classmethod
+    def job_result(cls, job_id, wait=0, progress_offset=None):
+        job = judge_job_queue.get(job_id, wait=min(float(wait), MAX_JOB_WAIT), progress_offset=progress_offset)
+        if not job:
+            raise JudgeClientError("job %s does not exist" % job_id)
+        return job.to_dict()
+
+    # 批量评判同一个测试用例（同一道题）的多个提交，例如重判一道题的所有提交，只需要一次http请求
+    # submissions是一个列表，每一项包括提交的id，language_config和src，其他的参数和judge一样，所有的提交共用
+    # 测试用例信息和特殊评判只加载和编译一次，所有提交一起调度到进程池，每评判完一个提交就返回一行json（NDJSON）
+    @classmethod
+    def judge_batch(cls, submissions, test_case_id, spj_version=None, spj_config=None, spj_compile_config=None,
+                    spj_src=None, **kwargs):
+        # 在开始返回结果之前检查提交、测试用例和特殊评判，出错的话整个请求直接返回错误，
+        # 开始返回结果之后再出错的话，其他提交的结果也会被中断
+        for submission in submissions:
+            if not isinstance(submission, dict) or \
+                    not all(key in submission for key in ("id", "language_config", "src")):
+                raise JudgeClientError("each submission requires id, language_config and src")
+        test_case_info_cache.get(str(test_case_id))
+        cls._ensure_spj(spj_version, spj_config, spj_compile_config, spj_src)
+
+        def _judge_one(submission):
+            try:
+                ret = {"err": None, "data": cls.judge(language_config=submission["language_config"],
+                                                      src=submission["src"],
+                                                      test_case_id=test_case_id,
+                                                      spj_version=spj_version,
+                                                      spj_config=spj_config,
+                                                      **kwargs)}
+            except Exception as e:
+                logger.exception(e)
+                ret = _error_response(e)
+            ret["id"] = submission["id"]
+            return ret
+
+        def _stream():
+            # 同时评判的提交数和进程池大小一样，每个提交的测试用例再由进程池并发运行
+            with ThreadPoolExecutor(max_workers=judge_pool.processes) as executor:
+                futures = [executor.submit(_judge_one, item) for item in submissions]
+                for future in as_completed(futures):
+                    yield json.dumps(future.result()) + "\n"
+
+        return _stream()
+
+    # 如果特殊评判之前没有被编译成功，找不到可执行文件，就先编译特殊评判
+    @classmethod
+    def _ensure_spj(cls, spj_version, spj_config, spj_compile_config, spj_src):
+        if spj_version and spj_config:
+            # 拼接设置特殊评判执行文件的路径
+            spj_exe_path = os.path.join(SPJ_EXE_DIR, spj_config["exe_name"].format(spj_version=spj_version))
+            # 如果特殊评判之前没有被编译成功，找不到可执行文件，日志抛出警告，然后先编译
+            if not os.path.isfile(spj_exe_path):
+                logger.warning("%s does not exists, spj src will be recompiled")
+                #类本身调用编译方法进行编译
+                cls.compile_spj(spj_version=spj_version, src=spj_src,
+                                spj_compile_config=spj_compile_config)
+
     # 编译特殊评判源文件，需要传入三个参数，此时传入的是特殊评判的源代码
     # 完成后返回字符串“success”
     @classmethod
@@ -171,6 +248,13 @@ class JudgeServer:
             raise SPJCompileError(e.message)
         return "success"
 
+# 将评判过程中的异常转换成返回给后台的错误信息
+def _error_response(e):
+    if isinstance(e, (CompileError, TokenVerificationFailed, SPJCompileError, JudgeClientError)):
+        return {"err": e.__class__.__name__, "data": e.message}
+    return {"err": "JudgeClientError", "data": e.__class__.__name__ + " :" + str(e)}
+
+
 #建立路由，通过路由可以执行其覆盖的方法，可以多个路由指向同一个方法。
 #使用 route() 装饰器告诉 Flask 什么样的URL 能触发我们的函数
 #这个函数的名字也在生成 URL 时被特定的函数采用，返回我们想要显示在用户浏览器中的信息。
@@ -179,7 +263,7 @@ class JudgeServer:
 @app.route('/<path:path>', methods=["POST"])
 def server(path):
     #设置多个可能的路由请求
-    if path in ("judge", "ping", "compile_spj"):
+    if path in ("judge", "ping", "compile_spj", "judge_batch", "judge_async", "job_result"):
         _token = request.headers.get("X-Judge-Server-Token")
         try:
             #如果令牌出错就抛出异常，否者执行try，获取数据
@@ -190,13 +274,14 @@ def server(path):
             except Exception:
                 data = {}
             #**将data的json格式数据转换成a=b的形式
-            ret = {"err": None, "data": getattr(JudgeServer, path)(**data)}
-        except (CompileError, TokenVerificationFailed, SPJCompileError, JudgeClientError) as e:
-            logger.exception(e)
-            ret = {"err": e.__class__.__name__, "data": e.message}
+            ret = getattr(JudgeServer, path)(**data)
+            #批量评判每完成一个提交就返回一行结果
+            if path == "judge_batch":
+                return Response(ret, mimetype="application/x-ndjson")
+            ret = {"err": None, "data": ret}
         except Exception as e:
             logger.exception(e)
-            ret = {"err": "JudgeClientError", "data": e.__class__.__name__ + " :" + str(e)}
+            ret = _error_response(e)
     else:
         ret = {"err": "InvalidRequest", "data": "404"}
 
@@ -208,6 +293,11 @@ def server(path):
 if DEBUG:
     logger.info("DEBUG=ON")
 
+#服务器进程加载应用的时候就预先fork好评判进程池，此时还没有开始处理请求的线程，之后所有的提交共享这个进程池
+judge_pool.start()
+#预先创建好tmpfs上的工作空间
+workspace_pool.prepare()
+
 # 用 run() 函数来让应用运行在本地服务器上。 其中 if __name__ == '__main__': 确保服务器只会在该脚本被 Python 
 # 解释器直接执行的时候才会运行，而不是作为模块导入的时候。
 # gunicorn -w 4 -b 0.0.0.0:8080 server:app
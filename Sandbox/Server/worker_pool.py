@@ -0,0 +1,45 @@
+import os
+import threading
+
+#常驻的多进程池，由评判服务器进程持有，所有提交共享，而不是每个提交都重新fork一遍
+from multiprocessing import Pool
+
+import psutil
+
+
+# 评判进程池：进程数就是同一时间内所有提交加起来能够并发执行的_judger.run的上限
+class JudgeWorkerPool(object):
+    def __init__(self, processes=None):
+        #默认根据系统CPU逻辑个数开启，也可以通过环境变量JUDGER_WORKER_NUM进行限定
+        self._processes = processes or int(os.environ.get("JUDGER_WORKER_NUM", 0)) or psutil.cpu_count()
+        self._pool = None
+        #多个处理请求的线程可能同时第一次用到进程池，这里加锁保证只创建一次
+        self._lock = threading.Lock()
+
+    @property
+    def processes(self):
+        return self._processes
+
+    # 预先fork好所有的工作进程，在服务器启动的时候调用，避免第一个提交来承担fork的开销
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(processes=self._processes)
+        return self._pool
+
+    # 将一个任务（例如一个测试用例的评判）调度到进程池，返回AsyncResult，调用get()获取结果
+    def apply_async(self, func, args=()):
+        pool = self._pool or self.start()
+        return pool.apply_async(func, args)
+
+    # 关闭进程池，等待所有任务完成，一般只在进程退出的时候使用
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+#整个评判服务器进程只有这一个进程池
+judge_pool = JudgeWorkerPool()
@@ -0,0 +1,137 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from config import JUDGER_WORKSPACE_BASE, JUDGER_TMPFS_WORKSPACE_BASE, WORKSPACE_POOL_SIZE, \
+    WORKSPACE_TMPFS_MIN_FREE, COMPILER_USER_UID, RUN_GROUP_GID
+from exception import JudgeClientError
+from utils import logger
+
+
+# 评判工作空间池：每个提交都需要一个工作空间目录，存放源码、编译结果和每个测试用例的输出文件
+# 配置了JUDGER_TMPFS_DIR（一个限定了大小的tmpfs）的话，工作空间放在内存里面，输出文件的写入和比较不再读写磁盘，
+# 评判完成之后清空目录里面的文件放回池里面，下一个提交直接使用，不用再mkdir、chown、chmod和rmtree整个目录
+# tmpfs剩余空间不够的时候退回到磁盘上的JUDGER_WORKSPACE_BASE，和之前一样每次新建和删除
+class WorkspacePool(object):
+    def __init__(self, disk_base=JUDGER_WORKSPACE_BASE, tmpfs_base=JUDGER_TMPFS_WORKSPACE_BASE,
+                 pool_size=WORKSPACE_POOL_SIZE, tmpfs_min_free=WORKSPACE_TMPFS_MIN_FREE):
+        self._disk_base = disk_base
+        self._tmpfs_base = tmpfs_base
+        self._pool_size = pool_size
+        self._tmpfs_min_free = tmpfs_min_free
+        #清空之后可以直接使用的tmpfs工作空间
+        self._free = []
+        #工作空间的准备和清理耗时，单位秒
+        self._setup_time = 0.0
+        self._teardown_time = 0.0
+        self._tmpfs_count = 0
+        self._disk_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tmpfs_enabled(self):
+        return bool(self._tmpfs_base)
+
+    # 预先创建好工作空间，在服务器启动的时候调用
+    def prepare(self):
+        if not self.tmpfs_enabled:
+            return
+        for _ in range(self._pool_size):
+            path = os.path.join(self._tmpfs_base, uuid.uuid4().hex)
+            try:
+                self._create(path)
+            except Exception as e:
+                logger.exception(e)
+                break
+            with self._lock:
+                self._free.append(path)
+
+    # 创建一个工作空间目录，编译用户是所有者，运行用户所在的组只有执行权限
+    @staticmethod
+    def _create(path):
+        os.mkdir(path)
+        os.chown(path, COMPILER_USER_UID, RUN_GROUP_GID)
+        os.chmod(path, 0o711)
+
+    # tmpfs剩余的空间是否足够再放一个工作空间
+    def _tmpfs_available(self):
+        try:
+            stat = os.statvfs(self._tmpfs_base)
+        except OSError as e:
+            logger.exception(e)
+            return False
+        return stat.f_bavail * stat.f_frsize >= self._tmpfs_min_free
+
+    # 获取一个工作空间，返回(路径, 是否在tmpfs上)
+    def acquire(self):
+        start = time.perf_counter()
+        in_tmpfs = self.tmpfs_enabled and self._tmpfs_available()
+        path = None
+        if in_tmpfs:
+            with self._lock:
+                if self._free:
+                    path = self._free.pop()
+        try:
+            if path is None:
+                path = os.path.join(self._tmpfs_base if in_tmpfs else self._disk_base, uuid.uuid4().hex)
+                self._create(path)
+        except Exception as e:
+            logger.exception(e)
+            raise JudgeClientError("failed to create runtime dir")
+        with self._lock:
+            self._setup_time += time.perf_counter() - start
+            if in_tmpfs:
+                self._tmpfs_count += 1
+            else:
+                self._disk_count += 1
+        return path, in_tmpfs
+
+    # 归还工作空间：tmpfs上的工作空间清空之后放回池里，磁盘上的或者池已经满了就整个删除
+    def release(self, path, in_tmpfs):
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                reuse = in_tmpfs and len(self._free) < self._pool_size
+            if reuse:
+                self._scrub(path)
+                with self._lock:
+                    self._free.append(path)
+            else:
+                shutil.rmtree(path)
+        except Exception as e:
+            logger.exception(e)
+            #清空失败的工作空间不能再使用，尽量删除
+            shutil.rmtree(path, ignore_errors=True)
+            raise JudgeClientError("failed to clean runtime dir")
+        finally:
+            with self._lock:
+                self._teardown_time += time.perf_counter() - start
+
+    # 删除工作空间里面的所有文件，并恢复目录的所有者和权限，防止被上一个提交修改过
+    def _scrub(self, path):
+        for name in os.listdir(path):
+            item = os.path.join(path, name)
+            if os.path.isdir(item) and not os.path.islink(item):
+                shutil.rmtree(item)
+            else:
+                os.remove(item)
+        os.chown(path, COMPILER_USER_UID, RUN_GROUP_GID)
+        os.chmod(path, 0o711)
+
+    # 工作空间统计信息，通过ping返回
+    def stats(self):
+        with self._lock:
+            count = self._tmpfs_count + self._disk_count
+            return {"tmpfs": self.tmpfs_enabled,
+                    "free": len(self._free),
+                    "tmpfs_count": self._tmpfs_count,
+                    "disk_count": self._disk_count,
+                    "setup_time": self._setup_time,
+                    "teardown_time": self._teardown_time,
+                    "avg_setup_time": self._setup_time / count if count else 0,
+                    "avg_teardown_time": self._teardown_time / count if count else 0}
+
+
+workspace_pool = WorkspacePool()
@@ -4,14 +4,33 @@
 # 这个中间件非常关键，例如记录session等信息和配置信息
 # 如果没用这个中间件，在测试的时候就知道使用不了session和ip等信息
 # 同时还要将其配置到settings的中间件哪里
+import ipaddress
+import re
+
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.utils.timezone import now
 from django.utils.deprecation import MiddlewareMixin
 
 from myutils.api import JSONResponse
+from myutils.cache import cache
+from myutils.throttling import TokenBucket
+from options.options import SysOptions
 from account.models import User
 
+# 按ip限流的接口，每次请求消耗的ip令牌数，按照顺序匹配第一个，没有匹配的接口不限流
+# 第三项是详情接口的参数，列表和详情是同一个路径（例如/api/problem?problem_id=），带这个参数的请求不算列表，不限流
+# 机房、学校的出口通常是同一个ip（NAT），列表和排名接口消耗的令牌很少，整个机房正常浏览不会被拒绝，
+# 默认的ip令牌桶每秒填充0.1个，消耗0.02个的接口每个ip每秒可以请求5次，刷接口的请求在查询数据库之前就被拒绝
+IP_THROTTLING_WEIGHTS = [
+    (re.compile(r"^/api/(register|apply_reset_password|reset_password)/?$"), 2, None),
+    (re.compile(r"^/api/(login|tfa_required|check_username_or_email)/?$"), 1, None),
+    (re.compile(r"^/api/captcha/?$"), 0.5, None),
+    (re.compile(r"^/api/(contest/)?problem/?$"), 0.02, "problem_id"),
+    (re.compile(r"^/api/(contests|submissions|contest_submissions|user_rank)/?$"), 0.02, None),
+    # 排名是从快照返回的，比其他列表便宜
+    (re.compile(r"^/api/contest_rank/?$"), 0.01, None),
+]
 
 class APITokenAuthMiddleware(MiddlewareMixin):
     # 调用接口的令牌验证中间件类
@@ -29,8 +48,41 @@ class APITokenAuthMiddleware(MiddlewareMixin):
                 pass
 
 
+class IPThrottlingMiddleware(MiddlewareMixin):
+    # ip限流中间件，登录、注册、列表这些接口在查询数据库之前拒绝请求太多的ip，使用SysOptions.throttling["ip"]的令牌桶
+    def process_request(self, request):
+        path = request.path_info
+        if not path.startswith("/api/"):
+            return
+        ip = request.META.get(settings.IP_HEADER, request.META.get("REMOTE_ADDR"))
+        try:
+            # 本机的请求（例如健康检查）不限流
+            if not ip or ipaddress.ip_address(ip).is_loopback:
+                return
+        except ValueError:
+            pass
+        weight = 0
+        for pattern, item, detail_param in IP_THROTTLING_WEIGHTS:
+            if pattern.match(path):
+                if not (detail_param and request.GET.get(detail_param)):
+                    weight = item
+                break
+        if not weight:
+            return
+        bucket = TokenBucket(key=f"ip:{ip}", redis_conn=cache, **SysOptions.throttling["ip"])
+        can_consume, wait = bucket.consume(weight)
+        if not can_consume:
+            resp = JSONResponse.response({"error": "error",
+                                          "data": "Too many requests, please wait %d seconds" % int(wait)})
+            resp.status_code = 429
+            resp["Retry-After"] = int(wait) + 1
+            return resp
+
+
 class SessionRecordMiddleware(MiddlewareMixin):
     # session记录中间件
+    # 只有值变化了才写入session，last_activity最多每SESSION_ACTIVITY_GRANULARITY秒更新一次，
+    # 大部分请求不修改session，SessionMiddleware也就不需要把session重新写入缓存
     def process_request(self, request):
         # 解析请求
         request.ip = request.META.get(settings.IP_HEADER, request.META.get("REMOTE_ADDR"))
@@ -38,16 +90,30 @@ class SessionRecordMiddleware(MiddlewareMixin):
         if request.user.is_authenticated():
             session = request.session
             # session代理信息和IP配置
-            session["user_agent"] = request.META.get("HTTP_USER_AGENT", "")
-            session["ip"] = request.ip
+            user_agent = request.META.get("HTTP_USER_AGENT", "")
+            if session.get("user_agent") != user_agent:
+                session["user_agent"] = user_agent
+            if session.get("ip") != request.ip:
+                session["ip"] = request.ip
             # 更新最新的活动事件为现在
-            session["last_activity"] = now()
-            # 用户sessions是从request里面获取得到的
-            user_sessions = request.user.session_keys
-            # user_sessions是一个list，没有就向里面append
-            if session.session_key not in user_sessions:
-                user_sessions.append(session.session_key)
-                request.user.save()
+            current = now()
+            last_activity = session.get("last_activity")
+            if last_activity is None or \
+                    (current - last_activity).total_seconds() >= settings.SESSION_ACTIVITY_GRANULARITY:
+                session["last_activity"] = current
+            # 用户sessions是从request里面获取得到的，只有新的session才需要加入
+            if session.session_key not in request.user.session_keys:
+                self._add_session_key(request.user, session.session_key)
+
+    @staticmethod
+    def _add_session_key(user, session_key):
+        # 锁住用户这一行之后只更新session_keys，同一个用户同时登录多个session不会互相覆盖
+        with transaction.atomic():
+            session_keys = User.objects.select_for_update().values_list("session_keys", flat=True).get(id=user.id)
+            if session_key not in session_keys:
+                session_keys.append(session_key)
+                User.objects.filter(id=user.id).update(session_keys=session_keys)
+        user.session_keys = session_keys
 
 
 class AdminRoleRequiredMiddleware(MiddlewareMixin):
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0001_initial'),
+        # 先把数据转换到UserProblemStatus再删除字段
+        ('problem', '0004_migrate_user_problem_status'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='acm_problems_status',
+        ),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='oi_problems_status',
+        ),
+    ]
@@ -80,24 +80,7 @@ class User(AbstractBaseUser):
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    # acm_problems_status examples:
-    # {
-    #     "problems": {
-    #         "1": {
-    #             "status": JudgeStatus.ACCEPTED,
-    #             "_id": "1000"
-    #         }
-    #     },
-    #     "contest_problems": {
-    #         "1": {
-    #             "status": JudgeStatus.ACCEPTED,
-    #             "_id": "1000"
-    #         }
-    #     }
-    # }
-    acm_problems_status = JSONField(default=dict)
-    # 类似于acm_problems_status，但是仅仅是添加了score字段
-    oi_problems_status = JSONField(default=dict)
+    # 用户做题的状态（之前的acm_problems_status和oi_problems_status）保存在problem.models.UserProblemStatus
 
     real_name = models.TextField(null=True)
     # 头像的这个东西要专门留意一下
@@ -4,6 +4,7 @@
 from django import forms
 
 from myutils.api import serializers, UsernameSerializer
+from problem.models import ProblemRuleType, UserProblemStatus
 
 from .models import AdminType, ProblemPermission, User, UserProfile
 
@@ -73,6 +74,8 @@ class UserSerializer(serializers.ModelSerializer):
 class UserProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer()
     real_name = serializers.SerializerMethodField()
+    acm_problems_status = serializers.SerializerMethodField()
+    oi_problems_status = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfile
@@ -85,6 +88,26 @@ class UserProfileSerializer(serializers.ModelSerializer):
     def get_real_name(self, obj):
         return obj.real_name if self.show_real_name else None
 
+    @staticmethod
+    def _problems_status(obj, rule_type):
+        # 从UserProblemStatus生成和之前的json字段一样的格式，前端不需要修改：
+        # {"problems": {题目id: {"status": ..., "_id": ...}}, "contest_problems": {...}}，OI的题目还有score
+        ret = {"problems": {}, "contest_problems": {}}
+        items = UserProblemStatus.objects.filter(user_id=obj.user_id, problem__rule_type=rule_type) \
+            .values_list("problem_id", "problem___id", "contest_id", "status", "score")
+        for problem_id, display_id, contest_id, status, score in items:
+            info = {"status": status, "_id": display_id}
+            if rule_type == ProblemRuleType.OI:
+                info["score"] = score
+            ret["contest_problems" if contest_id else "problems"][str(problem_id)] = info
+        return ret
+
+    def get_acm_problems_status(self, obj):
+        return self._problems_status(obj, ProblemRuleType.ACM)
+
+    def get_oi_problems_status(self, obj):
+        return self._problems_status(obj, ProblemRuleType.OI)
+
 
 class EditUserSerializer(serializers.Serializer):
     id = serializers.IntegerField()
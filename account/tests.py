@@ -463,6 +463,33 @@ class UserLoginAPITest(APITestCase):
         user = auth.get_user(self.client)
         self.assertTrue(user.is_authenticated())
 
+    def test_login_ip_throttling(self):
+        # ip的令牌用完之后，登录请求在中间件里面就被拒绝
+        throttling = SysOptions.throttling
+        throttling["ip"] = {"capacity": 1, "fill_rate": 0.001, "default_capacity": 1}
+        SysOptions.throttling = throttling
+        ip = f"2001:db8::{rand_str(4)}"
+        data = {"username": self.username, "password": self.password}
+        response = self.client.post(self.login_url, data=data, HTTP_X_REAL_IP=ip)
+        self.assertSuccess(response)
+        response = self.client.post(self.login_url, data=data, HTTP_X_REAL_IP=ip)
+        self.assertEqual(response.status_code, 429)
+        # 登录之后的接口不按ip限流
+        response = self.client.get(self.reverse("user_profile_api"), HTTP_X_REAL_IP=ip)
+        self.assertSuccess(response)
+
+    def test_list_ip_throttling(self):
+        # 列表接口也按ip限流，消耗的令牌比登录少，详情接口不限流
+        throttling = SysOptions.throttling
+        throttling["ip"] = {"capacity": 0.03, "fill_rate": 0.00001, "default_capacity": 0.03}
+        SysOptions.throttling = throttling
+        ip = f"2001:db8::{rand_str(4)}"
+        url = self.reverse("problem_api")
+        self.assertSuccess(self.client.get(url, HTTP_X_REAL_IP=ip))
+        self.assertEqual(self.client.get(url, HTTP_X_REAL_IP=ip).status_code, 429)
+        response = self.client.get(url, data={"problem_id": "1"}, HTTP_X_REAL_IP=ip)
+        self.assertNotEqual(response.status_code, 429)
+
     def test_login_with_wrong_info(self):
         # 使用错误的信息登录
         response = self.client.post(self.login_url,
@@ -1,13 +1,17 @@
 from django.test import TestCase
 
 import hashlib
+import json
 from unittest import mock
 
 from django.conf import settings
 from django.utils import timezone
 
+from judge.scheduler import judge_server_scheduler
 from options.options import SysOptions
 from myutils.api.tests import APITestCase
+from myutils.cache import cache
+from myutils.constants import CacheKey
 from .models import JudgeServer
 
 
@@ -124,6 +128,19 @@ class JudgeServerHeartbeatTest(APITestCase):
         self.assertSuccess(resp)
         self.assertEqual(JudgeServer.objects.get(hostname=self.data["hostname"]).judger_version, data["judger_version"])
 
+    def test_reclaim_expired_slot_lease(self):
+        # 占用槽位的任务被杀掉没有释放，租约过期之后对账的时候回收槽位
+        self.test_new_heartbeat()
+        judge_server_scheduler.reconcile(force=True)
+        slot = judge_server_scheduler.acquire()
+        self.assertEqual(cache.zscore(CacheKey.judge_server_load, slot.id), 1)
+        cache.execute_command("ZADD", CacheKey.judge_server_lease, "XX", 0, slot.lease)
+        judge_server_scheduler.reconcile(force=True)
+        self.assertEqual(cache.zscore(CacheKey.judge_server_load, slot.id), 0)
+        # 已经回收的槽位再释放也不会把任务数减成负数
+        judge_server_scheduler.release(slot)
+        self.assertEqual(cache.zscore(CacheKey.judge_server_load, slot.id), 0)
+
 
 class JudgeServerAPITest(APITestCase):
     # 评判机接口
@@ -158,7 +175,27 @@ class LanguageListAPITest(APITestCase):
     def test_get_languages(self):
         # 获取系统语言和特殊评测语言，默认是相等的
         resp = self.client.get(self.reverse("language_list_api"))
-        self.assertSuccess(resp)
+        data = json.loads(resp.content.decode("utf-8"))
+        self.assertIsNone(data["error"])
+        self.assertEqual([item["name"] for item in data["data"]["languages"]], list(SysOptions.language_names))
+
+    def test_get_languages_not_modified(self):
+        # 语言没有修改的时候，带上ETag再次请求返回304
+        url = self.reverse("language_list_api")
+        resp = self.client.get(url)
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp["ETag"])
+        self.assertEqual(resp.status_code, 304)
+
+    def test_language_registry_copies(self):
+        # 修改拿到的语言配置不会影响之后的请求
+        SysOptions.spj_languages[0]["spj"]["compile"]["exe_name"] = "changed"
+        SysOptions.language_names.append("changed")
+        registry = SysOptions.language_registry
+        self.assertNotEqual(registry.spj_languages[0]["spj"]["compile"]["exe_name"], "changed")
+        self.assertNotIn("changed", SysOptions.language_names)
+        config = registry.config("C")
+        config["compile"]["exe_name"] = "changed"
+        self.assertNotEqual(registry.config("C")["compile"]["exe_name"], "changed")
 
 
 class TestCasePruneAPITest(APITestCase):
@@ -183,6 +220,14 @@ class TestCasePruneAPITest(APITestCase):
         self.assertSuccess(resp)
         mocked_delete_one.assert_called_once_with(valid_id)
 
+    @mock.patch("conf.views.TestCasePruneAPI.delete_one")
+    def test_delete_invalid_test_case_id(self, mocked_delete_one):
+        # blobs和路径不是测试用例，不能删除
+        for test_case_id in ("blobs", "../x"):
+            resp = self.client.delete(f"{self.url}?id={test_case_id}")
+            self.assertFailed(resp, "Invalid test case id")
+        mocked_delete_one.assert_not_called()
+
 
 class ReleaseNoteAPITest(APITestCase):
     # 版本更改记录
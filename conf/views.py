@@ -4,8 +4,6 @@
 import hashlib
 import json
 import os
-import re
-import shutil
 import smtplib
 import time
 from datetime import datetime
@@ -13,17 +11,20 @@ from datetime import datetime
 import pytz
 import requests
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
 from django.utils import timezone
 from requests.exceptions import RequestException
 
 from account.decorators import super_admin_required
 from account.models import User
 from contest.models import Contest
-from judge.dispatcher import process_pending_task
+from judge.dispatcher import process_pending_task, waiting_queue_stats, judge_server_latency_stats
+from judge.scheduler import judge_server_scheduler
 from options.options import SysOptions
 from problem.models import Problem
+from problem.test_case_store import is_valid_test_case_id, test_case_store, TEST_CASE_ID_RE
 from submission.models import Submission
-from myutils.api import APIView, CSRFExemptAPIView, validate_serializer
+from myutils.api import APIView, CSRFExemptAPIView, ContentType, validate_serializer
 from myutils.shortcuts import send_email, get_env
 from myutils.xss_filter import XSSHtml
 from .models import JudgeServer
@@ -129,14 +130,20 @@ class JudgeServerAPI(APIView):
         servers = JudgeServer.objects.all().order_by("-last_heartbeat")
         # 返回系统存放的服务器口令和经过序列化的Server信息
         return self.success({"token": SysOptions.judge_server_token,
-                             "servers": JudgeServerSerializer(servers, many=True).data})
+                             "servers": JudgeServerSerializer(servers, many=True).data,
+                             # 等待队列的长度和排队时间
+                             "waiting_queue": waiting_queue_stats(),
+                             # 每台评测机的评测耗时直方图
+                             "latency": judge_server_latency_stats([server.id for server in servers])})
 
     @super_admin_required
     def delete(self, request):
         # 删除Judge_Server的信息，使用URL的方式传数据就使用GET.get
         hostname = request.GET.get("hostname")
         if hostname:
-            JudgeServer.objects.filter(hostname=hostname).delete()
+            for server in JudgeServer.objects.filter(hostname=hostname):
+                judge_server_scheduler.remove_server(server.id)
+                server.delete()
         return self.success()
 
     @validate_serializer(EditJudgeServerSerializer)
@@ -146,6 +153,9 @@ class JudgeServerAPI(APIView):
         is_disabled = request.data.get("is_disabled", False)   # is_disabled ->True
         print(is_disabled)
         JudgeServer.objects.filter(id=request.data["id"]).update(is_disabled=is_disabled)
+        # 禁用的评测机在调度器里面的槽位数变成0，不再分配新的任务
+        for server in JudgeServer.objects.filter(id=request.data["id"]):
+            judge_server_scheduler.update_server(server)
         if not is_disabled:
             # 解析排在队列里面的任务
             process_pending_task()
@@ -174,28 +184,40 @@ class JudgeServerHeartbeatAPI(CSRFExemptAPIView):
             server.ip = request.ip
             server.last_heartbeat = timezone.now()
             server.save()
+            # 更新调度器里面评测机的心跳和槽位数
+            judge_server_scheduler.update_server(server)
         except JudgeServer.DoesNotExist:
             # 若果不存在就配置，例如刚开始hostname不存在的
-            JudgeServer.objects.create(hostname=data["hostname"],
-                                       judger_version=data["judger_version"],
-                                       cpu_core=data["cpu_core"],
-                                       memory_usage=data["memory"],
-                                       cpu_usage=data["cpu"],
-                                       ip=request.META["REMOTE_ADDR"],
-                                       service_url=data["service_url"],
-                                       last_heartbeat=timezone.now(),
-                                       )
-            # 新server上线 处理队列中的任务，防止没有新的提交而导致一直waiting
-            # 将处于等待的（CacheKey.waiting_queue）任务加载到异步队列里面去
-            process_pending_task()
-
+            server = JudgeServer.objects.create(hostname=data["hostname"],
+                                                judger_version=data["judger_version"],
+                                                cpu_core=data["cpu_core"],
+                                                memory_usage=data["memory"],
+                                                cpu_usage=data["cpu"],
+                                                ip=request.META["REMOTE_ADDR"],
+                                                service_url=data["service_url"],
+                                                last_heartbeat=timezone.now(),
+                                                )
+            # 新server上线，下面处理队列中的任务，防止没有新的提交而导致一直waiting
+            judge_server_scheduler.update_server(server)
+
+        # 定期和数据库对账
+        judge_server_scheduler.reconcile()
+        # 评测机的心跳同时也是定时器：即使一直没有评测完成，等待队列里面的任务也能在有空闲槽位的时候被取出
+        process_pending_task()
         return self.success()
 
 
 class LanguagesAPI(APIView):
     # 语言选择配置
     def get(self, request):
-        return self.success({"languages": SysOptions.languages, "spj_languages": SysOptions.spj_languages})
+        # 响应在语言索引里面已经序列化好了，语言没有修改的时候返回304
+        registry = SysOptions.language_registry
+        if request.META.get("HTTP_IF_NONE_MATCH") == registry.etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(registry.response_body, content_type=ContentType.json_response)
+        response["ETag"] = registry.etag
+        return response
 
 
 class TestCasePruneAPI(APIView):
@@ -223,11 +245,15 @@ class TestCasePruneAPI(APIView):
         # 删除多余的测试用例
         test_case_id = request.GET.get("id")
         if test_case_id:
+            if not is_valid_test_case_id(test_case_id):
+                return self.error("Invalid test case id")
             self.delete_one(test_case_id)
             return self.success()
         # 删除孤儿测试列表的测试样例
         for id in self.get_orphan_ids():
             self.delete_one(id)
+        # 回收已经没有任何测试用例引用的文件
+        test_case_store.gc()
         return self.success()
 
     @staticmethod
@@ -237,9 +263,8 @@ class TestCasePruneAPI(APIView):
         # print(db_ids)       #<QuerySet []>
         disk_ids = os.listdir(settings.TEST_CASE_DIR)
         # print(disk_ids)     #[]
-        test_case_re = re.compile(r"^[a-zA-Z0-9]{32}$")
-        # print(test_case_re)   # 符合正则表达式的筛选出来
-        disk_ids = filter(lambda f: test_case_re.match(f), disk_ids)
+        # 符合test_case_id格式的筛选出来
+        disk_ids = filter(lambda f: TEST_CASE_ID_RE.match(f), disk_ids)
         # print(disk_ids)     # <filter object at 0x7f5f0dbb96a0>
         # print(list(set(disk_ids) - set(db_ids)))      #[]  因为没有这样一个目录，所以最后返回空列表
         return list(set(disk_ids) - set(db_ids))
@@ -247,9 +272,9 @@ class TestCasePruneAPI(APIView):
     @staticmethod
     def delete_one(id):
         # 删除一个孤儿测试用例，本方法被上面的delete调用
-        test_case_dir = os.path.join(settings.TEST_CASE_DIR, id)
-        if os.path.isdir(test_case_dir):
-            shutil.rmtree(test_case_dir, ignore_errors=True)
+        # 同时删除只被这个测试用例引用的文件，其他测试用例也在用的文件会保留
+        # 在存储的锁里面重新检查引用和修改时间，刚刚上传、还没有保存到题目的测试用例不会被删除
+        test_case_store.release(id)
 
 
 class ReleaseNotesAPI(APIView):
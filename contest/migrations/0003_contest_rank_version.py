@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contest', '0002_contest_rank_freeze_minutes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='acmcontestrank',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='oicontestrank',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
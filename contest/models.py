@@ -16,6 +16,8 @@ class Contest(models.Model):
     description = RichTextField()
     # 显示真实的排名或者缓存排名
     real_time_rank = models.BooleanField()
+    # 封榜：比赛结束前多少分钟开始，普通用户看到的排名停在封榜的时候，比赛结束之后解封，0表示不封榜
+    rank_freeze_minutes = models.IntegerField(default=0)
     password = models.TextField(null=True)
     # 枚举出来比赛的规则类型
     rule_type = models.TextField()
@@ -64,6 +66,8 @@ class AbstractContestRank(models.Model):
     user = models.ForeignKey(User)
     contest =models.ForeignKey(Contest)
     submission_number = models.IntegerField(default=0)
+    # 每次更新排名都加1，作为redis里面排名这一行的版本，见contest/scoreboard.py
+    version = models.IntegerField(default=0)
 
     class Meta:
         abstract = True
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*-encoding:UTF-8-*-
+# 增量维护的比赛排名
+#
+# 之前每次提交都会删除整个排名的缓存，下一次查看排名的时候重新查询所有参赛用户并排序。
+# 现在每个比赛在redis里面有一个有序集合和一个哈希表：
+#   contest_scoreboard:比赛id        有序集合，成员是用户id，分数是排名用的综合分数（见ContestScoreboard.score）
+#   contest_scoreboard_row:比赛id    哈希表，用户id -> 序列化之后的排名数据（json）
+#   contest_scoreboard_row_version:比赛id  哈希表，用户id -> 这一行的版本（数据库里面排名的version）
+#   contest_scoreboard_version:比赛id  排名每次变化都加1，不存在说明排名还没有从数据库加载
+# 评判完成之后只更新这个用户的一行，O(log n)，分页读取排名只访问redis。
+# 更新在数据库事务提交之后执行，同一个用户的两次更新可能乱序到达，版本比已经保存的旧的更新会被忽略。
+# 从数据库重新加载排名的时候（contest_scoreboard_rebuild:比赛id 是加载的锁）：
+#   先加锁再读取数据库，加载期间的更新除了照常更新之外，还记录在contest_scoreboard_pending:比赛id里面，
+#   加载的数据先写到临时的键，最后在一个脚本里面合并加载期间的更新、RENAME替换，加载期间的更新不会丢失。
+#
+# 普通用户看到的是排名的快照（contest_scoreboard_snapshot:比赛id，哈希表），不是实时的排名：
+#   etag       快照内容的摘要，用于If-None-Match
+#   time       生成快照的时间戳，超过SNAPSHOT_INTERVAL秒之后下一次读取的时候重新生成
+#   frozen     是否是封榜的快照，封榜期间不再重新生成，比赛结束之后解封
+#              封榜的快照不使用redis里面的实时排名，只根据封榜之前的提交重新计算（见get_frozen_rank），
+#              什么时候生成、生成几次内容都一样，快照丢失之后重新计算也还是封榜时候的排名
+#   rows       gzip压缩的所有排名数据
+#   page:offset:limit  gzip压缩的、已经序列化好的这一页的完整响应，第一次读取这一页的时候生成
+# 快照生成之后，每个请求只需要一次HMGET，直接返回压缩好的响应。
+
+import gzip
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from account.models import AdminType
+from myutils.cache import cache
+from myutils.constants import CacheKey, ContestRuleType
+from myutils.shortcuts import rand_str
+from submission.models import JudgeStatus, Submission
+from .models import ACMContestRank, OIContestRank
+from .serializers import ACMContestRankSerializer, OIContestRankSerializer
+
+# 排名数据在redis里面保存的时间（秒），每次更新都会延长，过期之后下一次读取的时候从数据库重新加载
+SCOREBOARD_TTL = 7 * 24 * 60 * 60
+# ACM排名的综合分数：AC数 * ACM_SCORE_BASE - 总用时，总用时不会超过ACM_SCORE_BASE秒（三百多年）
+ACM_SCORE_BASE = 10 ** 10
+
+# 从数据库加载排名最多需要的时间（秒），超过之后加载的锁过期，加载的结果作废
+REBUILD_LOCK_TIMEOUT = 60
+# 排名还没有加载、其他请求正在加载的时候，最多等待多久（秒）
+REBUILD_WAIT = 5
+
+# 正在从数据库加载排名的时候，把这次更新记录下来，加载完成的时候合并
+# 排名已经加载的时候才更新这个用户的一行，没有加载的话等下一次读取的时候从数据库加载，已经包括了这次的更新
+# 这个用户的一行的版本比这次更新的新的话，这次更新是乱序到达的旧数据，忽略
+# KEYS: 有序集合, 哈希表, 每一行的版本, 版本号, 加载期间的更新, 加载的锁
+# ARGV: 用户id, 综合分数, 排名数据, 过期时间, 这一行的版本
+UPDATE_SCRIPT = """
+local version = tonumber(ARGV[5])
+if redis.call('EXISTS', KEYS[6]) == 1 then
+    local pending = redis.call('HGET', KEYS[5], ARGV[1])
+    if not pending or tonumber(cjson.decode(pending)[1]) <= version then
+        redis.call('HSET', KEYS[5], ARGV[1], cjson.encode({ARGV[5], ARGV[2], ARGV[3]}))
+        redis.call('EXPIRE', KEYS[5], ARGV[4])
+    end
+end
+if redis.call('EXISTS', KEYS[4]) == 0 then
+    return false
+end
+local current = redis.call('HGET', KEYS[3], ARGV[1])
+if current and tonumber(current) > version then
+    return false
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[5])
+for i = 1, 4 do
+    redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+return redis.call('INCR', KEYS[4])
+"""
+
+# 加载完成：合并加载期间的更新到临时的键，再替换正在使用的排名，加载的锁已经过期（被其他加载替代）的话放弃
+# KEYS: 有序集合, 哈希表, 每一行的版本, 版本号, 加载期间的更新, 加载的锁, 临时有序集合, 临时哈希表, 临时的每一行的版本
+# ARGV: 加载的锁的值, 过期时间
+REBUILD_SCRIPT = """
+if redis.call('GET', KEYS[6]) ~= ARGV[1] then
+    redis.call('DEL', KEYS[7], KEYS[8], KEYS[9])
+    return false
+end
+local pending = redis.call('HGETALL', KEYS[5])
+for i = 1, #pending, 2 do
+    local user_id = pending[i]
+    local item = cjson.decode(pending[i + 1])
+    local current = redis.call('HGET', KEYS[9], user_id)
+    if not current or tonumber(current) <= tonumber(item[1]) then
+        redis.call('ZADD', KEYS[7], item[2], user_id)
+        redis.call('HSET', KEYS[8], user_id, item[3])
+        redis.call('HSET', KEYS[9], user_id, item[1])
+    end
+end
+for i = 1, 3 do
+    if redis.call('EXISTS', KEYS[6 + i]) == 1 then
+        redis.call('RENAME', KEYS[6 + i], KEYS[i])
+    else
+        redis.call('DEL', KEYS[i])
+    end
+end
+redis.call('DEL', KEYS[5], KEYS[6])
+local version = redis.call('INCR', KEYS[4])
+for i = 1, 4 do
+    redis.call('EXPIRE', KEYS[i], ARGV[2])
+end
+return version
+"""
+
+# 普通用户看到的排名快照最多多久重新生成一次（秒）
+SNAPSHOT_INTERVAL = 5
+# 生成封榜快照的锁的过期时间（秒），需要读取封榜之前的所有提交，比普通的快照慢
+FREEZE_LOCK_TIMEOUT = 60
+# ACM每次错误的罚时（秒），和judge/dispatcher.py里面的一致
+ACM_PENALTY = 20 * 60
+
+# 快照还是同一个版本的时候才保存生成的分页，防止把旧快照的分页写到新的快照里面
+# KEYS: 快照  ARGV: etag, 分页的字段, 分页的数据
+SAVE_PAGE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'etag') == ARGV[1] then
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+end
+return false
+"""
+
+
+class ContestScoreboard(object):
+    _update_script = None
+    _rebuild_script = None
+    _save_page_script = None
+
+    def __init__(self, contest):
+        self.contest = contest
+        self.zset_key = f"{CacheKey.contest_scoreboard}:{contest.id}"
+        self.row_key = f"{CacheKey.contest_scoreboard_row}:{contest.id}"
+        self.row_version_key = f"{CacheKey.contest_scoreboard_row_version}:{contest.id}"
+        self.version_key = f"{CacheKey.contest_scoreboard_version}:{contest.id}"
+        self.pending_key = f"{CacheKey.contest_scoreboard_pending}:{contest.id}"
+        self.rebuild_lock_key = f"{CacheKey.contest_scoreboard_rebuild}:{contest.id}"
+        self.snapshot_key = f"{CacheKey.contest_scoreboard_snapshot}:{contest.id}"
+        self.snapshot_lock_key = f"{CacheKey.contest_scoreboard_snapshot_lock}:{contest.id}"
+        self.freeze_lock_key = f"{CacheKey.contest_scoreboard_freeze_lock}:{contest.id}"
+
+    @property
+    def is_acm(self):
+        return self.contest.rule_type == ContestRuleType.ACM
+
+    def score(self, rank):
+        # ACM按照AC数从多到少、总用时从少到多排名，OI按照总分从高到低排名，读取的时候按照分数从高到低
+        if self.is_acm:
+            return rank.accepted_number * ACM_SCORE_BASE - rank.total_time
+        return rank.total_score
+
+    def serialize(self, rank):
+        # 保存真实姓名，读取的时候不是比赛管理员再去掉
+        serializer = ACMContestRankSerializer if self.is_acm else OIContestRankSerializer
+        return json.dumps(serializer(rank, is_contest_admin=True).data)
+
+    def get_rank(self):
+        # 数据库里面参加排名的用户：只有没有被禁用的普通用户
+        model = ACMContestRank if self.is_acm else OIContestRank
+        return model.objects.filter(contest=self.contest, user__admin_type=AdminType.REGULAR_USER,
+                                    user__is_disabled=False).select_related("user__userprofile")
+
+    @property
+    def _keys(self):
+        return [self.zset_key, self.row_key, self.row_version_key, self.version_key,
+                self.pending_key, self.rebuild_lock_key]
+
+    def rebuild(self):
+        """
+        从数据库重新加载整个排名，写到临时的键之后一次替换，读取的时候不会看到加载了一半的排名
+        :return: 其他请求正在加载的时候返回False
+        """
+        token = rand_str()
+        # 锁在lua脚本里面读取，不能用django的cache.set（会加前缀和序列化）
+        if not cache.execute_command("SET", self.rebuild_lock_key, token, "NX", "EX", REBUILD_LOCK_TIMEOUT):
+            return False
+        # 加锁之后再读取数据库，之后提交的更新都会记录在加载期间的更新里面
+        cache.execute_command("DEL", self.pending_key)
+        ranks = list(self.get_rank())
+        tmp_keys = [f"{key}:rebuild" for key in (self.zset_key, self.row_key, self.row_version_key)]
+        pipe = cache.pipeline()
+        pipe.delete(*tmp_keys)
+        if ranks:
+            # 不同版本的redis-py的zadd参数不一样，直接执行命令
+            args = []
+            for rank in ranks:
+                args.extend([self.score(rank), rank.user_id])
+            pipe.execute_command("ZADD", tmp_keys[0], *args)
+            pipe.hmset(tmp_keys[1], {rank.user_id: self.serialize(rank) for rank in ranks})
+            pipe.hmset(tmp_keys[2], {rank.user_id: rank.version for rank in ranks})
+        pipe.execute()
+        if ContestScoreboard._rebuild_script is None:
+            ContestScoreboard._rebuild_script = cache.register_script(REBUILD_SCRIPT)
+        return bool(ContestScoreboard._rebuild_script(keys=self._keys + tmp_keys, args=[token, SCOREBOARD_TTL]))
+
+    def ensure_built(self):
+        if cache.exists(self.version_key) or self.rebuild():
+            return
+        # 其他请求正在加载，等加载完成
+        deadline = time.time() + REBUILD_WAIT
+        while time.time() < deadline and not cache.exists(self.version_key):
+            time.sleep(0.1)
+
+    def update(self, rank):
+        # 评判完成、保存了这个用户的排名之后调用，只更新这一行
+        # 排名的version每次更新都会增加，作为这一行的版本，乱序到达的旧数据不会覆盖新的数据
+        # 封榜的快照只根据封榜之前的提交生成，这里不需要处理封榜
+        if rank.user.admin_type != AdminType.REGULAR_USER or rank.user.is_disabled:
+            return
+        if ContestScoreboard._update_script is None:
+            ContestScoreboard._update_script = cache.register_script(UPDATE_SCRIPT)
+        ContestScoreboard._update_script(keys=self._keys,
+                                         args=[rank.user_id, self.score(rank), self.serialize(rank), SCOREBOARD_TTL,
+                                               rank.version])
+
+    def reader(self, is_contest_admin=False):
+        self.ensure_built()
+        return ScoreboardReader(self, is_contest_admin)
+
+    @property
+    def freeze_time(self):
+        # 封榜的时间：比赛结束前rank_freeze_minutes分钟，不实时显示排名的比赛从比赛开始就封榜
+        if not self.contest.real_time_rank:
+            return self.contest.start_time
+        return self.contest.end_time - timedelta(minutes=self.contest.rank_freeze_minutes)
+
+    def is_frozen(self):
+        # 现在是不是在封榜期间：封榜的时间到比赛结束
+        # 不实时显示排名（real_time_rank为False）的比赛，整个比赛期间都是封榜的，普通用户看到的是第一个提交之前的排名
+        if self.contest.real_time_rank and not self.contest.rank_freeze_minutes:
+            return False
+        return self.freeze_time <= timezone.now() < self.contest.end_time
+
+    def get_frozen_rank(self):
+        """
+        封榜时候的排名：只根据封榜之前的提交重新计算，规则和judge/dispatcher.py里面更新排名的一致
+        数据库和redis里面的排名已经包括了封榜之后的提交，不能使用
+        :return: 按照排名排好序的、没有保存的排名对象
+        """
+        ranks = {rank.user_id: rank for rank in self.get_rank()}
+        model = ACMContestRank if self.is_acm else OIContestRank
+        frozen = {}
+        # 第一个AC的用户按照提交时间计算
+        first_ac = set()
+        submissions = Submission.objects.filter(contest=self.contest, user_id__in=list(ranks.keys()),
+                                                create_time__lt=self.freeze_time) \
+            .exclude(result__in=[JudgeStatus.PENDING, JudgeStatus.JUDGING, JudgeStatus.SYSTEM_ERROR]) \
+            .order_by("create_time", "id") \
+            .values_list("user_id", "problem_id", "result", "create_time", "statistic_info")
+        for user_id, problem_id, result, create_time, statistic_info in submissions.iterator():
+            rank = frozen.get(user_id)
+            if rank is None:
+                rank = frozen[user_id] = model(id=ranks[user_id].id, user=ranks[user_id].user, contest=self.contest)
+            problem_id = str(problem_id)
+            if not self.is_acm:
+                rank.total_score += statistic_info.get("score", 0) - rank.submission_info.get(problem_id, 0)
+                rank.submission_info[problem_id] = statistic_info.get("score", 0)
+                continue
+            info = rank.submission_info.setdefault(problem_id, {"is_ac": False, "ac_time": 0, "error_number": 0,
+                                                                "is_first_ac": False})
+            if info["is_ac"]:
+                continue
+            rank.submission_number += 1
+            if result == JudgeStatus.ACCEPTED:
+                rank.accepted_number += 1
+                info["is_ac"] = True
+                info["ac_time"] = (create_time - self.contest.start_time).total_seconds()
+                rank.total_time += int(info["ac_time"] + info["error_number"] * ACM_PENALTY)
+                if problem_id not in first_ac:
+                    first_ac.add(problem_id)
+                    info["is_first_ac"] = True
+            elif result != JudgeStatus.COMPILE_ERROR:
+                info["error_number"] += 1
+        # 和有序集合一样，分数相同的时候按照用户id从大到小
+        return sorted(frozen.values(), key=lambda rank: (self.score(rank), str(rank.user_id)), reverse=True)
+
+    def publish(self):
+        # 生成普通用户看到的快照，去掉真实姓名
+        if self.is_frozen():
+            return self._save_snapshot([json.loads(self.serialize(rank)) for rank in self.get_frozen_rank()],
+                                       frozen=True)
+        self.ensure_built()
+        pipe = cache.pipeline()
+        pipe.zrevrange(self.zset_key, 0, -1)
+        pipe.hgetall(self.row_key)
+        user_ids, rows = pipe.execute()
+        if self.is_frozen():
+            # 读取排名的时候已经封榜，读到的可能有封榜之后的提交，改成生成封榜的快照
+            return self.publish()
+        self._save_snapshot([json.loads(rows[user_id].decode("utf-8")) for user_id in user_ids if user_id in rows],
+                            frozen=False)
+
+    def _save_snapshot(self, results, frozen):
+        for row in results:
+            row["user"]["real_name"] = None
+        data = json.dumps(results).encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(data + str(int(frozen)).encode("utf-8")).hexdigest()
+        pipe = cache.pipeline()
+        pipe.delete(self.snapshot_key)
+        pipe.hmset(self.snapshot_key, {"etag": etag, "time": time.time(), "frozen": int(frozen),
+                                       "rows": gzip.compress(data)})
+        pipe.expire(self.snapshot_key, SCOREBOARD_TTL)
+        pipe.execute()
+
+    def _snapshot_expired(self, etag, published_time, frozen):
+        if etag is None:
+            return True
+        if self.is_frozen():
+            # 封榜期间只使用封榜的时候生成的快照
+            return frozen != b"1"
+        return frozen == b"1" or time.time() - float(published_time) > SNAPSHOT_INTERVAL
+
+    def snapshot_page(self, offset, limit):
+        """
+        普通用户看到的一页排名
+        :return: (etag, gzip压缩的完整响应{"error": None, "data": {"results": ..., "total": ..., "frozen": ...}})
+        """
+        page_field = f"page:{offset}:{limit}"
+        fields = ["etag", "time", "frozen", page_field]
+        etag, published_time, frozen, page = cache.hmget(self.snapshot_key, fields)
+        if self._snapshot_expired(etag, published_time, frozen):
+            if self.is_frozen():
+                self._publish_frozen()
+            # 同时只有一个请求重新生成快照，其他的请求先使用旧的快照
+            elif etag is None or cache.set(self.snapshot_lock_key, 1, timeout=SNAPSHOT_INTERVAL, nx=True):
+                self.publish()
+            etag, published_time, frozen, page = cache.hmget(self.snapshot_key, fields)
+        if page is None:
+            rows = json.loads(gzip.decompress(cache.hget(self.snapshot_key, "rows")).decode("utf-8"))
+            data = {"error": None,
+                    "data": {"results": rows[offset:offset + limit], "total": len(rows), "frozen": frozen == b"1"}}
+            page = gzip.compress(json.dumps(data).encode("utf-8"))
+            if ContestScoreboard._save_page_script is None:
+                ContestScoreboard._save_page_script = cache.register_script(SAVE_PAGE_SCRIPT)
+            ContestScoreboard._save_page_script(keys=[self.snapshot_key], args=[etag, page_field, page])
+        return etag.decode("utf-8"), page
+
+    def _publish_frozen(self):
+        # 封榜之后第一次读取排名（或者封榜的快照丢失了）的时候生成封榜的快照，只有拿到锁的请求生成，
+        # 其他请求不能使用封榜之前的快照，等待生成完成，等不到的话自己生成，内容是一样的
+        if cache.set(self.freeze_lock_key, 1, timeout=FREEZE_LOCK_TIMEOUT, nx=True):
+            try:
+                self.publish()
+            finally:
+                cache.delete(self.freeze_lock_key)
+            return
+        deadline = time.time() + REBUILD_WAIT
+        while time.time() < deadline:
+            if cache.hget(self.snapshot_key, "frozen") == b"1":
+                return
+            time.sleep(0.1)
+        self.publish()
+
+
+class ScoreboardReader(object):
+    # 支持切片和count()，可以直接传给APIView.paginate_data分页，每一页只读取redis里面这一页的数据
+    def __init__(self, scoreboard, is_contest_admin=False):
+        self.scoreboard = scoreboard
+        self.is_contest_admin = is_contest_admin
+
+    def count(self):
+        return cache.zcard(self.scoreboard.zset_key)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError("ScoreboardReader only supports slicing without step")
+        start = item.start or 0
+        stop = item.stop if item.stop is not None else 0
+        if stop <= start:
+            return []
+        user_ids = cache.zrevrange(self.scoreboard.zset_key, start, stop - 1)
+        if not user_ids:
+            return []
+        rows = []
+        for row in cache.hmget(self.scoreboard.row_key, user_ids):
+            # 读取的过程中排名被重新加载，可能有一行已经不存在了
+            if row is None:
+                continue
+            row = json.loads(row.decode("utf-8"))
+            if not self.is_contest_admin:
+                row["user"]["real_name"] = None
+            rows.append(row)
+        return rows
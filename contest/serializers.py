@@ -18,6 +18,7 @@ class CreateContestSerializer(serializers.Serializer):
     password = serializers.CharField(allow_blank=True, max_length=32)
     visible = serializers.BooleanField()
     real_time_rank = serializers.BooleanField()
+    rank_freeze_minutes = serializers.IntegerField(min_value=0, required=False, default=0)
     allowed_ip_ranges = serializers.ListField(child=serializers.CharField(max_length=32), allow_empty=True)
 
 
@@ -31,6 +32,7 @@ class EditContestSerializer(serializers.Serializer):
     password = serializers.CharField(allow_blank=True, allow_null=True, max_length=32)
     visible = serializers.BooleanField()
     real_time_rank = serializers.BooleanField()
+    rank_freeze_minutes = serializers.IntegerField(min_value=0, required=False, default=0)
     allowed_ip_ranges = serializers.ListField(child=serializers.CharField(max_length=32))
 
 
@@ -89,7 +91,8 @@ class ACMContestRankSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ACMContestRank
-        fields = "__all__"
+        # version只是redis里面排名这一行的版本
+        exclude = ("version",)
 
     def __init__(self, *args, **kwargs):
         self.is_contest_admin = kwargs.pop("is_contest_admin", False)
@@ -105,7 +108,7 @@ class OIContestRankSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = OIContestRank
-        fields = "__all__"
+        exclude = ("version",)
 
     def __init__(self, *args, **kwargs):
         self.is_contest_admin = kwargs.pop("is_contest_admin", False)
@@ -3,13 +3,21 @@
 
 from django.test import TestCase
 import copy
+import gzip
+import json
 from datetime import datetime, timedelta
 
 from django.utils import timezone
 
 from myutils.api.tests import APITestCase
+from myutils.cache import cache
 
-from .models import ContestAnnouncement, ContestRuleType, Contest
+from problem.models import Problem
+from submission.models import Submission
+from submission.tests import DEFAULT_PROBLEM_DATA, DEFAULT_SUBMISSION_DATA
+
+from .models import ContestAnnouncement, ContestRuleType, Contest, ACMContestRank
+from .scoreboard import ContestScoreboard
 
 
 # 注意，还有两个ACMContestHelper和DownloadContestSubmissions 这两个类还没测试，先放下
@@ -194,5 +202,143 @@ class ContestRankAPITest(APITestCase):
     def get_contest_rank(self):
         # 获得acm比赛的排名，使用的是get方法
         resp = self.client.get(self.url + "?contest_id=" + self.acm_contest.id)
-        self.assertSuccess(resp)
-
+        self.assertIsNone(json.loads(resp.content.decode("utf-8"))["error"])
+
+    def test_get_contest_rank_gzip(self):
+        # 客户端支持gzip的时候直接返回压缩好的快照，否则返回解压之后的内容
+        session = self.client.session
+        session["accessible_contests"] = [self.acm_contest.id]
+        session.save()
+        url = f"{self.url}?contest_id={self.acm_contest.id}"
+        resp = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(resp["Content-Encoding"], "gzip")
+        data = json.loads(gzip.decompress(resp.content).decode("utf-8"))
+        resp = self.client.get(url)
+        self.assertEqual(json.loads(resp.content.decode("utf-8")), data)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=resp["ETag"]).status_code, 304)
+
+    def test_download_rank_csv(self):
+        # 流式导出csv，第一行是表头
+        resp = self.client.get(f"{self.url}?contest_id={self.acm_contest.id}&download_csv=1&format=csv")
+        content = b"".join(resp.streaming_content).decode("utf-8-sig")
+        self.assertEqual(content.splitlines()[0], "User ID,Username,Real Name,AC,Total Submission,Total Time")
+
+
+class ContestScoreboardTest(APITestCase):
+    # 增量维护的比赛排名测试
+    def setUp(self):
+        admin = self.create_admin(login=False)
+        self.contest = Contest.objects.create(created_by=admin, **DEFAULT_CONTEST_DATA)
+        self.scoreboard = ContestScoreboard(self.contest)
+        self.user1 = self.create_user("test1", "test123", login=False)
+        self.user2 = self.create_user("test2", "test123", login=False)
+        # 管理员不参加排名
+        ACMContestRank.objects.create(user=admin, contest=self.contest, accepted_number=10)
+        ACMContestRank.objects.create(user=self.user1, contest=self.contest, accepted_number=1, total_time=100)
+        ACMContestRank.objects.create(user=self.user2, contest=self.contest, accepted_number=1, total_time=50)
+        self.scoreboard.rebuild()
+        self.scoreboard.publish()
+
+    def test_rank_order(self):
+        reader = self.scoreboard.reader()
+        self.assertEqual(reader.count(), 2)
+        self.assertEqual([row["user"]["username"] for row in reader[0:10]], ["test2", "test1"])
+
+    def test_update_rank(self):
+        rank = ACMContestRank.objects.get(user=self.user1, contest=self.contest)
+        rank.accepted_number = 2
+        rank.total_time = 200
+        rank.save()
+        self.scoreboard.update(rank)
+        rows = self.scoreboard.reader()[0:10]
+        self.assertEqual([row["user"]["username"] for row in rows], ["test1", "test2"])
+        self.assertEqual(rows[0]["accepted_number"], 2)
+        self.assertIsNone(rows[0]["user"]["real_name"])
+
+    def _submit(self, user, problem, minutes, result=0):
+        # 比赛开始之后minutes分钟的提交
+        submission = Submission.objects.create(**dict(DEFAULT_SUBMISSION_DATA, problem_id=problem.id, user_id=user.id,
+                                                      username=user.username, contest=self.contest, result=result))
+        create_time = self.contest.start_time + timedelta(minutes=minutes)
+        Submission.objects.filter(id=submission.id).update(create_time=create_time)
+
+    def _freeze(self):
+        # 比赛两个小时之前开始，还有一个小时结束，封榜九十分钟，也就是半个小时之前封榜
+        # test2在第10分钟AC，test1在第20分钟AC，封榜之后test1又AC了一道题
+        self.contest.start_time = timezone.now() - timedelta(hours=2)
+        self.contest.end_time = timezone.now() + timedelta(hours=1)
+        self.contest.rank_freeze_minutes = 90
+        self.contest.save()
+        problem_data = copy.deepcopy(DEFAULT_PROBLEM_DATA)
+        problem_data.pop("tags")
+        problems = [Problem.objects.create(**dict(problem_data, _id=_id, contest=self.contest,
+                                                  created_by=self.contest.created_by)) for _id in ("A", "B")]
+        self._submit(self.user2, problems[0], 10)
+        self._submit(self.user1, problems[0], 15, result=-1)
+        self._submit(self.user1, problems[0], 20)
+        self._submit(self.user1, problems[1], 100)
+        rank = ACMContestRank.objects.get(user=self.user1, contest=self.contest)
+        rank.accepted_number = 2
+        rank.version = 1
+        rank.save()
+        return rank
+
+    def _frozen_results(self, page):
+        data = json.loads(gzip.decompress(page).decode("utf-8"))["data"]
+        self.assertTrue(data["frozen"])
+        return data["results"]
+
+    def test_frozen_snapshot(self):
+        # 封榜之后普通用户看到的是只根据封榜之前的提交计算的排名，封榜之后的更新先到达也不会被看到
+        self.scoreboard.update(self._freeze())
+        etag, page = self.scoreboard.snapshot_page(0, 10)
+        results = self._frozen_results(page)
+        self.assertEqual([row["user"]["username"] for row in results], ["test2", "test1"])
+        self.assertEqual((results[1]["accepted_number"], results[1]["submission_number"]), (1, 2))
+        self.assertEqual(results[1]["total_time"], 40 * 60)
+        self.assertTrue(results[0]["submission_info"][str(Problem.objects.get(_id="A").id)]["is_first_ac"])
+        self.assertIsNone(results[1]["user"]["real_name"])
+        # 封榜期间再次更新，快照不变
+        self.scoreboard.update(ACMContestRank.objects.get(user=self.user1, contest=self.contest))
+        self.assertEqual(self.scoreboard.snapshot_page(0, 10)[0], etag)
+        # 比赛管理员看到的实时排名已经变化
+        self.assertEqual(self.scoreboard.reader()[0:1][0]["user"]["username"], "test1")
+
+    def test_frozen_snapshot_lost(self):
+        # 封榜的快照丢失之后重新生成的还是封榜时候的排名，不会使用实时的排名
+        self.scoreboard.update(self._freeze())
+        etag, _ = self.scoreboard.snapshot_page(0, 10)
+        cache.execute_command("DEL", self.scoreboard.snapshot_key)
+        new_etag, page = self.scoreboard.snapshot_page(0, 10)
+        self.assertEqual(new_etag, etag)
+        self.assertEqual([row["user"]["username"] for row in self._frozen_results(page)], ["test2", "test1"])
+
+    def test_stale_update_ignored(self):
+        # 事务提交之后的更新可能乱序到达，版本旧的更新不会覆盖新的数据
+        rank = ACMContestRank.objects.get(user=self.user1, contest=self.contest)
+        stale = ACMContestRank.objects.get(id=rank.id)
+        rank.accepted_number = 2
+        rank.version = 1
+        rank.save()
+        self.scoreboard.update(rank)
+        self.scoreboard.update(stale)
+        self.assertEqual(self.scoreboard.reader()[0:1][0]["accepted_number"], 2)
+
+    def test_rebuild_in_progress(self):
+        # 正在加载的时候不会重复加载，加载期间的更新在加载完成之后保留
+        cache.execute_command("SET", self.scoreboard.rebuild_lock_key, "other", "EX", 60)
+        self.assertFalse(self.scoreboard.rebuild())
+        cache.execute_command("DEL", self.scoreboard.rebuild_lock_key)
+        self.assertTrue(self.scoreboard.rebuild())
+
+    def test_not_real_time_rank(self):
+        # 不实时显示排名的比赛，比赛期间普通用户看到的排名不变
+        self.contest.real_time_rank = False
+        self.contest.save()
+        self.assertTrue(self.scoreboard.is_frozen())
+        etag, _ = self.scoreboard.snapshot_page(0, 10)
+        rank = ACMContestRank.objects.get(user=self.user1, contest=self.contest)
+        rank.accepted_number = 2
+        rank.save()
+        self.scoreboard.update(rank)
+        self.assertEqual(self.scoreboard.snapshot_page(0, 10)[0], etag)
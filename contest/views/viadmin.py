@@ -1,24 +1,20 @@
 #!/usr/bin/env python
 # -*-encoding:UTF-8-*-
 
-import copy
-import os
 import zipfile
 from ipaddress import ip_network
 
 import dateutil.parser
-from django.http import FileResponse
+from django.db import transaction
+from django.http import StreamingHttpResponse
 
 from account.decorators import check_contest_permission, ensure_created_by
-from account.models import User
+from account.models import AdminType, User
 from submission.models import Submission, JudgeStatus
 from myutils.api import APIView, validate_serializer
-from myutils.cache import cache
-from myutils.constants import CacheKey
-from myutils.shortcuts import rand_str
-from myutils.tasks import delete_files
 # 导入实体表
 from ..models import Contest, ContestAnnouncement, ACMContestRank
+from ..scoreboard import ContestScoreboard
 from ..serializers import (ContestAnnouncementSerializer, ContestAdminSerializer,
                            CreateContestSerializer, CreateContestAnnouncementSerializer,
                            EditContestSerializer, EditContestAnnouncementSerializer,
@@ -77,11 +73,6 @@ class ContestAPI(APIView):
             except ValueError:
                 return self.error(f"{ip_range} is not a valid cidr network")
 
-        # 不需要实时比赛排名就删除缓存关键字
-        if not contest.real_time_rank and data.get("real_time_rank"):
-            cache_key = f"{CacheKey.contest_rank_cache}:{contest.id}"
-            cache.delete(cache_key)
-
         # 对于每一个在data里面的键值对，将对应的属性更新到contest里面去，保存到数据库
         for k, v in data.items():
             setattr(contest, k, v)
@@ -211,44 +202,64 @@ class ACMContestHelper(APIView):
     @validate_serializer(ACMContestHelperSerializer)
     def put(self, request):
         data = request.data
-        try:
-            rank = ACMContestRank.objects.get(pk=data["rank_id"])
-        except ACMContestRank.DoesNotExist:
-            return self.error("Rank id does not exist")
-        problem_rank_status = rank.submission_info.get(data["problem_id"])
-        if not problem_rank_status:
-            return self.error("Problem id does not exist")
-        problem_rank_status["checked"] = data["checked"]
-        rank.save(update_fields=("submission_info",))
+        with transaction.atomic():
+            try:
+                rank = ACMContestRank.objects.select_for_update().get(pk=data["rank_id"], contest=self.contest)
+            except ACMContestRank.DoesNotExist:
+                return self.error("Rank id does not exist")
+            problem_rank_status = rank.submission_info.get(data["problem_id"])
+            if not problem_rank_status:
+                return self.error("Problem id does not exist")
+            problem_rank_status["checked"] = data["checked"]
+            rank.version += 1
+            rank.save(update_fields=("submission_info", "version"))
+            transaction.on_commit(lambda: ContestScoreboard(self.contest).update(rank))
         return self.success()
 
 
+class ZipStream(object):
+    # 只能追加写入的缓冲区，zipfile写入不能seek的文件的时候使用data descriptor，不需要回头修改文件头，
+    # 每写完一个文件就把缓冲区里面的数据取出来返回给客户端
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
 class DownloadContestSubmissions(APIView):
-    def _dump_submissions(self, contest, exclude_admin=True):
-        problem_ids = contest.problem_set.all().values_list("id", "_id")
-        id2display_id = {k[0]: k[1] for k in problem_ids}
-        ac_map = {k[0]: False for k in problem_ids}
-        submissions = Submission.objects.filter(contest=contest, result=JudgeStatus.ACCEPTED).order_by("-create_time")
-        user_ids = submissions.values_list("user_id", flat=True)
-        users = User.objects.filter(id__in=user_ids)
-        path = f"/tmp/{rand_str()}.zip"
-        with zipfile.ZipFile(path, "w") as zip_file:
-            for user in users:
-                if user.is_admin_role() and exclude_admin:
-                    continue
-                user_ac_map = copy.deepcopy(ac_map)
-                user_submissions = submissions.filter(user_id=user.id)
-                for submission in user_submissions:
-                    problem_id = submission.problem_id
-                    if user_ac_map[problem_id]:
-                        continue
-                    file_name = f"{user.username}_{id2display_id[submission.problem_id]}.txt"
-                    compression = zipfile.ZIP_DEFLATED
-                    zip_file.writestr(zinfo_or_arcname=f"{file_name}",
-                                      data=submission.code,
-                                      compress_type=compression)
-                    user_ac_map[problem_id] = True
-        return path
+    def _dump_submissions(self, contest, exclude_admin=True, user_dir=False):
+        # 每个用户每道题最后一次AC的代码，一次查询按照(user_id, problem_id)去重（postgres的DISTINCT ON），
+        # iterator()使用服务端游标，边读取边压缩边返回，内存里面只有当前的一份代码
+        id2display_id = dict(contest.problem_set.all().values_list("id", "_id"))
+        submissions = Submission.objects.filter(contest=contest, result=JudgeStatus.ACCEPTED)
+        if exclude_admin:
+            admin_ids = User.objects.filter(admin_type__in=[AdminType.ADMIN, AdminType.SUPER_ADMIN]).values("id")
+            submissions = submissions.exclude(user_id__in=admin_ids)
+        submissions = submissions.order_by("user_id", "problem_id", "-create_time") \
+            .distinct("user_id", "problem_id").values_list("username", "problem_id", "code")
+
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for username, problem_id, code in submissions.iterator():
+                display_id = id2display_id.get(problem_id, problem_id)
+                if user_dir:
+                    file_name = f"{username}/{display_id}.txt"
+                else:
+                    file_name = f"{username}_{display_id}.txt"
+                zip_file.writestr(file_name, code)
+                yield stream.pop()
+        # 关闭之后写入的中央目录
+        yield stream.pop()
 
     def get(self, request):
         contest_id = request.GET.get("contest_id")
@@ -261,9 +272,8 @@ class DownloadContestSubmissions(APIView):
             return self.error("Contest does not exist")
 
         exclude_admin = request.GET.get("exclude_admin") == "1"
-        zip_path = self._dump_submissions(contest, exclude_admin)
-        delete_files.apply_async((zip_path,), countdown=300)
-        resp = FileResponse(open(zip_path, "rb"))
-        resp["Content-Type"] = "application/zip"
-        resp["Content-Disposition"] = f"attachment;filename={os.path.basename(zip_path)}"
+        user_dir = request.GET.get("user_dir") == "1"
+        resp = StreamingHttpResponse(self._dump_submissions(contest, exclude_admin, user_dir),
+                                     content_type="application/zip")
+        resp["Content-Disposition"] = f"attachment;filename=contest-{contest.id}-submissions.zip"
         return resp
@@ -1,26 +1,27 @@
 #!/usr/bin/env python
 # -*-encoding:UTF-8-*-
 
-import io
+import csv
+import gzip
+import itertools
+import tempfile
 
 import xlsxwriter   # 表格
 
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.timezone import now
-from django.core.cache import cache
 
 from problem.models import Problem
-from myutils.api import APIView, validate_serializer
-from myutils.constants import CacheKey
+from myutils.api import APIView, ContentType, validate_serializer
 from myutils.shortcuts import datetime2str
-from account.models import AdminType
 from account.decorators import login_required, check_contest_permission
 
 from myutils.constants import ContestRuleType, ContestStatus
-from ..models import ContestAnnouncement, Contest, OIContestRank, ACMContestRank
+from ..models import ContestAnnouncement, Contest
+from ..scoreboard import ContestScoreboard
 from ..serializers import ContestAnnouncementSerializer
 from ..serializers import ContestSerializer, ContestPasswordVerifySerializer
-from ..serializers import OIContestRankSerializer, ACMContestRankSerializer
 
 
 class ContestAnnouncementListAPI(APIView):
@@ -112,24 +113,68 @@ class ContestAccessAPI(APIView):
 class ContestRankAPI(APIView):
     # 获得比赛的排名，使用的是get方法
     def get_rank(self):
-        # 根据情况获得排名
+        # 根据情况获得排名，数据库里面的完整排名，用于下载
+        qs = ContestScoreboard(self.contest).get_rank()
         if self.contest.rule_type == ContestRuleType.ACM:
-            return ACMContestRank.objects.filter(contest=self.contest,
-                                                 user__admin_type=AdminType.REGULAR_USER,
-                                                 user__is_disabled=False).\
-                select_related("user").order_by("-accepted_number", "total_time")
+            return qs.order_by("-accepted_number", "total_time")
+        return qs.order_by("-total_score")
+
+    def _export_rows(self, is_contest_admin):
+        # 导出的排名的每一行，第一行是表头，用服务器端游标逐行读取数据库，内存占用和参赛人数无关
+        problems = Problem.objects.filter(contest=self.contest, visible=True).order_by("_id").values_list("id", "title")
+        # 题目id -> 第几个题目的列，不用每个单元格都在列表里面查找
+        problem_columns = {}
+        problem_titles = []
+        for index, (problem_id, title) in enumerate(problems):
+            problem_columns[str(problem_id)] = index
+            problem_titles.append(title)
+
+        is_acm = self.contest.rule_type == ContestRuleType.ACM
+        if is_acm:
+            yield ["User ID", "Username", "Real Name", "AC", "Total Submission", "Total Time"] + problem_titles
+            fields = ("accepted_number", "submission_number", "total_time")
         else:
-            return OIContestRank.objects.filter(contest=self.contest,
-                                                user__admin_type=AdminType.REGULAR_USER,
-                                                user__is_disabled=False). \
-                select_related("user").order_by("-total_score")
-
-    def column_string(self, n):
-        string = ""
-        while n > 0:
-            n, remainder = divmod(n - 1, 26)
-            string = chr(65 + remainder) + string
-        return string
+            yield ["User ID", "Username", "Real Name", "Total Score"] + problem_titles
+            fields = ("total_score", )
+        ranks = self.get_rank().values_list("user_id", "user__username", "user__userprofile__real_name",
+                                            "submission_info", *fields)
+        for user_id, username, real_name, submission_info, *values in ranks.iterator():
+            problem_cells = [""] * len(problem_titles)
+            for problem_id, info in submission_info.items():
+                column = problem_columns.get(problem_id)
+                # 已经隐藏的题目不导出
+                if column is not None:
+                    problem_cells[column] = str(info["is_ac"] if is_acm else info)
+            yield [str(user_id), username, (real_name if is_contest_admin else None) or ""] + \
+                [str(value) for value in values] + problem_cells
+
+    def _export_csv(self, rows):
+        # 一边查询一边生成csv返回，不在内存里面保存整个文件
+        class Echo(object):
+            def write(self, value):
+                return value
+
+        writer = csv.writer(Echo())
+        # 带BOM，Excel打开的时候中文不会乱码
+        content = itertools.chain(["\ufeff"], (writer.writerow(row) for row in rows))
+        response = StreamingHttpResponse(content, content_type="text/csv; charset=utf-8")
+        response["Content-Disposition"] = f"attachment; filename=contest-{self.contest.id}-rank.csv"
+        return response
+
+    def _export_xlsx(self, rows):
+        # xlsxwriter的constant_memory模式每写完一行就写到临时文件，内存里面只有当前这一行，
+        # 生成的文件也放在临时文件里面，FileResponse分块返回，返回完成之后自动删除
+        f = tempfile.TemporaryFile()
+        workbook = xlsxwriter.Workbook(f, {"constant_memory": True})
+        worksheet = workbook.add_worksheet()
+        for index, row in enumerate(rows):
+            worksheet.write_row(index, 0, row)
+        # 关闭工作本，返回响应
+        workbook.close()
+        f.seek(0)
+        response = FileResponse(f, content_type="application/xlsx")
+        response["Content-Disposition"] = f"attachment; filename=content-{self.contest.id}-rank.xlsx"
+        return response
 
     # 检查申请获取比赛排名的用户是否有权限先
     @check_contest_permission(check_type="ranks")
@@ -138,76 +183,36 @@ class ContestRankAPI(APIView):
         download_csv = request.GET.get("download_csv")
         force_refresh = request.GET.get("force_refresh")
         is_contest_admin = request.user.is_authenticated() and request.user.is_contest_admin(self.contest)
-        # 根据比赛类型选择序列化器
-        if self.contest.rule_type == ContestRuleType.OI:
-            serializer = OIContestRankSerializer
-        else:
-            serializer = ACMContestRankSerializer
-
+        # 排名在redis里面增量维护，见contest/scoreboard.py
+        scoreboard = ContestScoreboard(self.contest)
         if force_refresh == "1" and is_contest_admin:
-            # 强行更新True和是超级用户时，返回排名，qs是question status
-            qs = self.get_rank()
-        else:
-            # 否则使用缓存即机制，将数据输出到缓存里面
-            cache_key = f"{CacheKey.contest_rank_cache}:{self.contest.id}"
-            qs = cache.get(cache_key)
-            if not qs:
-                qs = self.get_rank()
-                cache.set(cache_key, qs)
-
-        # 请求数据有下载csv表格的请求
+            # 强行更新True和是比赛管理员时，从数据库重新加载排名
+            scoreboard.rebuild()
+
+        # 请求数据有下载csv表格的请求，下载的是数据库里面的实时排名，封榜期间只有比赛管理员可以下载
         if download_csv:
-            data = serializer(qs, many=True, is_contest_admin=is_contest_admin).data
-            # 查找出比赛问题的答题状态
-            contest_problems = Problem.objects.filter(contest=self.contest, visible=True).order_by("_id")
-            problem_ids = [item.id for item in contest_problems]
-
-            # 使用io比特流
-            f = io.BytesIO()
-            workbook = xlsxwriter.Workbook(f)
-            worksheet = workbook.add_worksheet()
-            worksheet.write("A1", "User ID")
-            worksheet.write("B1", "Username")
-            worksheet.write("C1", "Real Name")
-            if self.contest.rule_type == ContestRuleType.OI:
-                # 比赛类型为OI
-                worksheet.write("D1", "Total Score")
-                for item in range(contest_problems.count()):
-                    worksheet.write(self.column_string(5 + item) + "1", f"{contest_problems[item].title}")
-                for index, item in enumerate(data):
-                    worksheet.write_string(index + 1, 0, str(item["user"]["id"]))
-                    worksheet.write_string(index + 1, 1, item["user"]["username"])
-                    worksheet.write_string(index + 1, 2, item["user"]["real_name"] or "")
-                    worksheet.write_string(index + 1, 3, str(item["total_score"]))
-                    for k, v in item["submission_info"].items():
-                        worksheet.write_string(index + 1, 4 + problem_ids.index(int(k)), str(v))
-            else:
-                # 比赛类型为ACM
-                worksheet.write("D1", "AC")
-                worksheet.write("E1", "Total Submission")
-                worksheet.write("F1", "Total Time")
-                for item in range(contest_problems.count()):
-                    worksheet.write(self.column_string(7 + item) + "1", f"{contest_problems[item].title}")
-
-                for index, item in enumerate(data):
-                    worksheet.write_string(index + 1, 0, str(item["user"]["id"]))
-                    worksheet.write_string(index + 1, 1, item["user"]["username"])
-                    worksheet.write_string(index + 1, 2, item["user"]["real_name"] or "")
-                    worksheet.write_string(index + 1, 3, str(item["accepted_number"]))
-                    worksheet.write_string(index + 1, 4, str(item["submission_number"]))
-                    worksheet.write_string(index + 1, 5, str(item["total_time"]))
-                    for k, v in item["submission_info"].items():
-                        worksheet.write_string(index + 1, 6 + problem_ids.index(int(k)), str(v["is_ac"]))
-
-            # 关闭工作本，返回响应
-            workbook.close()
-            f.seek(0)
-            response = HttpResponse(f.read())
-            response["Content-Disposition"] = f"attachment; filename=content-{self.contest.id}-rank.xlsx"
-            response["Content-Type"] = "application/xlsx"
-            return response
-
-        # 分页显示问题状态question status
-        page_qs = self.paginate_data(request, qs)
-        page_qs["results"] = serializer(page_qs["results"], many=True, is_contest_admin=is_contest_admin).data
-        return self.success(page_qs)
+            if not is_contest_admin and scoreboard.is_frozen():
+                return self.error("Rank is frozen")
+            rows = self._export_rows(is_contest_admin)
+            if request.GET.get("format") == "csv":
+                return self._export_csv(rows)
+            return self._export_xlsx(rows)
+
+        if is_contest_admin:
+            # 比赛管理员看到的是实时的排名，每一页只从redis读取这一页的数据，已经是序列化之后的数据
+            return self.success(self.paginate_data(request, scoreboard.reader(is_contest_admin)))
+
+        # 普通用户看到的是排名的快照，封榜期间停在封榜的时候，每一页都是压缩好的完整响应
+        offset, limit = self.get_offset_limit(request)
+        etag, page = scoreboard.snapshot_page(offset, limit)
+        if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+            response = HttpResponseNotModified()
+        elif "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+            response = HttpResponse(page, content_type=ContentType.json_response)
+            response["Content-Encoding"] = "gzip"
+        else:
+            body = gzip.decompress(page)
+            response = HttpResponse(body, content_type=ContentType.json_response)
+        response["ETag"] = etag
+        patch_vary_headers(response, ("Accept-Encoding", "Cookie"))
+        return response
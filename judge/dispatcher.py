@@ -5,78 +5,256 @@
 import hashlib   # 摘要算法
 import json
 import logging
-from urllib.parse import urljoin
+import time
+from urllib.parse import urljoin, urlsplit
 
 import requests
+from django.conf import settings
 from django.db import transaction
 from django.db.models import F  # 条件查询
+from requests.adapters import HTTPAdapter
 
-from account.models import User
-from conf.models import JudgeServer
+from account.models import User, UserProfile
 from contest.models import ContestRuleType, ACMContestRank, OIContestRank, ContestStatus
+from contest.scoreboard import ContestScoreboard
 from options.options import SysOptions
-from problem.models import Problem, ProblemRuleType
+from problem.models import Problem, ProblemRuleType, UserProblemStatus
 
 from problem.utils import parse_problem_template   #noqa
 
 from submission.models import JudgeStatus, Submission
+from judge.scheduler import judge_server_scheduler
+from judge.statistics import add_problem_statistic_event
 from myutils.cache import cache
-from myutils.constants import CacheKey
+from myutils.constants import CacheKey, JudgeLane
+from myutils.shortcuts import rand_str
 
 logger = logging.getLogger(__name__)
 
+# 保存最近多少个任务的排队时间和评测耗时
+LATENCY_SAMPLES = 1000
+# 和评测机建立连接的超时时间（秒），评测机挂掉的时候尽快换另外一台
+CONNECT_TIMEOUT = 3
+# 不需要等待评判的请求（提交异步任务、编译特殊评判）的读取超时时间（秒）
+REQUEST_TIMEOUT = 60
+# 连接评测机失败的时候，最多换几台评测机重试
+CONNECT_RETRIES = 2
+# 批量评判没有空闲的评测机槽位的时候，过多久（秒）再试
+BATCH_RETRY_DELAY = 5
+# 比赛题目第一个AC的用户在redis里面保存多久（秒）
+FIRST_AC_TTL = 30 * 24 * 60 * 60
+# 批量评判还没有开始评判的提交最多保存多久（秒）
+JUDGE_BATCH_TTL = 7 * 24 * 60 * 60
+# 每台评测机的评测耗时直方图的分桶上界（秒），超过最后一个的算在+Inf里面
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120)
+
+# 每台评测机一个http会话，保持长连接，同一个celery进程里面的评判请求复用连接，不用每次都重新建立tcp连接
+_sessions = {}
+
+
+def judge_server_session(url):
+    base_url = "{0.scheme}://{0.netloc}".format(urlsplit(url))
+    session = _sessions.get(base_url)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sessions[base_url] = session
+    return session
+
+
+def _lane_key(key, lane):
+    return f"{key}:{lane}"
+
+
+def _add_sample(key, value):
+    cache.lpush(key, value)
+    cache.ltrim(key, 0, LATENCY_SAMPLES - 1)
+
+
+def _percentiles(key):
+    # 最近的样本的50、90、99百分位数
+    samples = sorted(float(item) for item in cache.lrange(key, 0, -1))
+    if not samples:
+        return {"p50": 0, "p90": 0, "p99": 0, "count": 0}
+    return {"p50": samples[int(len(samples) * 0.5)],
+            "p90": samples[int(len(samples) * 0.9)],
+            "p99": samples[int(len(samples) * 0.99)],
+            "count": len(samples)}
+
+
+def lane_reserve(lane):
+    # 比赛以外的评测至少要给比赛留下多少个空闲的评测机槽位
+    if lane == JudgeLane.CONTEST:
+        return 0
+    return SysOptions.judge_lanes.get("contest_reserved_slots", 0)
+
+
+def record_judge_latency(lane, latency):
+    # 记录从提交进入评测（或者进入等待队列）到评测完成的耗时
+    _add_sample(_lane_key(CacheKey.judge_latency, lane), latency)
+
+
+# 没有空闲的评测机的时候，提交放到对应优先级的等待队列，最新的在左边，最早的在右边
+def enqueue_pending_task(submission_id, problem_id, lane, enqueue_time=None):
+    data = {"submission_id": submission_id, "problem_id": problem_id, "lane": lane,
+            "enqueue_time": enqueue_time or time.time()}
+    cache.lpush(_lane_key(CacheKey.waiting_queue, lane), json.dumps(data))
+
 
 # 继续处理在队列中的任务
 def process_pending_task():
-    # 如果llen："Return the length of the list ``name``"返回的waiting_queue名字长度不空，
-    # 队列中还有任务，导入评判任务judge_task，加载在队列里面等待的任务到异步队列
-    if cache.llen(CacheKey.waiting_queue):
-        # 防止循环引入
-        from judge.tasks import judge_task
-        data = json.loads(cache.rpop(CacheKey.waiting_queue).decode("utf-8"))
-        judge_task.delay(**data)
+    # 有多少个空闲的评测机槽位就从等待队列里面取出多少个任务，取出的时候每个任务已经占好了评测机的槽位，
+    # 评测任务直接使用这个评测机，不会因为和新的提交抢槽位而重新排队
+    # 多个优先级的等待队列按照权重轮流取出任务，比赛的权重最高，而且有预留的槽位
+    # 评测机槽位释放、评测机心跳的时候都会调用，多个进程同时调用也不会取出比空闲槽位更多的任务
+    queues = [_lane_key(CacheKey.waiting_queue, lane) for lane in JudgeLane.choices()]
+    pipe = cache.pipeline()
+    for queue in queues:
+        pipe.llen(queue)
+    if not any(pipe.execute()):
+        return
+    # 防止循环引入
+    from judge.tasks import judge_task
+    weights = SysOptions.judge_lanes.get("weights", {})
+    queues = [(queue, weights.get(lane, 1), lane_reserve(lane)) for queue, lane in zip(queues, JudgeLane.choices())]
+    now = time.time()
+    for task, server, _ in judge_server_scheduler.acquire_queued(queues):
+        data = json.loads(task.decode("utf-8"))
+        # 记录排队时间，用于后台显示
+        _add_sample(_lane_key(CacheKey.waiting_queue_wait_time, data["lane"]), now - data["enqueue_time"])
+        judge_task.delay(judge_server=server._asdict(), **data)
+
+
+def record_judge_server_latency(judge_server_id, latency):
+    # 按照LATENCY_BUCKETS分桶记录评测机的评测耗时，同时记录总次数和总耗时
+    key = f"{CacheKey.judge_server_latency}:{judge_server_id}"
+    bucket = next((str(item) for item in LATENCY_BUCKETS if latency <= item), "+Inf")
+    pipe = cache.pipeline()
+    pipe.hincrby(key, bucket, 1)
+    pipe.hincrby(key, "count", 1)
+    pipe.hincrbyfloat(key, "sum", latency)
+    pipe.execute()
+
+
+def judge_server_latency_stats(judge_server_ids):
+    # 每台评测机的评测耗时直方图：{评测机id: {"buckets": {分桶上界: 次数}, "count": 总次数, "avg": 平均耗时}}
+    ret = {}
+    for judge_server_id in judge_server_ids:
+        data = {k.decode("utf-8"): v for k, v in
+                cache.hgetall(f"{CacheKey.judge_server_latency}:{judge_server_id}").items()}
+        count = int(data.get("count", 0))
+        ret[judge_server_id] = {
+            "buckets": {bucket: int(data.get(bucket, 0)) for bucket in [str(item) for item in LATENCY_BUCKETS] + ["+Inf"]},
+            "count": count,
+            "avg": float(data.get("sum", 0)) / count if count else 0}
+    return ret
+
+
+def waiting_queue_stats():
+    # 每个优先级的等待队列的长度、最早的任务已经等待的时间，以及最近的排队时间和评测耗时的百分位数
+    ret = {}
+    now = time.time()
+    for lane in JudgeLane.choices():
+        queue = _lane_key(CacheKey.waiting_queue, lane)
+        oldest = cache.lindex(queue, -1)
+        ret[lane] = {"depth": cache.llen(queue),
+                     "oldest_wait": now - json.loads(oldest.decode("utf-8"))["enqueue_time"] if oldest else 0,
+                     "wait": _percentiles(_lane_key(CacheKey.waiting_queue_wait_time, lane)),
+                     "latency": _percentiles(_lane_key(CacheKey.judge_latency, lane))}
+    return ret
 
 
 class DispatcherBase(object):
+    # 轮询异步评判结果的时候，每次请求在评测机上最多等待的秒数
+    job_poll_wait = 10
+
     def __init__(self):
         # judge_server_token默认就是judge_server_token
         self.token = hashlib.sha256(SysOptions.judge_server_token.encode("utf-8")).hexdigest()
 
-    def _request(self, url, data=None):
-        kwargs = {"headers": {"X-Judge-Server-Token": self.token}}
+    def _post(self, url, data=None, timeout=REQUEST_TIMEOUT, **kwargs):
+        # 通过评测机的长连接会话发送请求，timeout是读取超时时间，连接失败、超时的时候抛出requests的异常
+        kwargs["headers"] = {"X-Judge-Server-Token": self.token}
         if data:
             # 设置键值对关键参数kwargs为传入的数据
             kwargs["json"] = data
+        return judge_server_session(url).post(url, timeout=(CONNECT_TIMEOUT, timeout), **kwargs)
+
+    def _request(self, url, data=None, timeout=REQUEST_TIMEOUT):
+        # 请求失败返回None
         try:
             # 在这里通过post的方法请求后端的评测机---------------->>>>>>>>>>>>>>>>>这里是判题入口
-            return requests.post(url, **kwargs).json()
+            return self._post(url, data=data, timeout=timeout).json()
         except Exception as e:
             logger.exception(e)
 
+    def _request_stream(self, url, data=None, timeout=REQUEST_TIMEOUT):
+        # 请求评测机并逐行解析返回的结果（NDJSON），用于批量评判，每评判完一个提交就返回一行
+        # timeout是两行结果之间最多等待的时间，连接失败、超时的时候结束，调用者处理没有返回结果的提交
+        try:
+            with self._post(url, data=data, timeout=timeout, stream=True) as resp:
+                for line in resp.iter_lines():
+                    if line:
+                        yield json.loads(line.decode("utf-8"))
+        except Exception as e:
+            logger.exception(e)
+
+    def _request_job(self, server, data, timeout, on_progress=None):
+        # 异步评判：提交评判任务拿到任务id，然后长轮询任务结果，评测机在评判完成之后马上返回，
+        # 评判过程中不会一直占用评测机处理请求的线程
+        # 传入on_progress的话，每当有新的测试用例评判完成，评测机也马上返回，调用on_progress(已经完成的测试用例结果)
+        # 超过timeout秒还没有评判完成就放弃，返回None
+        # 提交任务的时候连接不上评测机，抛出requests.ConnectionError，任务还没有开始，调用者可以换一台评测机重试
+        try:
+            resp = self._post(urljoin(server.service_url, "/judge_async"), data=data).json()
+        except requests.ConnectionError:
+            raise
+        except Exception as e:
+            logger.exception(e)
+            return None
+        if resp["err"]:
+            return resp
+        deadline = time.time() + timeout
+        job_id = resp["data"]["job_id"]
+        progress_offset = 0
+        while True:
+            if time.time() > deadline:
+                logger.error(f"Judge job {job_id} on {server.service_url} timed out after {timeout} seconds")
+                return None
+            poll_data = {"job_id": job_id, "wait": self.job_poll_wait}
+            if on_progress:
+                poll_data["progress_offset"] = progress_offset
+            resp = self._request(urljoin(server.service_url, "/job_result"), data=poll_data,
+                                 timeout=self.job_poll_wait + CONNECT_TIMEOUT)
+            if not resp:
+                return None
+            if resp["err"]:
+                # 轮询出错（例如评测机重启之后任务不存在了）不是提交的问题，不能当成编译错误，按照系统错误处理
+                logger.error(f"Failed to get judge job {job_id} from {server.service_url}: {resp['data']}")
+                return None
+            if resp["data"]["status"] == "finished":
+                # 任务结果和同步的/judge返回的格式一样
+                return resp["data"]["result"]
+            # 评判还在进行，延长槽位的租约，对账的时候不会被当成泄露的槽位回收
+            judge_server_scheduler.renew(server)
+            progress = resp["data"].get("progress", [])
+            if on_progress and len(progress) > progress_offset:
+                progress_offset = len(progress)
+                on_progress(progress)
+
     @staticmethod
-    def choose_judge_server():
-        # 选择测评服务器
-        with transaction.atomic():
-            # 按照任务数字排列，将能够判题的Server查出来
-            servers = JudgeServer.objects.select_for_update().filter(is_disabled=False).order_by("task_number")
-            # 选出servers中server状态为normal的评测机组成新的servers
-            servers = [s for s in servers if s.status == "normal"]
-            for server in servers:
-                # 根据原来server的任务数设置新的任务数
-                if server.task_number <= server.cpu_core * 2:
-                    server.task_number = F("task_number") + 1
-                    server.save()
-                    return server
+    def choose_judge_server(lane=JudgeLane.PRACTICE):
+        # 选择测评服务器：正在评测的任务数最少、还有空闲槽位、心跳正常的评测机，由redis原子地分配，不需要数据库锁
+        # 比赛以外的评测不能占用为比赛预留的槽位
+        return judge_server_scheduler.acquire(reserve=lane_reserve(lane))
 
     @staticmethod
-    def release_judge_server(judge_server_id):
-        # 释放判题测评机
-        with transaction.atomic():
-            # 使用原子操作, 同时因为use和release中间间隔了判题过程,需要重新查询一下
-            server = JudgeServer.objects.get(id=judge_server_id)
-            # 释放server就将任务数减去1，以便其他的任务被安排上
-            server.task_number = F("task_number") - 1
-            server.save()
+    def release_judge_server(server):
+        # 释放判题测评机的槽位，马上处理等待队列里面的任务
+        judge_server_scheduler.release(server)
+        process_pending_task()
 
 
 class SPJCompiler(DispatcherBase):
@@ -84,9 +262,8 @@ class SPJCompiler(DispatcherBase):
     def __init__(self, spj_code, spj_version, spj_language):
         # 初始化特殊评判编译配置spj_compile_config
         super().__init__()
-        # 根据输入的config，获得里面的config["name"]，从而获得spj_language
-        spj_compile_config = list(filter(lambda config: spj_language == config["name"], SysOptions.spj_languages))[0]["spj"][
-            "compile"]
+        # 根据特殊评判的语言从语言索引里面取出编译配置
+        spj_compile_config = SysOptions.language_registry.spj_config(spj_language)["compile"]
         self.data = {
             "src": spj_code,
             "spj_version": spj_version,
@@ -94,29 +271,34 @@ class SPJCompiler(DispatcherBase):
         }
 
     def compile_spj(self):
-        # 编译特殊评判
-        server = self.choose_judge_server()
+        # 编译特殊评判，管理员在等待结果，和比赛一样不受预留槽位的限制
+        server = self.choose_judge_server(lane=JudgeLane.CONTEST)
         # 如果当前没有可用的Server，返回错误
         if not server:
             return "No available judge_server"
         # 拼接server的url和compile_spj的路径当做请求路径---->发送请求判题
         result = self._request(urljoin(server.service_url, "compile_spj"), data=self.data)
         # 结果返回之后释放server，出现错误err就返回对应的data
-        self.release_judge_server(server.id)
+        self.release_judge_server(server)
+        if not result:
+            return "Failed to connect to judge server"
         if result["err"]:
             return result["data"]
 
 
 class JudgeDispatcher(DispatcherBase):
     # 评测调度者类
-    def __init__(self, submission_id, problem_id):
+    def __init__(self, submission_id, problem_id, lane=None):
         # 初始化sumission、比赛contest_id、last_result
         super().__init__()
         self.submission = Submission.objects.get(id=submission_id)
         self.contest_id = self.submission.contest_id
         # 如果self.submissiom.info(从评测机返回的信息) 不空，那最近一次（上一次）的结果（last_result）也就是self.submission.result，否则是None
         # self.submission.result默认数据是JudgeStatus.PENDING，那么self.last_result在有数据返回的情况下值也是JudgeStatus.PENDING
-        self.last_result = self.submission.result if self.submission.info else None
+        # info里面只有评判进度的话说明上一次评判没有完成，不算有结果
+        # 上一次评判没有拿到结果（系统错误）的话，counted_result是之前计入统计信息的结果
+        self.last_result = self.submission.info.get("counted_result", self.submission.result) if \
+            [key for key in self.submission.info if key != "progress"] else None
 
         # 设置比赛id和题目id
         # 比赛id非空就要设置题目id和题目归属的比赛id，就是外键关系，否则说明题目并不依附于比赛，肯能就是用户从问题列表中找一道题目来尝试ac
@@ -126,6 +308,25 @@ class JudgeDispatcher(DispatcherBase):
         else:
             self.problem = Problem.objects.get(id=problem_id)
 
+        # 评测优先级：没有指定的话，正在进行的比赛的提交优先评测，其他的是平时练习
+        if lane:
+            self.lane = lane
+        elif self.contest_id and self.contest.status == ContestStatus.CONTEST_UNDERWAY:
+            self.lane = JudgeLane.CONTEST
+        else:
+            self.lane = JudgeLane.PRACTICE
+
+    @staticmethod
+    def problem_judge_timeout(problem):
+        # 一个提交最多需要评判多久（秒）：每个测试用例的实际运行时间限制是cpu时间限制的3倍，再加上编译的时间，
+        # 评测机上的任务可能还要排队等待前面的任务，所以再乘以2
+        test_case_number = max(len(problem.test_case_score or []), 1)
+        return (problem.time_limit / 1000 * 3 * test_case_number + 30) * 2
+
+    @property
+    def judge_timeout(self):
+        return self.problem_judge_timeout(self.problem)
+
     def _compute_statistic_info(self, resp_data):
         # 根据评判结果返回的数据计算统计信息：内存使用、时间使用、OI分数
         # 用时和内存占用保存为多个测试点中最长的那个
@@ -152,29 +353,67 @@ class JudgeDispatcher(DispatcherBase):
             # 计分正常，得出统计分数
             self.submission.statistic_info["score"] = score
 
-    def judge(self):
-        # 先选择评测机
-        server = self.choose_judge_server()
+    def judge(self, server=None, enqueue_time=None):
+        # 先选择评测机，从等待队列里面取出来的任务已经占好了评测机的槽位，enqueue_time是进入等待队列的时间
+        start_time = enqueue_time or time.time()
+        server = server or self.choose_judge_server(lane=self.lane)
         if not server:
             # 没有Server说明现在被用完，需要等一下
-            data = {"submission_id": self.submission.id, "problem_id": self.problem.id}
             # 缓存存放等待任务，返回
-            cache.lpush(CacheKey.waiting_queue, json.dumps(data))
+            enqueue_pending_task(self.submission.id, self.problem.id, self.lane)
+            return
+
+        # 提交数据信息
+        data = self._judge_data()
+
+        # 将对应ID的提交信息更新到提交信息数据表，状态由waiting_queue--->JUDGING
+        Submission.objects.filter(id=self.submission.id).update(result=JudgeStatus.JUDGING)
+
+        # 评判请求发起------->>>>请求后台评判机，评测机把评判放入任务队列之后马上返回任务id，再轮询评判结果
+        # 连接不上评测机的话换一台评测机重试，不能再选择已经失败的评测机
+        failed = []
+        while True:
+            judge_start_time = time.time()
+            try:
+                resp = self._request_job(server, data, self.judge_timeout, on_progress=self.save_judge_progress)
+                break
+            except requests.ConnectionError as e:
+                logger.warning(f"Failed to connect to judge server {server.service_url}: {e}")
+                failed.append(server.id)
+                retry_server = None
+                if len(failed) <= CONNECT_RETRIES:
+                    retry_server = judge_server_scheduler.acquire(reserve=lane_reserve(self.lane), exclude=failed)
+                self.release_judge_server(server)
+                if not retry_server:
+                    resp = None
+                    server = None
+                    break
+                server = retry_server
+
+        # 保存评判结果，并释放Server
+        self.save_judge_result(resp)
+        if server:
+            self.release_judge_server(server)
+            record_judge_server_latency(server.id, time.time() - judge_start_time)
+        record_judge_latency(self.lane, time.time() - start_time)
+        if not resp:
+            # 评测机没有返回结果是我们这边的问题，不计入提交数、罚时和统计信息，之后重判的时候再计入
             return
+        self.update_statistics()
 
+    def _judge_data(self):
+        # 构建发送给评测机的评判数据
         # 提交代码所选择的语言
         language = self.submission.language
         # 提交信息配置sub_config和特殊评判信息配置spj_config
-        # 过滤各项名字为系统的选项语言，并保存在语言language，形成一个列表，取到第一项（下标为0）
-        sub_config = list(filter(lambda item: language == item["name"], SysOptions.languages))[0]
+        # 根据语言的名字从语言索引里面取出配置
+        registry = SysOptions.language_registry
+        sub_config = registry.config(language)
         spj_config = {}
 
         # 需要进行特殊评判：配置评判语言
         if self.problem.spj_code:
-            for lang in SysOptions.spj_languages:
-                if lang["name"] == self.problem.spj_language:
-                    spj_config = lang["spj"]
-                    break
+            spj_config = registry.spj_config(self.problem.spj_language, {})
 
         # 如果提交的语言包含在问题的模板里面，解析模板，重新拼接成新的代码，否则就直接选取配置代码
         if language in self.problem.template:
@@ -183,9 +422,8 @@ class JudgeDispatcher(DispatcherBase):
         else:
             code = self.submission.code
 
-        # 提交数据信息
-        data = {
-            "language_config": sub_config["config"],
+        return {
+            "language_config": sub_config,
             "src": code,
             "max_cpu_time": self.problem.time_limit,
             "max_memory": 1024 * 1024 * self.problem.memory_limit,
@@ -194,17 +432,31 @@ class JudgeDispatcher(DispatcherBase):
             "spj_version": self.problem.spj_version,
             "spj_config": spj_config.get("config"),
             "spj_compile_config": spj_config.get("compile"),
-            "spj_src": self.problem.spj_code
+            "spj_src": self.problem.spj_code,
+            # ACM模式只取第一个出错的测试点的状态，评测机遇到出错的测试点之后就不用再跑剩下的测试点
+            "stop_on_first_failure": self.problem.rule_type == ProblemRuleType.ACM
         }
 
-        # 将对应ID的提交信息更新到提交信息数据表，状态由waiting_queue--->JUDGING
-        Submission.objects.filter(id=self.submission.id).update(result=JudgeStatus.JUDGING)
-
-        # 评判请求发起------->>>>请求后台评判机
-        resp = self._request(urljoin(server.service_url, "/judge"), data=data)
+    def save_judge_progress(self, progress):
+        # 评判过程中，把已经完成的测试用例结果写到提交信息的info["progress"]，轮询提交信息的用户可以看到评判进度
+        # 只更新info字段，评判结果还是JUDGING，评判完成之后由save_judge_result覆盖
+        self.submission.info["progress"] = sorted(progress, key=lambda x: int(x["test_case"]))
+        Submission.objects.filter(id=self.submission.id).update(info=self.submission.info)
 
+    def save_judge_result(self, resp):
         # 根据返回的评测结果信息设置提交信息表字段并保存到数据库表
-        if resp["err"]:
+        # 评判完成，评判进度不再需要
+        self.submission.info.pop("progress", None)
+        self.submission.info.pop("counted_result", None)
+        if not resp:
+            # 连接不上评测机或者评判超时，设置为系统错误，可以之后再重判
+            # 这次不更新统计信息，记下之前计入统计信息的结果，重判的时候从这个结果改成新的结果
+            if self.last_result is not None:
+                self.submission.info["counted_result"] = self.last_result
+            self.submission.result = JudgeStatus.SYSTEM_ERROR
+            self.submission.statistic_info["err_info"] = "Judge server did not return the result"
+            self.submission.statistic_info["score"] = 0
+        elif resp["err"]:
             self.submission.result = JudgeStatus.COMPILE_ERROR
             self.submission.statistic_info["err_info"] = resp["data"]
             self.submission.statistic_info["score"] = 0
@@ -224,10 +476,11 @@ class JudgeDispatcher(DispatcherBase):
                 self.submission.result = error_test_case[0]["result"]
             else:
                 self.submission.result = JudgeStatus.PARTIALLY_ACCEPTED
-        # 保存提交信息，并释放Server
+        # 保存提交信息
         self.submission.save()
-        self.release_judge_server(server.id)
 
+    def update_statistics(self):
+        # 评判结果保存之后，更新比赛排名或者题目和用户的统计信息
         if self.contest_id:
             # 如果当前不是正在进行比赛 或者 当前的提交信息对应的用户是比赛的创建者（当前用户是管理员），
             # 日志中记录管理员是在进行调试：显示contest_id和submission.id
@@ -247,206 +500,115 @@ class JudgeDispatcher(DispatcherBase):
             else:
                 self.update_problem_status()
 
-        # 至此判题结束，尝试处理任务队列中剩余的任务
-        process_pending_task()
-
     def update_problem_status_rejudge(self):
         # 更新数据：当一次提交不通过，又一次提交时候，走这个函数
-        # 此方法更新的是用户配置表的数据
+        # 此方法更新的是用户做题的状态和用户配置表的数据
         result = str(self.submission.result)
-        problem_id = str(self.problem.id)
         with transaction.atomic():
-            # update problem status
-            problem = Problem.objects.select_for_update().get(contest_id=self.contest_id, id=self.problem.id)
+            # 题目的统计信息不再锁题目直接更新，记录一个增量事件，由后台任务批量合并，见judge/statistics.py
             # 上一次评测结果不是AC，而这次AC，那么AC数就加1
-            if self.last_result != JudgeStatus.ACCEPTED and self.submission.result == JudgeStatus.ACCEPTED:
-                problem.accepted_number += 1
-            # 更新题目的AC数目和统计信息（字典类型：统计题目的ac，wa等），注意get方法的使用
-            problem_info = problem.statistic_info
-            # 统计信息字典中排队数减1，last_result默认是pending
-            problem_info[self.last_result] = problem_info.get(self.last_result, 1) - 1
-            # 统计信息字典中的结果字段下PENDING(=6) + 1 --> JUDGING(=7)
+            # 统计信息字典中上一次的结果数减1，这一次的结果数加1
+            accepted = self.last_result != JudgeStatus.ACCEPTED and self.submission.result == JudgeStatus.ACCEPTED
+            problem_info = {str(self.last_result): -1}
             problem_info[result] = problem_info.get(result, 0) + 1
-            problem.save(update_fields=["accepted_number", "statistic_info"])
-
-            # 更新用户的配置信息，例如题目的ac数目
-            profile = User.objects.select_for_update().get(id=self.submission.user_id).userprofile
-            if problem.rule_type == ProblemRuleType.ACM:
-                # 获取已经AC的问题的字典数据，里面的题目都已经AC
-                acm_problems_status = profile.acm_problems_status.get("problems", {})
-                # 如果用户本身对此题目ac不通过(默认是这样)，那么对此题目的ac状态赋值为这次自身提交信息的结果
-                if acm_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    acm_problems_status[problem_id]["status"] = self.submission.result
-                    # 进一步判断，如果这次对这道题目提交的结果ac了，ac数目加1
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        profile.accepted_number += 1
-                # 如果本身已经AC通过，赋值回自身，不做更改（不能这次没通过就抹掉前面的AC状态），同时更新用户配置数据
-                profile.acm_problems_status["problems"] = acm_problems_status
-                profile.save(update_fields=["accepted_number", "acm_problems_status"])
-
-            else:
-                # 获取用户配置信息中OI通过的状态信息
-                oi_problems_status = profile.oi_problems_status.get("problems", {})
-                # 取到本次做OI题目的总分score
-                score = self.submission.statistic_info["score"]
-                # 如果上一次OI题目不AC
-                if oi_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    # 注意：计算总分时候，应该先减掉上一次该题所得的分数，然后再加上本次所得的分数，这样就不会出现冲突混乱，不然你要怎样计分
-                    profile.add_score(this_time_score=score,
-                                      last_time_score=oi_problems_status[problem_id]["score"])
-                    # 将此问题的分数更新为本次所得的分数，同时更新次题目的状态为本次OI状态，如果上次得分多，本次得分少，那就分数少了，就是这个规则
-                    oi_problems_status[problem_id]["score"] = score
-                    oi_problems_status[problem_id]["status"] = self.submission.result
-                    # 上次没AC，今次AC，那就AC+1，vice versa
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        profile.accepted_number += 1
-                # 如果本身已经AC通过，赋值回自身，不做更改（不能这次没通过就抹掉前面的AC状态），同时更新用户配置数据
-                profile.oi_problems_status["problems"] = oi_problems_status
-                profile.save(update_fields=["accepted_number", "oi_problems_status"])
+            add_problem_statistic_event(self.problem.id, accepted_number=int(accepted), statistic_info=problem_info)
+            # 重判不算新的提交
+            self._update_user_problem_status(submission_number=0)
 
     def update_problem_status(self):
         # 更新问题状态，
         result = str(self.submission.result)
-        problem_id = str(self.problem.id)
         with transaction.atomic():
-            # 更新问题状态：题目提交数、ac数、统计信息的AC数，跟新数据库
-            problem = Problem.objects.select_for_update().get(contest_id=self.contest_id, id=self.problem.id)
-            problem.submission_number += 1
-            if self.submission.result == JudgeStatus.ACCEPTED:
-                problem.accepted_number += 1
-            problem_info = problem.statistic_info
-            # 统计信息字典中的结果字段下PENDING(=6) + 1 --> JUDGING(=7)
-            problem_info[result] = problem_info.get(result, 0) + 1
-            problem.save(update_fields=["accepted_number", "submission_number", "statistic_info"])
-
-            # 更新用户配置
-            user = User.objects.select_for_update().get(id=self.submission.user_id)
-            user_profile = user.userprofile
-            # 提交数+1
-            user_profile.submission_number += 1
-            if problem.rule_type == ProblemRuleType.ACM:
-                # 查找出之前用户对该题的AC状态
-                acm_problems_status = user_profile.acm_problems_status.get("problems", {})
-                # 显示的problems_id不在字典类型acm_problems_status，这种情况是用户首次提交该题的信息，非rejudge，后者有专门的方法处理或者走下面的elif
-                if problem_id not in acm_problems_status:
-                    # 新构建acm_problems_status类型，并保存
-                    acm_problems_status[problem_id] = {"status": self.submission.result, "_id": self.problem._id}
-                    # 本次通过，AC+1
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                # 之前的状态为not AC
-                elif acm_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    # 更新本次的提交状态
-                    acm_problems_status[problem_id]["status"] = self.submission.result
-                    # 如果AC就+1
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                # 状态不存在而又没AC，赋值会给自身，不做更改， 更新数据库
-                user_profile.acm_problems_status["problems"] = acm_problems_status
-                user_profile.save(update_fields=["submission_number", "accepted_number", "acm_problems_status"])
-
-            else:
-                # 取到之前的OI状态和本次OI的得分
-                oi_problems_status = user_profile.oi_problems_status.get("problems", {})
-                score = self.submission.statistic_info["score"]
-                if problem_id not in oi_problems_status:
-                    # 之前没做过这道题，首次提交，分数就是本次所得的分数
-                    user_profile.add_score(score)
-                    # 新构建oi_problems_status，将该题目的状态信息以字典类型存放
-                    oi_problems_status[problem_id] = {"status": self.submission.result,
-                                                      "_id": self.problem._id,
-                                                      "score": score}
-                    # 如果AC，AC+1
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                elif oi_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    # 注意：计算总分时候，应该先减掉上一次该题所得的分数，然后再加上本次所得的分数
-                    user_profile.add_score(this_time_score=score,
-                                           last_time_score=oi_problems_status[problem_id]["score"])
-                    # 配置该题目的分数和答题状态，并保存
-                    oi_problems_status[problem_id]["score"] = score
-                    oi_problems_status[problem_id]["status"] = self.submission.result
-                    if self.submission.result == JudgeStatus.ACCEPTED:
-                        user_profile.accepted_number += 1
-                user_profile.oi_problems_status["problems"] = oi_problems_status
-                user_profile.save(update_fields=["submission_number", "accepted_number", "oi_problems_status"])
+            # 更新问题状态：题目提交数、ac数、统计信息的AC数，记录增量事件，由后台任务批量合并到题目里面
+            add_problem_statistic_event(self.problem.id, submission_number=1,
+                                        accepted_number=int(self.submission.result == JudgeStatus.ACCEPTED),
+                                        statistic_info={result: 1})
+            # 更新用户做题的状态和用户配置，提交数+1
+            self._update_user_problem_status(submission_number=1)
+
+    def _update_user_problem_status(self, submission_number):
+        # 更新用户做这道题的状态（UserProblemStatus的一行），以及用户配置里面的提交数、AC数和OI总分，在事务里面调用
+        # 只锁用户做这道题的这一行，用户配置的计数器用F表达式更新，不再读写整个json字段
+        score = self.submission.statistic_info.get("score", 0) if self.problem.rule_type == ProblemRuleType.OI else 0
+        status, created = UserProblemStatus.objects.select_for_update().get_or_create(
+            user_id=self.submission.user_id, problem_id=self.problem.id,
+            defaults={"contest_id": self.contest_id, "status": self.submission.result, "score": score})
+        profile_fields = {}
+        if submission_number:
+            profile_fields["submission_number"] = F("submission_number") + submission_number
+        if created:
+            # 用户首次提交该题，分数就是本次所得的分数，本次通过，AC+1
+            accepted = self.submission.result == JudgeStatus.ACCEPTED
+            score_delta = score
+        elif status.status != JudgeStatus.ACCEPTED:
+            # 之前的状态为not AC，更新本次的提交状态，如果AC就+1
+            # 注意：计算总分时候，应该先减掉上一次该题所得的分数，然后再加上本次所得的分数
+            accepted = self.submission.result == JudgeStatus.ACCEPTED
+            score_delta = score - status.score
+            status.status = self.submission.result
+            status.score = score
+            status.save(update_fields=["status", "score"])
+        else:
+            # 如果本身已经AC通过，不做更改（不能这次没通过就抹掉前面的AC状态）
+            accepted = False
+            score_delta = 0
+        if accepted:
+            profile_fields["accepted_number"] = F("accepted_number") + 1
+        if score_delta:
+            profile_fields["total_score"] = F("total_score") + score_delta
+        if profile_fields:
+            UserProfile.objects.filter(user_id=self.submission.user_id).update(**profile_fields)
 
     def update_contest_problem_status(self):
         # 更新比赛题目答题状态
         with transaction.atomic():
-            # 获取参赛用户、配置、提交的问题
-            user = User.objects.select_for_update().get(id=self.submission.user_id)
-            user_profile = user.userprofile
-            problem_id = str(self.problem.id)
-            if self.contest.rule_type == ContestRuleType.ACM:
-                # 获取上一次用户对该题的AC状态，才做都是在字典里面进行
-                contest_problems_status = user_profile.acm_problems_status.get("contest_problems", {})
-                if problem_id not in contest_problems_status:
-                    # 初次答题构建新的status
-                    contest_problems_status[problem_id] = {"status": self.submission.result, "_id": self.problem._id}
-                elif contest_problems_status[problem_id]["status"] != JudgeStatus.ACCEPTED:
-                    # not AC，直接赋值新状态
-                    contest_problems_status[problem_id]["status"] = self.submission.result
-                else:
+            # 获取并锁住用户做这道比赛题目的状态
+            score = self.submission.statistic_info.get("score", 0) \
+                if self.contest.rule_type == ContestRuleType.OI else 0
+            status, created = UserProblemStatus.objects.select_for_update().get_or_create(
+                user_id=self.submission.user_id, problem_id=self.problem.id,
+                defaults={"contest_id": self.contest_id, "status": self.submission.result, "score": score})
+            if not created:
+                if self.contest.rule_type == ContestRuleType.ACM and status.status == JudgeStatus.ACCEPTED:
                     # 如果已AC， 直接跳过 不计入任何计数器
                     return
-                user_profile.acm_problems_status["contest_problems"] = contest_problems_status
-                user_profile.save(update_fields=["acm_problems_status"])
-
-            elif self.contest.rule_type == ContestRuleType.OI:
-                # 获取上一次的题目答题状态和当前分数
-                contest_problems_status = user_profile.oi_problems_status.get("contest_problems", {})
-                score = self.submission.statistic_info["score"]
-                if problem_id not in contest_problems_status:
-                    # 初次答题构建新的status
-                    contest_problems_status[problem_id] = {"status": self.submission.result,
-                                                           "_id": self.problem._id,
-                                                           "score": score}
-                else:
-                    # 否则就是已经对该题提交过答案，跟新信息
-                    contest_problems_status[problem_id]["score"] = score
-                    contest_problems_status[problem_id]["status"] = self.submission.result
-                user_profile.oi_problems_status["contest_problems"] = contest_problems_status
-                user_profile.save(update_fields=["oi_problems_status"])
-
-            # 如果不是以ACM或者OI参加的比赛，用户仅仅是想AC这道题，根据contest_id和problem.id查找出该比赛题目
-            problem = Problem.objects.select_for_update().get(contest_id=self.contest_id, id=self.problem.id)
-            result = str(self.submission.result)
-            problem_info = problem.statistic_info
-            # 统计信息中的PENDING(=6)+1 -->JUDGING
-            problem_info[result] = problem_info.get(result, 0) + 1
-            # 提交数目+1
-            problem.submission_number += 1
-            if self.submission.result == JudgeStatus.ACCEPTED:
-                problem.accepted_number += 1
-            problem.save(update_fields=["submission_number", "accepted_number", "statistic_info"])
+                # ACM没有AC，直接赋值新状态；OI已经对该题提交过答案，更新分数和状态
+                status.status = self.submission.result
+                status.score = score
+                status.save(update_fields=["status", "score"])
+
+            # 比赛题目的提交数、AC数和统计信息和平时练习一样记录增量事件，由后台任务批量合并，比赛期间不再锁题目
+            add_problem_statistic_event(self.problem.id, submission_number=1,
+                                        accepted_number=int(self.submission.result == JudgeStatus.ACCEPTED),
+                                        statistic_info={str(self.submission.result): 1})
 
     def update_contest_rank(self):
-        # 如果比赛是OI或者比赛实时排名为true，先删除缓存的数据，重新按照指定的比赛规则进行排序
-        if self.contest.rule_type == ContestRuleType.OI or self.contest.real_time_rank:
-            cache.delete(f"{CacheKey.contest_rank_cache}:{self.contest.id}")
+        # 更新数据库里面这个用户的排名，事务提交之后再更新redis里面的排名的这一行，见contest/scoreboard.py
         with transaction.atomic():
             if self.contest.rule_type == ContestRuleType.ACM:
-                acm_rank, _ = ACMContestRank.objects.select_for_update(). \
+                rank, _ = ACMContestRank.objects.select_for_update(). \
                     get_or_create(user_id=self.submission.user_id, contest=self.contest)
+                # 排名每次更新版本都加1，redis里面乱序到达的旧版本会被忽略，下面保存排名的时候一起保存
+                rank.version += 1
                 # 传入查找到的acm_rank，里面有accepted_number、total_time、submission_info
-                self._update_acm_contest_rank(acm_rank)
+                self._update_acm_contest_rank(rank)
             else:
-                oi_rank, _ = OIContestRank.objects.select_for_update(). \
+                rank, _ = OIContestRank.objects.select_for_update(). \
                     get_or_create(user_id=self.submission.user_id, contest=self.contest)
+                rank.version += 1
                 # 传入查找到的oi_rank，里面有total_score、submission_info
-                self._update_oi_contest_rank(oi_rank)
+                self._update_oi_contest_rank(rank)
+            transaction.on_commit(lambda: ContestScoreboard(self.contest).update(rank))
 
     def _update_acm_contest_rank(self, rank):
         # 获取本题的ID
         info = rank.submission_info.get(str(self.submission.problem_id))
-        # 因前面更改过，这里需要重新获取
-        problem = Problem.objects.get(contest_id=self.contest_id, id=self.problem.id)
 
         # 首先此题提交过，Info非空，即非第一次提交
         if info:
             # 如果本题没被AC，返回.否则继续
             if info["is_ac"]:
+                rank.save(update_fields=["version"])
                 return
 
             # rank的提交数+1
@@ -459,7 +621,7 @@ class JudgeDispatcher(DispatcherBase):
                 rank.total_time += info["ac_time"] + info["error_number"] * 20 * 60
 
                 # 首次被AC
-                if problem.accepted_number == 1:
+                if self._is_first_ac():
                     info["is_first_ac"] = True
             # 不是编译错误，就是答案错误，提交错误数+1
             elif self.submission.result != JudgeStatus.COMPILE_ERROR:
@@ -477,7 +639,7 @@ class JudgeDispatcher(DispatcherBase):
                 # 首次计时不加罚时
                 rank.total_time += info["ac_time"]
 
-                if problem.accepted_number == 1:
+                if self._is_first_ac():
                     info["is_first_ac"] = True
 
             # 否则非编译错误就是答案错误
@@ -487,6 +649,15 @@ class JudgeDispatcher(DispatcherBase):
         rank.submission_info[str(self.submission.problem_id)] = info
         rank.save()
 
+    def _is_first_ac(self):
+        # 是不是第一个AC这道比赛题目的用户，题目的AC数是批量合并的，不能再用题目的AC数判断
+        # 其他用户已经AC过的话就不是，同时AC的时候由redis的SET NX决定哪一个是第一个
+        if UserProblemStatus.objects.filter(problem_id=self.problem.id, status=JudgeStatus.ACCEPTED) \
+                .exclude(user_id=self.submission.user_id).exists():
+            return False
+        return bool(cache.set(f"{CacheKey.contest_first_ac}:{self.problem.id}", self.submission.user_id,
+                              timeout=FIRST_AC_TTL, nx=True))
+
     def _update_oi_contest_rank(self, rank):
         # 获取题目ID，当前统计信息里面的分数，上一次该题的得分
         problem_id = str(self.submission.problem_id)
@@ -502,3 +673,128 @@ class JudgeDispatcher(DispatcherBase):
         rank.submission_info[problem_id] = current_score
         rank.save()
 
+
+def judge_batch(submission_ids, problem_id, lane=JudgeLane.REJUDGE):
+    # 批量评判同一道题的多个提交，提交放到这一批的列表里面，由judge_batch_task每次取出一批评判
+    submission_ids = list(submission_ids)
+    if not submission_ids:
+        return
+    batch_id = rand_str()
+    key = f"{CacheKey.judge_batch}:{batch_id}"
+    pipe = cache.pipeline()
+    pipe.rpush(key, *submission_ids)
+    pipe.expire(key, JUDGE_BATCH_TTL)
+    pipe.execute()
+    # 防止循环引入
+    from judge.tasks import judge_batch_task
+    judge_batch_task.delay(batch_id, problem_id, lane)
+
+
+class JudgeBatchDispatcher(DispatcherBase):
+    # 批量评测调度者类：同一道题的多个提交（例如重判一道题）分成多批，每批只发送一次请求给评测机，
+    # 评测机共用测试用例和编译缓存，每评判完一个提交就返回一行结果，这里就马上保存结果和更新统计信息
+    # 每个提交占用评测机的一个槽位，一批的提交数就是在同一台评测机上占用到的槽位数，评测机的负载和单个评判一样计算
+    # 一批的提交数还要保证按顺序评判完也不会超过celery任务的时间限制，剩下的提交由下一个任务继续评判
+    # 提交数据里面和题目相关的字段（测试用例、时间内存限制、特殊评判）是所有提交共用的，只发送一次
+    common_fields = ("max_cpu_time", "max_memory", "test_case_id", "output", "spj_version", "spj_config",
+                     "spj_compile_config", "spj_src", "stop_on_first_failure")
+
+    # 批量评测默认是重判，优先级最低
+    def __init__(self, batch_id, problem_id, lane=JudgeLane.REJUDGE):
+        super().__init__()
+        self.batch_id = batch_id
+        self.key = f"{CacheKey.judge_batch}:{batch_id}"
+        self.problem_id = problem_id
+        self.lane = lane
+
+    def _pop(self, count):
+        # 从这一批剩下的提交里面取出最多count个，多个任务同时取也不会取到同一个提交
+        pipe = cache.pipeline()
+        pipe.lrange(self.key, 0, count - 1)
+        pipe.ltrim(self.key, count, -1)
+        submission_ids = [item.decode("utf-8") for item in pipe.execute()[0]]
+        disabled_uids = User.objects.filter(is_disabled=True).values_list("id", flat=True)
+        return list(Submission.objects.filter(id__in=submission_ids).exclude(user_id__in=disabled_uids)
+                    .values_list("id", flat=True))
+
+    def _schedule_next(self, countdown=None):
+        # 防止循环引入
+        from judge.tasks import judge_batch_task
+        if cache.llen(self.key):
+            judge_batch_task.apply_async((self.batch_id, self.problem_id, self.lane), countdown=countdown)
+
+    def judge(self):
+        remaining = cache.llen(self.key)
+        if not remaining:
+            return
+        problem = Problem.objects.get(id=self.problem_id)
+        # 一批最多多少个提交：每个提交按照最长的评判时间计算，按顺序评判完也不会超过celery任务的时间限制
+        judge_timeout = JudgeDispatcher.problem_judge_timeout(problem)
+        batch_size = max(int(settings.CELERY_TASK_TIME_LIMIT // judge_timeout), 1)
+        slots = judge_server_scheduler.acquire_batch(min(batch_size, remaining),
+                                                     reserve=lane_reserve(self.lane))
+        if not slots:
+            # 没有空闲的槽位，过一会儿再试，释放的槽位优先给等待队列里面的任务
+            self._schedule_next(countdown=BATCH_RETRY_DELAY)
+            return
+        submission_ids = self._pop(len(slots))
+        # 取到的提交比槽位少（其他任务同时取走了，或者用户被禁用了），多余的槽位马上释放
+        for slot in slots[len(submission_ids):]:
+            judge_server_scheduler.release(slot)
+        slots = slots[:len(submission_ids)]
+        # 剩下的提交马上交给下一个任务，还有空闲槽位的话由其他评测机同时评判
+        self._schedule_next()
+        if not submission_ids:
+            process_pending_task()
+            return
+
+        start_time = time.time()
+        dispatchers = {submission_id: JudgeDispatcher(submission_id, self.problem_id, lane=self.lane)
+                       for submission_id in submission_ids}
+        data = None
+        submissions = []
+        for submission_id, dispatcher in dispatchers.items():
+            judge_data = dispatcher._judge_data()
+            if data is None:
+                data = {k: judge_data[k] for k in self.common_fields}
+            submissions.append({"id": submission_id,
+                                "language_config": judge_data["language_config"],
+                                "src": judge_data["src"]})
+        data["submissions"] = submissions
+
+        Submission.objects.filter(id__in=submission_ids).update(result=JudgeStatus.JUDGING)
+
+        server = slots[0]
+        finished = set()
+        try:
+            # 评测机同时评判的提交数不超过槽位数，两行结果之间最多间隔一个提交的评判时间
+            for resp in self._request_stream(urljoin(server.service_url, "/judge_batch"), data=data,
+                                             timeout=judge_timeout):
+                for slot in slots:
+                    judge_server_scheduler.renew(slot)
+                submission_id = resp.pop("id", None)
+                # 没有id说明整个请求出错了，例如测试用例不存在、特殊评判编译错误，所有的提交都是这个结果
+                if submission_id is None:
+                    for submission_id, dispatcher in dispatchers.items():
+                        if submission_id not in finished:
+                            dispatcher.save_judge_result(dict(resp))
+                            dispatcher.update_statistics()
+                            finished.add(submission_id)
+                    break
+                dispatcher = dispatchers.get(submission_id)
+                if not dispatcher or submission_id in finished:
+                    continue
+                dispatcher.save_judge_result(resp)
+                dispatcher.update_statistics()
+                finished.add(submission_id)
+                record_judge_latency(self.lane, time.time() - start_time)
+        finally:
+            for slot in slots:
+                judge_server_scheduler.release(slot)
+            process_pending_task()
+        record_judge_server_latency(server.id, time.time() - start_time)
+
+        # 连接中断等原因没有返回结果的提交，和单个评判一样设置为系统错误，不计入统计信息，可以之后再重判
+        for submission_id, dispatcher in dispatchers.items():
+            if submission_id not in finished:
+                dispatcher.save_judge_result(None)
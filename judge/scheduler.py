@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*-encoding:UTF-8-*-
+# 评测机选择：基于redis的评测任务槽位调度
+#
+# 之前每次选择和释放评测机都要在数据库事务里面select_for_update所有评测机，比赛的时候所有的celery worker都在等同一批行锁。
+# 现在评测机的负载放在redis里面，选择和释放都是一个lua脚本，原子执行，不需要加锁：
+#   judge_server_load       有序集合，成员是评测机id，分数是正在评测的任务数
+#   judge_server_capacity   哈希表，评测机id -> 最多同时评测的任务数（根据cpu_core计算，禁用的评测机是0）
+#   judge_server_heartbeat  哈希表，评测机id -> 最后一次心跳的时间戳
+#   judge_server_url        哈希表，评测机id -> service_url
+#   judge_server_lease      有序集合，成员是"评测机id:租约id"，分数是租约的过期时间戳，每占用一个槽位就有一个租约
+# 评测机的信息在每次心跳的时候更新，数据库只在定期的对账（reconcile）中读写。
+# 占用槽位的进程被杀掉（OOM、celery的硬超时、重新部署）来不及释放槽位的话，租约会过期，
+# 对账的时候删除过期的租约，并按照剩下的租约数重新计算每台评测机正在评测的任务数，泄露的槽位不会一直被占用。
+
+import logging
+import time
+from collections import namedtuple
+
+from django.utils import timezone
+
+from conf.models import JudgeServer
+from myutils.cache import cache
+from myutils.constants import CacheKey
+
+logger = logging.getLogger(__name__)
+
+# 和JudgeServer.status一致，超过这个秒数没有心跳的评测机不再分配任务
+HEARTBEAT_TIMEOUT = 6
+# 对账的间隔（秒）
+RECONCILE_INTERVAL = 60
+# 槽位租约的有效期（秒），比celery任务的硬超时长，评判过程中会续期
+SLOT_LEASE_TIMEOUT = 300
+
+# 选中的评测机，只有分配任务需要的id和service_url，以及释放槽位的时候需要的租约
+JudgeServerSlot = namedtuple("JudgeServerSlot", ["id", "service_url", "lease"])
+
+# 选择正在评测的任务数最少、还有空闲槽位、心跳正常的评测机，没有返回nil，ACQUIRE_SCRIPT和DISPATCH_SCRIPT共用
+# free_slots返回所有心跳正常的评测机加起来的空闲槽位数
+CHOOSE_SERVER = """
+local function choose_server(load_key, capacity_key, heartbeat_key, now, timeout, excluded)
+    local servers = redis.call('ZRANGE', load_key, 0, -1, 'WITHSCORES')
+    for i = 1, #servers, 2 do
+        local id = servers[i]
+        local load = tonumber(servers[i + 1])
+        local capacity = tonumber(redis.call('HGET', capacity_key, id) or '0')
+        local heartbeat = tonumber(redis.call('HGET', heartbeat_key, id) or '0')
+        if load < capacity and now - heartbeat <= timeout and not (excluded and excluded[id]) then
+            return id
+        end
+    end
+    return nil
+end
+
+-- 为占用的槽位创建一个租约，返回租约
+local function take_lease(lease_key, counter_key, id, expire)
+    local lease = id .. ':' .. redis.call('INCR', counter_key)
+    redis.call('ZADD', lease_key, expire, lease)
+    return lease
+end
+
+local function free_slots(load_key, capacity_key, heartbeat_key, now, timeout)
+    local servers = redis.call('ZRANGE', load_key, 0, -1, 'WITHSCORES')
+    local free = 0
+    for i = 1, #servers, 2 do
+        local id = servers[i]
+        local load = tonumber(servers[i + 1])
+        local capacity = tonumber(redis.call('HGET', capacity_key, id) or '0')
+        local heartbeat = tonumber(redis.call('HGET', heartbeat_key, id) or '0')
+        if load < capacity and now - heartbeat <= timeout then
+            free = free + capacity - load
+        end
+    end
+    return free
+end
+"""
+
+# 选择评测机并占用一个槽位，空闲槽位数不超过ARGV[3]（为比赛预留的槽位数）的时候不分配
+# ARGV[5]之后是不能选择的评测机id，例如刚刚连接失败的评测机
+# KEYS: load, capacity, heartbeat, url, lease, lease_id
+# ARGV: 当前时间戳, 心跳超时秒数, 预留槽位数, 租约有效期, 排除的评测机id...
+ACQUIRE_SCRIPT = CHOOSE_SERVER + """
+local now = tonumber(ARGV[1])
+local timeout = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local lease_timeout = tonumber(ARGV[4])
+local excluded = {}
+for i = 5, #ARGV do
+    excluded[ARGV[i]] = true
+end
+if reserve > 0 and free_slots(KEYS[1], KEYS[2], KEYS[3], now, timeout) <= reserve then
+    return false
+end
+local id = choose_server(KEYS[1], KEYS[2], KEYS[3], now, timeout, excluded)
+if not id then
+    return false
+end
+redis.call('ZINCRBY', KEYS[1], 1, id)
+local lease = take_lease(KEYS[5], KEYS[6], id, now + lease_timeout)
+return {id, redis.call('HGET', KEYS[4], id), lease}
+"""
+
+# 批量评判：在同一台评测机上最多占用ARGV[5]个槽位，每个槽位一个租约，评测机同时评判的提交数不会超过占用的槽位数
+# 占用之后至少要留下ARGV[3]个空闲槽位（为比赛预留的槽位数）
+# KEYS: load, capacity, heartbeat, url, lease, lease_id
+# ARGV: 当前时间戳, 心跳超时秒数, 预留槽位数, 租约有效期, 最多占用的槽位数
+ACQUIRE_BATCH_SCRIPT = CHOOSE_SERVER + """
+local now = tonumber(ARGV[1])
+local timeout = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local lease_timeout = tonumber(ARGV[4])
+local free = free_slots(KEYS[1], KEYS[2], KEYS[3], now, timeout)
+if free <= reserve then
+    return false
+end
+local id = choose_server(KEYS[1], KEYS[2], KEYS[3], now, timeout)
+if not id then
+    return false
+end
+local load = tonumber(redis.call('ZSCORE', KEYS[1], id))
+local capacity = tonumber(redis.call('HGET', KEYS[2], id))
+local count = math.min(tonumber(ARGV[5]), capacity - load, free - reserve)
+redis.call('ZINCRBY', KEYS[1], count, id)
+local leases = {}
+for i = 1, count do
+    table.insert(leases, take_lease(KEYS[5], KEYS[6], id, now + lease_timeout))
+end
+return {id, redis.call('HGET', KEYS[4], id), leases}
+"""
+
+# 有多少个空闲的槽位就从各个优先级的等待队列里面取出多少个任务，每个任务占用一个槽位，最多取出ARGV[3]个
+# 取任务和占槽位在同一个脚本里面，多个消费者同时处理等待队列也不会取出比空闲槽位更多的任务
+# 多个队列之间按照权重平滑加权轮询（和nginx的upstream一样），每个队列的当前权重保存在KEYS[7]里面，
+# 空闲槽位数不超过队列的预留槽位数的时候，这个队列暂时不能取任务
+# KEYS: load, capacity, heartbeat, url, lease, lease_id, 当前权重, 等待队列1, 等待队列2...
+# ARGV: 当前时间戳, 心跳超时秒数, 最多取出的任务数, 租约有效期, 队列1的权重, 队列1的预留槽位数, 队列2的权重...
+DISPATCH_SCRIPT = CHOOSE_SERVER + """
+local now = tonumber(ARGV[1])
+local timeout = tonumber(ARGV[2])
+local max_count = tonumber(ARGV[3])
+local lease_timeout = tonumber(ARGV[4])
+local ret = {}
+while #ret < max_count do
+    local free = free_slots(KEYS[1], KEYS[2], KEYS[3], now, timeout)
+    if free <= 0 then
+        break
+    end
+    local best = nil
+    local best_weight = nil
+    local total = 0
+    for i = 1, #KEYS - 7 do
+        local queue = KEYS[7 + i]
+        local weight = tonumber(ARGV[3 + 2 * i])
+        local reserve = tonumber(ARGV[4 + 2 * i])
+        if free > reserve and redis.call('LLEN', queue) > 0 then
+            local current = redis.call('HINCRBY', KEYS[7], queue, weight)
+            total = total + weight
+            if not best or current > best_weight then
+                best = i
+                best_weight = current
+            end
+        end
+    end
+    if not best then
+        break
+    end
+    redis.call('HINCRBY', KEYS[7], KEYS[7 + best], -total)
+    local id = choose_server(KEYS[1], KEYS[2], KEYS[3], now, timeout)
+    redis.call('ZINCRBY', KEYS[1], 1, id)
+    local lease = take_lease(KEYS[5], KEYS[6], id, now + lease_timeout)
+    table.insert(ret, {redis.call('RPOP', KEYS[7 + best]), id, redis.call('HGET', KEYS[4], id), best, lease})
+end
+return ret
+"""
+
+# 释放一个槽位，评测机已经被删除或者任务数已经是0就什么都不做
+# 租约已经不存在（过期之后被对账回收了）的话，槽位已经释放过了，不能再减一次
+# KEYS: load, lease  ARGV: 评测机id, 租约
+RELEASE_SCRIPT = """
+if redis.call('ZREM', KEYS[2], ARGV[2]) == 0 then
+    return false
+end
+local load = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if load and tonumber(load) > 0 then
+    return redis.call('ZINCRBY', KEYS[1], -1, ARGV[1])
+end
+return false
+"""
+
+# 删除过期的租约，然后按照每台评测机剩下的租约数重新设置正在评测的任务数
+# KEYS: load, lease  ARGV: 当前时间戳
+RECLAIM_SCRIPT = """
+local expired = redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+local counts = {}
+for _, lease in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    local id = string.match(lease, '^(.*):[^:]*$')
+    counts[id] = (counts[id] or 0) + 1
+end
+for _, id in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    redis.call('ZADD', KEYS[1], counts[id] or 0, id)
+end
+return expired
+"""
+
+
+class JudgeServerScheduler(object):
+    def __init__(self):
+        self._acquire_script = None
+        self._acquire_batch_script = None
+        self._dispatch_script = None
+        self._release_script = None
+        self._reclaim_script = None
+
+    @property
+    def _keys(self):
+        return [CacheKey.judge_server_load, CacheKey.judge_server_capacity,
+                CacheKey.judge_server_heartbeat, CacheKey.judge_server_url,
+                CacheKey.judge_server_lease, CacheKey.judge_server_lease_id]
+
+    @staticmethod
+    def capacity(server):
+        # 和之前的task_number <= cpu_core * 2一致
+        if server.is_disabled:
+            return 0
+        return server.cpu_core * 2 + 1
+
+    def acquire(self, reserve=0, exclude=()):
+        # 选择评测机并占用一个槽位，没有可用的评测机返回None
+        # reserve：至少要留下多少个空闲槽位，用于给比赛预留槽位，exclude：不能选择的评测机id
+        if self._acquire_script is None:
+            self._acquire_script = cache.register_script(ACQUIRE_SCRIPT)
+        args = [time.time(), HEARTBEAT_TIMEOUT, reserve, SLOT_LEASE_TIMEOUT] + list(exclude)
+        ret = self._acquire_script(keys=self._keys, args=args)
+        if not ret and not cache.exists(CacheKey.judge_server_load):
+            # redis里面还没有评测机的信息（例如redis重启过），从数据库加载一次之后再试
+            self.reconcile(force=True)
+            ret = self._acquire_script(keys=self._keys, args=args)
+        if not ret:
+            return None
+        return JudgeServerSlot(id=int(ret[0]), service_url=ret[1].decode("utf-8"), lease=ret[2].decode("utf-8"))
+
+    def acquire_batch(self, count, reserve=0):
+        """
+        在同一台评测机上占用最多count个槽位，用于批量评判
+        :return: [JudgeServerSlot, ...]，每个槽位一个，评测机都是同一台，没有可用的评测机返回空列表
+        """
+        if self._acquire_batch_script is None:
+            self._acquire_batch_script = cache.register_script(ACQUIRE_BATCH_SCRIPT)
+        if not cache.exists(CacheKey.judge_server_load):
+            self.reconcile(force=True)
+        ret = self._acquire_batch_script(keys=self._keys,
+                                         args=[time.time(), HEARTBEAT_TIMEOUT, reserve, SLOT_LEASE_TIMEOUT, count])
+        if not ret:
+            return []
+        judge_server_id, service_url, leases = ret
+        return [JudgeServerSlot(id=int(judge_server_id), service_url=service_url.decode("utf-8"),
+                                lease=lease.decode("utf-8")) for lease in leases]
+
+    def acquire_queued(self, queues, max_count=100):
+        """
+        从多个等待队列（最早的任务在右边）按照权重取出任务，并为每个任务占用一个评测机槽位
+        :param queues: [(等待队列, 权重, 预留槽位数), ...]
+        :return: [(任务, JudgeServerSlot, 等待队列), ...]，没有空闲槽位或者队列都是空的时候返回空列表
+        """
+        if self._dispatch_script is None:
+            self._dispatch_script = cache.register_script(DISPATCH_SCRIPT)
+        if not cache.exists(CacheKey.judge_server_load):
+            self.reconcile(force=True)
+        keys = self._keys + [CacheKey.waiting_queue_weight] + [queue for queue, _, _ in queues]
+        args = [time.time(), HEARTBEAT_TIMEOUT, max_count, SLOT_LEASE_TIMEOUT]
+        for _, weight, reserve in queues:
+            args.extend([weight, reserve])
+        ret = self._dispatch_script(keys=keys, args=args)
+        return [(task, JudgeServerSlot(id=int(judge_server_id), service_url=service_url.decode("utf-8"),
+                                       lease=lease.decode("utf-8")),
+                 queues[index - 1][0])
+                for task, judge_server_id, service_url, index, lease in ret]
+
+    def release(self, slot):
+        if self._release_script is None:
+            self._release_script = cache.register_script(RELEASE_SCRIPT)
+        self._release_script(keys=[CacheKey.judge_server_load, CacheKey.judge_server_lease],
+                             args=[slot.id, slot.lease])
+
+    def renew(self, slot):
+        # 延长槽位的租约，评判时间比较长的时候在评判过程中调用，租约已经被回收的话不会重新创建
+        cache.execute_command("ZADD", CacheKey.judge_server_lease, "XX",
+                              time.time() + SLOT_LEASE_TIMEOUT, slot.lease)
+
+    def reclaim(self):
+        # 回收过期的租约，并按照剩下的租约重新计算每台评测机正在评测的任务数，返回回收的租约数
+        if self._reclaim_script is None:
+            self._reclaim_script = cache.register_script(RECLAIM_SCRIPT)
+        return self._reclaim_script(keys=[CacheKey.judge_server_load, CacheKey.judge_server_lease],
+                                    args=[time.time()])
+
+    def update_server(self, server):
+        # 评测机心跳、启用或者禁用的时候更新redis里面的评测机信息，正在评测的任务数保持不变
+        pipe = cache.pipeline()
+        pipe.hset(CacheKey.judge_server_capacity, server.id, self.capacity(server))
+        pipe.hset(CacheKey.judge_server_heartbeat, server.id, server.last_heartbeat.timestamp())
+        pipe.hset(CacheKey.judge_server_url, server.id, server.service_url or "")
+        # 不存在的时候才加入，已经存在的话保留正在评测的任务数，不同版本的redis-py的zadd参数不一样，直接执行命令
+        pipe.execute_command("ZADD", CacheKey.judge_server_load, "NX", 0, server.id)
+        pipe.execute()
+
+    def remove_server(self, judge_server_id):
+        pipe = cache.pipeline()
+        pipe.zrem(CacheKey.judge_server_load, judge_server_id)
+        for key in self._keys[1:4]:
+            pipe.hdel(key, judge_server_id)
+        pipe.execute()
+
+    def reconcile(self, force=False):
+        """
+        和数据库对账，最多每RECONCILE_INTERVAL秒执行一次
+        用数据库里面的评测机重建redis里面的评测机信息，删除已经不存在的评测机，
+        回收过期的槽位租约并重新计算正在评测的任务数，再写回数据库的task_number，用于后台显示
+        """
+        if not force and not cache.set(CacheKey.judge_server_reconcile, timezone.now().timestamp(),
+                                       timeout=RECONCILE_INTERVAL, nx=True):
+            return
+        servers = list(JudgeServer.objects.all())
+        for server in servers:
+            self.update_server(server)
+        server_ids = {str(server.id) for server in servers}
+        expired = self.reclaim()
+        if expired:
+            logger.warning(f"Reclaimed {expired} expired judge server slot leases")
+        for item, load in cache.zrange(CacheKey.judge_server_load, 0, -1, withscores=True):
+            judge_server_id = item.decode("utf-8")
+            if judge_server_id not in server_ids:
+                self.remove_server(judge_server_id)
+                continue
+            JudgeServer.objects.filter(id=judge_server_id).exclude(task_number=int(load)) \
+                .update(task_number=int(load))
+
+
+judge_server_scheduler = JudgeServerScheduler()
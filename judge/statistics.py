@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*-encoding:UTF-8-*-
+# 题目统计信息的批量更新
+#
+# 之前每次评判完成都要select_for_update题目，热门题目的那一行成了所有评判任务都要等待的锁。
+# 现在评判完成的时候只插入一条增量事件（ProblemStatisticEvent），和用户信息的更新在同一个事务里面，
+# 由后台任务每FLUSH_INTERVAL秒把事件按照题目合并之后一次性更新到题目里面：
+#   - 合并和删除事件在同一个事务里面，任务失败重试的时候没有删除的事件还会再合并一次，已经删除的不会，每个事件只合并一次
+#   - 事件用select_for_update(skip_locked=True)取出，多个任务同时合并也不会重复合并同一个事件
+
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+
+from myutils.cache import cache
+from myutils.constants import CacheKey
+from problem.models import Problem, ProblemStatisticEvent
+
+logger = logging.getLogger(__name__)
+
+# 合并事件的间隔（秒），第一个事件写入之后最多等待这么久就会合并到题目里面
+FLUSH_INTERVAL = 0.5
+# 每个事务最多合并的事件数
+FLUSH_BATCH_SIZE = 1000
+# 合并任务失败（例如worker被杀掉）没有删除标记的时候，最多这么久之后可以重新安排合并任务
+FLUSH_SCHEDULE_TIMEOUT = 60
+
+
+def add_problem_statistic_event(problem_id, submission_number=0, accepted_number=0, statistic_info=None):
+    # 记录题目统计信息的变化，在调用者的事务提交之后安排合并任务
+    ProblemStatisticEvent.objects.create(problem_id=problem_id,
+                                         submission_number=submission_number,
+                                         accepted_number=accepted_number,
+                                         statistic_info=statistic_info or {})
+    transaction.on_commit(schedule_problem_statistics_flush)
+
+
+def schedule_problem_statistics_flush():
+    # 已经安排了合并任务的话就不再重复安排，FLUSH_INTERVAL秒之内的事件由同一个任务合并
+    if cache.set(CacheKey.problem_statistics_flush, 1, timeout=FLUSH_SCHEDULE_TIMEOUT, nx=True):
+        # 防止循环引入
+        from judge.tasks import flush_problem_statistics_task
+        flush_problem_statistics_task.apply_async(countdown=FLUSH_INTERVAL)
+
+
+def flush_problem_statistics():
+    # 合并所有的事件，返回合并的事件数
+    # 先删除标记，之后写入的事件会重新安排一个合并任务，不会被遗漏
+    cache.delete(CacheKey.problem_statistics_flush)
+    count = 0
+    while True:
+        with transaction.atomic():
+            events = list(ProblemStatisticEvent.objects.select_for_update(skip_locked=True)
+                          .order_by("id")[:FLUSH_BATCH_SIZE])
+            if not events:
+                break
+            _apply_events(events)
+            ProblemStatisticEvent.objects.filter(id__in=[event.id for event in events]).delete()
+        count += len(events)
+    if count:
+        logger.info(f"Flushed {count} problem statistic events")
+    return count
+
+
+def _apply_events(events):
+    submission_number = defaultdict(int)
+    accepted_number = defaultdict(int)
+    statistic_info = defaultdict(lambda: defaultdict(int))
+    for event in events:
+        submission_number[event.problem_id] += event.submission_number
+        accepted_number[event.problem_id] += event.accepted_number
+        for result, delta in event.statistic_info.items():
+            statistic_info[event.problem_id][result] += delta
+
+    # 按照题目id的顺序加锁，多个合并任务同时执行也不会死锁
+    for problem_id in sorted(submission_number.keys()):
+        problem = Problem.objects.select_for_update().filter(id=problem_id).first()
+        if not problem:
+            continue
+        problem_info = problem.statistic_info
+        for result, delta in statistic_info[problem_id].items():
+            problem_info[result] = problem_info.get(result, 0) + delta
+        Problem.objects.filter(id=problem_id).update(
+            submission_number=F("submission_number") + submission_number[problem_id],
+            accepted_number=F("accepted_number") + accepted_number[problem_id],
+            statistic_info=problem_info)
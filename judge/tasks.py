@@ -7,14 +7,33 @@ from celery import shared_task
 
 from account.models import User
 from submission.models import Submission
-from judge.dispatcher import JudgeDispatcher
+from judge.dispatcher import JudgeDispatcher, JudgeBatchDispatcher
+from judge.scheduler import JudgeServerSlot
+from judge.statistics import flush_problem_statistics
+from myutils.constants import JudgeLane
 
 
 # celery 发现任务之后会执行
+# judge_server是从等待队列取出任务的时候已经占好槽位的评测机，lane是评测优先级，enqueue_time是进入等待队列的时间
 @shared_task
-def judge_task(submissiom_id, problem_id):
-    uid = Submission.objects.get(id=submissiom_id).user_id
+def judge_task(submission_id, problem_id, judge_server=None, lane=None, enqueue_time=None):
+    server = JudgeServerSlot(**judge_server) if judge_server else None
+    uid = Submission.objects.get(id=submission_id).user_id
     if User.objects.get(id=uid).is_disabled:
+        if server:
+            JudgeDispatcher.release_judge_server(server)
         return
     # 在判定用户有效之后，JudgeDispatcher会将问题提交的ID和问题ID提交给评判机
-    JudgeDispatcher(submissiom_id, problem_id).judge()
+    JudgeDispatcher(submission_id, problem_id, lane=lane).judge(server=server, enqueue_time=enqueue_time)
+
+
+# 批量评判同一道题的多个提交（见judge.dispatcher.judge_batch），每个任务取出一批，只请求一次评测机
+@shared_task
+def judge_batch_task(batch_id, problem_id, lane=JudgeLane.REJUDGE):
+    JudgeBatchDispatcher(batch_id, problem_id, lane=lane).judge()
+
+
+# 把评判完成时记录的题目统计信息的增量事件合并到题目里面
+@shared_task
+def flush_problem_statistics_task():
+    flush_problem_statistics()
@@ -1,3 +1,67 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from account.models import UserProfile
+from contest.models import ACMContestRank, Contest
+from contest.tests import DEFAULT_CONTEST_DATA
+from problem.models import Problem, ProblemStatisticEvent, UserProblemStatus
+from submission.models import JudgeStatus, Submission
+from submission.tests import SubmissionPrepare
+
+from .dispatcher import JudgeDispatcher
+from .scheduler import JudgeServerSlot
+
+
+@mock.patch("judge.dispatcher.JudgeDispatcher.release_judge_server")
+@mock.patch("judge.dispatcher.JudgeDispatcher._request_job", return_value=None)
+@mock.patch("judge.dispatcher.JudgeDispatcher.choose_judge_server",
+            return_value=JudgeServerSlot(id=1, service_url="http://judge-server:8080", lease="1:1"))
+class JudgeDispatcherSystemErrorTest(SubmissionPrepare):
+    # 评测机超时或者连接不上的时候，提交是系统错误，不计入任何统计信息
+    def setUp(self):
+        self._create_problem_and_submission()
+        self.user = self.create_user("test1", "test123", login=False)
+        Submission.objects.filter(id=self.submission.id).update(user_id=self.user.id)
+
+    def test_practice_system_error(self, *args):
+        JudgeDispatcher(self.submission.id, self.problem.id).judge()
+        self.assertEqual(Submission.objects.get(id=self.submission.id).result, JudgeStatus.SYSTEM_ERROR)
+        self.assertFalse(ProblemStatisticEvent.objects.exists())
+        self.assertFalse(UserProblemStatus.objects.filter(user_id=self.user.id).exists())
+        self.assertEqual(UserProfile.objects.get(user_id=self.user.id).submission_number, 0)
+
+    def test_contest_system_error(self, *args):
+        contest = Contest.objects.create(created_by=self.problem.created_by, **DEFAULT_CONTEST_DATA)
+        Problem.objects.filter(id=self.problem.id).update(contest=contest)
+        Submission.objects.filter(id=self.submission.id).update(contest=contest)
+        JudgeDispatcher(self.submission.id, self.problem.id).judge()
+        self.assertFalse(ACMContestRank.objects.filter(user_id=self.user.id).exists())
+        self.assertEqual(Problem.objects.get(id=self.problem.id).submission_number, 0)
+
+    def test_rejudge_after_system_error(self, *args):
+        # 之前计入统计信息的结果保留下来，重判的时候从这个结果改成新的结果，不会再算一次新的提交
+        Submission.objects.filter(id=self.submission.id).update(
+            result=JudgeStatus.WRONG_ANSWER, info={"err": None, "data": []})
+        JudgeDispatcher(self.submission.id, self.problem.id).judge()
+        self.assertEqual(JudgeDispatcher(self.submission.id, self.problem.id).last_result, JudgeStatus.WRONG_ANSWER)
+
+
+@mock.patch("judge.dispatcher.JudgeDispatcher.release_judge_server")
+@mock.patch("judge.dispatcher.JudgeDispatcher._request_job",
+            return_value={"err": None, "data": [{"test_case": "1", "result": 0, "cpu_time": 1, "memory": 1}]})
+@mock.patch("judge.dispatcher.JudgeDispatcher.choose_judge_server",
+            return_value=JudgeServerSlot(id=1, service_url="http://judge-server:8080", lease="1:1"))
+class JudgeDispatcherContestStatisticTest(SubmissionPrepare):
+    # 比赛题目的统计信息也通过增量事件批量合并，不再锁题目
+    def setUp(self):
+        self._create_problem_and_submission()
+        self.user = self.create_user("test1", "test123", login=False)
+        self.contest = Contest.objects.create(created_by=self.problem.created_by, **DEFAULT_CONTEST_DATA)
+        Problem.objects.filter(id=self.problem.id).update(contest=self.contest)
+        Submission.objects.filter(id=self.submission.id).update(user_id=self.user.id, contest=self.contest)
+
+    def test_contest_accepted(self, *args):
+        JudgeDispatcher(self.submission.id, self.problem.id).judge()
+        event = ProblemStatisticEvent.objects.get(problem_id=self.problem.id)
+        self.assertEqual((event.submission_number, event.accepted_number), (1, 1))
+        rank = ACMContestRank.objects.get(user_id=self.user.id, contest=self.contest)
+        self.assertTrue(rank.submission_info[str(self.problem.id)]["is_first_ac"])
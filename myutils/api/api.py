@@ -125,14 +125,9 @@ class APIView(View):
     def server_error(self):
         return self.error(err="server-error", msg="server error")
 
-    def paginate_data(self, request, query_set, object_serializer=None):
-        """
-        # 分页进行显示数据
-        :param request: django的request
-        :param query_set: django model的query set或者其他list like objects
-        :param object_serializer: 用来序列化query set, 如果为None, 则直接对query set切片
-        :return:
-        """
+    @staticmethod
+    def get_offset_limit(request):
+        # 从请求参数里面获取分页的offset和limit，不合法的时候使用默认值
         try:
             limit = int(request.GET.get("limit", "10"))
         except ValueError:
@@ -145,6 +140,17 @@ class APIView(View):
             offset = 0
         if offset < 0:
             offset = 0
+        return offset, limit
+
+    def paginate_data(self, request, query_set, object_serializer=None):
+        """
+        # 分页进行显示数据
+        :param request: django的request
+        :param query_set: django model的query set或者其他list like objects
+        :param object_serializer: 用来序列化query set, 如果为None, 则直接对query set切片
+        :return:
+        """
+        offset, limit = self.get_offset_limit(request)
         results = query_set[offset:offset + limit]
         if object_serializer:
             count = query_set.count()
@@ -12,10 +12,49 @@ class Choices:
 
 class CacheKey:
     # 缓存关键字
+    # 每个优先级一个等待队列：waiting_queue:contest等，见JudgeLane
     waiting_queue = "waiting_queue"
-    contest_rank_cache = "contest_rank_cache"
+    waiting_queue_wait_time = "waiting_queue_wait_time"
+    waiting_queue_weight = "waiting_queue_weight"
+    judge_latency = "judge_latency"
+    # 批量评判还没有开始评判的提交：judge_batch:批次id，见judge/dispatcher.py
+    judge_batch = "judge_batch"
+    # 比赛排名，见contest/scoreboard.py
+    contest_scoreboard = "contest_scoreboard"
+    contest_scoreboard_row = "contest_scoreboard_row"
+    contest_scoreboard_row_version = "contest_scoreboard_row_version"
+    contest_scoreboard_version = "contest_scoreboard_version"
+    contest_scoreboard_pending = "contest_scoreboard_pending"
+    contest_scoreboard_rebuild = "contest_scoreboard_rebuild"
+    contest_scoreboard_snapshot = "contest_scoreboard_snapshot"
+    contest_scoreboard_snapshot_lock = "contest_scoreboard_snapshot_lock"
+    contest_scoreboard_freeze_lock = "contest_scoreboard_freeze_lock"
     website_config = "website_config"
     option = "option"
+    option_version = "option_version"
+    # 令牌桶限流：throttling:用户id等，见myutils/throttling.py
+    throttling = "throttling"
+    # 评测机调度，见judge/scheduler.py
+    judge_server_load = "judge_server_load"
+    judge_server_capacity = "judge_server_capacity"
+    judge_server_heartbeat = "judge_server_heartbeat"
+    judge_server_url = "judge_server_url"
+    judge_server_lease = "judge_server_lease"
+    judge_server_lease_id = "judge_server_lease_id"
+    judge_server_reconcile = "judge_server_reconcile"
+    # 每台评测机的评测耗时直方图：judge_server_latency:评测机id
+    judge_server_latency = "judge_server_latency"
+    # 比赛题目第一个AC的用户：contest_first_ac:题目id
+    contest_first_ac = "contest_first_ac"
+    # 已经安排了题目统计信息的合并任务，见judge/statistics.py
+    problem_statistics_flush = "problem_statistics_flush"
+
+
+class JudgeLane(Choices):
+    # 评测的优先级，从高到低：正在进行的比赛、平时练习、重判和批量评测
+    CONTEST = "contest"
+    PRACTICE = "practice"
+    REJUDGE = "rejudge"
 
 
 class Difficulty(Choices):
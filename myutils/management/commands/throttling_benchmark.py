@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*-encoding:UTF-8-*-
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from myutils.cache import cache
+from myutils.shortcuts import rand_str
+from myutils.throttling import TokenBucket, consume
+
+
+class Command(BaseCommand):
+    """
+    令牌桶的性能测试，用多个线程模拟gunicorn的线程同时限流，输出每秒的操作数和延迟的分位数
+    python manage.py throttling_benchmark --threads=8 --requests=10000 --keys=100
+    """
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--requests", type=int, default=10000, help="每个线程的请求数")
+        parser.add_argument("--keys", type=int, default=100, help="不同的令牌桶的个数，越少竞争越激烈")
+        parser.add_argument("--multi", action="store_true", help="每次同时检查ip和用户两个令牌桶")
+
+    def handle(self, *args, **options):
+        threads = options["threads"]
+        requests = options["requests"]
+        keys = options["keys"]
+        prefix = f"benchmark:{rand_str()}"
+
+        def buckets(i):
+            # 容量足够大，测试的是限流本身的开销，不是被拒绝的比例
+            result = [TokenBucket(key=f"{prefix}:user:{i % keys}", capacity=10 ** 9, fill_rate=10 ** 9,
+                                  default_capacity=10 ** 9, redis_conn=cache)]
+            if options["multi"]:
+                result.append(TokenBucket(key=f"{prefix}:ip:{i % keys}", capacity=10 ** 9, fill_rate=10 ** 9,
+                                          default_capacity=10 ** 9, redis_conn=cache))
+            return result
+
+        def worker(n):
+            latencies = []
+            for i in range(requests):
+                bucket_list = buckets(n * requests + i)
+                start = time.perf_counter()
+                consume(bucket_list)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        # 预热：注册脚本、建立连接
+        consume(buckets(0))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = [item for result in executor.map(worker, range(threads)) for item in result]
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write(f"threads: {threads}, buckets per request: {len(buckets(0))}, requests: {len(latencies)}")
+        self.stdout.write(f"ops/sec: {len(latencies) / elapsed:.0f}")
+        self.stdout.write(f"latency p50: {percentile(0.5):.3f}ms, p99: {percentile(0.99):.3f}ms, "
+                          f"max: {latencies[-1] * 1000:.3f}ms")
+        # 测试用的令牌桶在填满之后（一两秒）会自动过期，不需要删除
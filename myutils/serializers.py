@@ -17,7 +17,7 @@ class LanguageNameChoiceField(serializers.CharField):
     # 提交代码的时候进行的语言选择字段
     def to_internal_value(self, data):
         data = super().to_internal_value(data)
-        if data and data not in SysOptions.language_names:
+        if data and data not in SysOptions.language_registry.name_set:
             raise InvalidLanguage(data)
         return data
 
@@ -26,7 +26,7 @@ class SPJLanguageNameChoiceField(serializers.CharField):
     # 特殊评判的语言选择字段
     def to_internal_value(self, data):
         data = super().to_internal_value(data)
-        if data and data not in SysOptions.spj_language_names:
+        if data and data not in SysOptions.language_registry.spj_name_set:
             raise InvalidLanguage(data)
         return data
 
@@ -36,7 +36,7 @@ class LanguageNameMultiChoiceField(serializers.ListField):
     def to_internal_value(self, data):
         data = super().to_internal_value(data)
         for item in data:
-            if item not in SysOptions.language_names:
+            if item not in SysOptions.language_registry.name_set:
                 raise InvalidLanguage(item)
         return data
 
@@ -46,6 +46,6 @@ class SPJLanguageNameMultiChoiceField(serializers.ListField):
     def to_internal_value(self, data):
         data = super().to_internal_value(data)
         for item in data:
-            if item not in SysOptions.spj_language_names:
+            if item not in SysOptions.language_registry.spj_name_set:
                 raise InvalidLanguage(item)
         return data
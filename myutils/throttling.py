@@ -1,98 +1,108 @@
 #!/usr/bin/env python
 # -*-encoding:UTF-8-*-
 # 扼杀限流类之令牌水桶
+#
+# 每个令牌桶是redis里面的一个哈希表（last_capacity：剩余的令牌数，last_timestamp：上一次更新的时间戳），
+# 填充和消耗令牌都在一个lua脚本里面完成，一次请求、原子执行，多个进程、线程同时消耗同一个桶也不会多发令牌。
+# 多个桶（例如ip和用户）可以在同一个脚本里面一起检查：所有的桶都有足够的令牌才一起消耗，否则都不消耗。
 
 import time
 
+from myutils.constants import CacheKey
+
+# 需要等待的最长时间（秒），填充速度是0的时候令牌不会恢复，lua算出来的等待时间是inf
+MAX_WAIT = 24 * 60 * 60
+
+# 先把每个桶填充到现在，再检查是不是所有的桶都有足够的令牌
+# 桶满了之后就不需要保存了，过期时间是填满需要的时间，所以不存在的桶就是满的桶，令牌数是容量
+# KEYS: 令牌桶1, 令牌桶2...
+# ARGV: 当前时间戳, 消耗的令牌数, 桶1的容量, 桶1的填充速度, 桶2的容量...
+# 返回: {是否成功(1/0), 需要等待的秒数（字符串，lua返回数字的时候会去掉小数部分）}
+CONSUME_SCRIPT = """
+local now = tonumber(ARGV[1])
+local num = tonumber(ARGV[2])
+local tokens = {}
+local wait = 0
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[1 + 2 * i])
+    local fill_rate = tonumber(ARGV[2 + 2 * i])
+    local bucket = redis.call('HMGET', KEYS[i], 'last_capacity', 'last_timestamp')
+    local current = capacity
+    if bucket[1] then
+        local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+        current = math.min(capacity, tonumber(bucket[1]) + elapsed * fill_rate)
+    end
+    tokens[i] = current
+    if current < num then
+        wait = math.max(wait, (num - current) / fill_rate)
+    end
+end
+local allowed = wait == 0
+for i = 1, #KEYS do
+    local left = tokens[i]
+    if allowed then
+        left = left - num
+    end
+    redis.call('HMSET', KEYS[i], 'last_capacity', left, 'last_timestamp', now)
+    local fill_rate = tonumber(ARGV[2 + 2 * i])
+    if fill_rate > 0 then
+        redis.call('EXPIRE', KEYS[i], math.max(1, math.ceil((tonumber(ARGV[1 + 2 * i]) - left) / fill_rate) + 1))
+    end
+end
+if allowed then
+    return {1, '0'}
+end
+return {0, tostring(wait)}
+"""
+
+
 class TokenBucket:
     """
-    注意：对于单个key的操作不是线程安全的
+    令牌桶，consume在redis里面原子执行，可以在多个进程、线程里面同时使用
     """
+    _consume_script = None
+
     def __init__(self, key, capacity, fill_rate, default_capacity, redis_conn):
         """
         构造函数初始化
         :param key: 秘钥
         :param capacity: 最大容量
         :param fill_rate: 填充速度/s
-        :param default_capacity: 初始容量
+        :param default_capacity: 初始容量，已经不再使用：满的桶会过期删除，不存在的桶当成满的桶，
+                                 新的桶也从满的开始，否则空闲了一段时间的用户回来之后只有初始容量
         :param redis_conn: redis connection
         """
-        self._key = key
+        self._key = f"{CacheKey.throttling}:{key}"
         self._capacity = capacity
         self._fill_rate = fill_rate
         self._default_capacity = default_capacity
         self._redis_conn = redis_conn
 
-        self._last_capacity_key = "last_capacity"
-        self._last_timestamp_key = "last_timestamp"
-
-    def _init_key(self):
-        """
-        初始化关键字
-        :return: 默认的容量和事件
-        """
-        self._last_capacity = self._default_capacity
-        now = time.time()
-        self._last_timestamp = now
-        return self._default_capacity,now
-
-
-    @property
-    def _last_capacity(self):
-        """
-        设置上一次的存储最大容量
-        :return:
-        """
-        last_capacity = self._redis_conn.hget(self._key, self._last_capacity_key)
-        if last_capacity is None:
-            return self._init_key()[0]
-        else:
-            return float(last_capacity)
-
-    @_last_capacity.setter
-    def _last_capacity(self, value):
-        self._redis_conn.hset(self._key, self._last_capacity_key, value)
-
-    @property
-    def _last_timestamp(self):
-        """
-        上一次的时间戳
-        :return:
-        """
-        return float(self._redis_conn.hget(self._key, self._last_capacity_key))
-
-    @_last_timestamp.setter
-    def _last_timestamp(self, value):
-        self._redis_conn.hset(self._key, self._last_capacity_key, value)
-
-    def _try_to_fill(self, now):
-        """
-        尝试填充,单位是秒
-        :param now:
-        :return: 返回一个用时最少的
-        """
-        delta = self._fill_rate * (now - self._last_timestamp)
-        return min(self._last_capacity + delta, self._capacity)
-
     def consume(self, num=1):
         """
         消耗num个token，返回是否成功
-        双因素验证工具类
         :param num:
         :return: result:boolean, wait_time:float
         """
-        # print("capacity ",self.fill(time.time()))
-        if self._last_capacity >= num:
-            self._last_capacity -= num
-            return True, 0
-        else:
-            # 获取当前时间
-            now = time.time()
-            cur_num = self._try_to_fill(now)
-            if cur_num >= num:
-                self._last_capacity = cur_num - num
-                self._last_timestamp = now
-                return True, 0
-            else:
-                # 保证生成同一个hash
-                return False, (num - cur_num) / self._fill_rate
+        return consume([self], num)
+
+
+def consume(buckets, num=1):
+    """
+    在一次请求里面从多个令牌桶各消耗num个token，所有的桶都有足够的令牌才会消耗，
+    所有的桶需要使用同一个redis connection
+    :param buckets: TokenBucket的列表
+    :param num:
+    :return: result:boolean, wait_time:float，失败的时候是令牌最少的桶需要等待的时间，最多MAX_WAIT
+    """
+    if not buckets:
+        return True, 0
+    redis_conn = buckets[0]._redis_conn
+    if TokenBucket._consume_script is None:
+        TokenBucket._consume_script = redis_conn.register_script(CONSUME_SCRIPT)
+    args = [time.time(), num]
+    for bucket in buckets:
+        args.extend([bucket._capacity, bucket._fill_rate])
+    allowed, wait = TokenBucket._consume_script(keys=[bucket._key for bucket in buckets], args=args,
+                                                client=redis_conn)
+    return bool(allowed), min(float(wait), MAX_WAIT)
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*-encoding:UTF-8-*-
 
+import copy
+import hashlib
+import json
 import os
+import time
+
 from django.core.cache import cache
 from django.db import transaction, IntegrityError
 
@@ -29,6 +34,7 @@ class OptionKeys:
     judge_server_token = "judge_server_token"
     throttling = "throttling"
     languages = "languages"
+    judge_lanes = "judge_lanes"
 
 
 class OprionDefaultValue:
@@ -50,6 +56,93 @@ class OprionDefaultValue:
     throttling = {"ip": {"capacity": 100, "fill_rate": 0.1, "default_capacity": 50},
                   "user": {"capacity": 20, "fill_rate": 0.03, "default_capacity": 10}}
     languages = languages
+    # 评测优先级：每个优先级的等待队列的调度权重，以及为比赛预留的评测机槽位数（其他优先级不能占用）
+    judge_lanes = {"weights": {"contest": 6, "practice": 3, "rejudge": 1}, "contest_reserved_slots": 2}
+
+
+# 系统选项有两级缓存：
+#   进程内的字典，读取选项的时候直接返回，不访问redis
+#   redis里面的option:键，进程内没有缓存的时候读取，再没有才查询数据库
+# 修改选项的时候删除redis里面的缓存，并修改redis里面的版本号（CacheKey.option_version），
+# 每个进程最多每LOCAL_CACHE_CHECK_INTERVAL秒检查一次版本号，版本号变了就清空进程内的缓存，
+# 所以一个进程修改的选项最多LOCAL_CACHE_CHECK_INTERVAL秒之后所有的进程都能看到。
+# 进程内的缓存检查版本号的间隔（秒）
+LOCAL_CACHE_CHECK_INTERVAL = 1
+# redis里面的缓存时间（秒），修改选项的时候会主动删除，这里只是防止直接修改了数据库的时候一直读取旧的值
+CACHE_TIMEOUT = 60 * 60
+
+
+class _LocalOptionCache(object):
+    # 进程内的选项缓存
+    def __init__(self):
+        self.values = {}
+        self.version = None
+        self.checked_at = 0
+
+    def check_version(self):
+        now = time.monotonic()
+        if now - self.checked_at < LOCAL_CACHE_CHECK_INTERVAL:
+            return
+        # 先读取版本号再读取选项，读取的过程中选项被修改的话，下一次检查的时候版本号已经变了，不会一直使用旧的值
+        version = cache.get(CacheKey.option_version)
+        if version != self.version:
+            self.values.clear()
+            self.version = version
+        self.checked_at = now
+
+    def get(self, option_key, default=None):
+        value = self.values.get(option_key, default)
+        # 字典和列表返回副本，调用者修改返回值（例如去掉smtp_config的密码）不会影响缓存
+        if isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+        return value
+
+    def clear(self):
+        self.values.clear()
+        self.checked_at = 0
+
+
+_local_cache = _LocalOptionCache()
+_missing = object()
+# 进程内缓存里面保存语言索引使用的键，和选项一样在版本号变化的时候清空
+_LANGUAGE_REGISTRY_KEY = "__language_registry"
+
+
+class LanguageRegistry(object):
+    """
+    按照名字索引的语言配置，根据SysOptions.languages生成，每个选项版本在每个进程里面只生成一次，
+    评判、特殊评判的编译、序列化器的校验和语言列表的接口共用。
+    同一个对象在多个请求之间共享，名字是不可变的tuple和frozenset，配置只通过返回副本的方法读取，
+    调用者修改拿到的配置不会影响其他请求
+    """
+    def __init__(self, languages):
+        self._languages = languages
+        self._spj_languages = [item for item in languages if "spj" in item]
+        # 语言名字 -> 发送给评测机的配置（编译和运行）
+        self._configs = {item["name"]: item["config"] for item in languages}
+        # 语言名字 -> 特殊评判的配置（编译和运行）
+        self._spj_configs = {item["name"]: item["spj"] for item in self._spj_languages}
+        self.names = tuple(item["name"] for item in languages)
+        self.spj_names = tuple(item["name"] for item in self._spj_languages)
+        self.name_set = frozenset(self.names)
+        self.spj_name_set = frozenset(self.spj_names)
+        # 语言列表接口的完整响应，序列化一次之后直接返回，ETag是内容的摘要
+        data = {"languages": languages, "spj_languages": self._spj_languages}
+        self.response_body = json.dumps({"error": None, "data": data}).encode("utf-8")
+        self.etag = '"%s"' % hashlib.sha1(self.response_body).hexdigest()
+
+    @property
+    def spj_languages(self):
+        return copy.deepcopy(self._spj_languages)
+
+    def config(self, name):
+        # 语言不存在的时候抛出KeyError
+        return copy.deepcopy(self._configs[name])
+
+    def spj_config(self, name, default=None):
+        if name not in self._spj_configs:
+            return default
+        return copy.deepcopy(self._spj_configs[name])
 
 
 class _SysOptionsMeta(type):
@@ -58,11 +151,14 @@ class _SysOptionsMeta(type):
     # 本类使用缓存的机制包括设置、删除、获取和重建
     @classmethod
     def _set_cache(mcs, option_key, option_value):
-        cache.set(f"{CacheKey.option}:{option_key}", option_value, timeout=60)
+        cache.set(f"{CacheKey.option}:{option_key}", option_value, timeout=CACHE_TIMEOUT)
 
     @classmethod
     def _del_cache(mcs, option_key):
+        # 删除redis里面的缓存，修改版本号让所有进程清空进程内的缓存
         cache.delete(f"{CacheKey.option}:{option_key}")
+        cache.set(CacheKey.option_version, rand_str(), timeout=None)
+        _local_cache.clear()
 
     @classmethod
     def _get_keys(cls):
@@ -90,17 +186,23 @@ class _SysOptionsMeta(type):
     @classmethod
     def _get_option(mcs, option_key, use_cache=True):
         # 获取选项，私有方法，对系统的选项的查询时候会被调用
-        # 首先会尝试查看缓存，如果缓存存在对应的值就直接使用缓存返回，否则才查找数据库
+        # 首先会尝试查看进程内的缓存和redis里面的缓存，如果缓存存在对应的值就直接使用缓存返回，否则才查找数据库
         try:
             if use_cache:
-                option = cache.get(f"{CacheKey.option}:{option_key}")
-                if option:
+                _local_cache.check_version()
+                option = _local_cache.get(option_key, _missing)
+                if option is not _missing:
                     return option
+                option = cache.get(f"{CacheKey.option}:{option_key}", _missing)
+                if option is not _missing:
+                    _local_cache.values[option_key] = option
+                    return _local_cache.get(option_key)
             # 首先是根据穿过来的key查找数据库，如果找到就得到value，同时设置一下缓存，方便下一次快速调用
             option = SysOptionsModel.objects.get(key=option_key)
             value = option.value
             mcs._set_cache(option_key, value)
-            return value
+            _local_cache.values[option_key] = value
+            return _local_cache.get(option_key)
         except SysOptionsModel.DoesNotExist:
             mcs._init_option()
             return mcs._get_option(option_key, use_cache=use_cache)
@@ -115,6 +217,8 @@ class _SysOptionsMeta(type):
                 option.value = option_value
                 option.save()
                 mcs._del_cache(option_key)
+                # 事务提交之后再删除一次，其他进程可能在提交之前读取了旧的值重新写入缓存
+                transaction.on_commit(lambda: mcs._del_cache(option_key))
         except SysOptionsModel.DoesNotExist:
             mcs._init_option()
             mcs._set_option(option_key, option_value)
@@ -130,6 +234,7 @@ class _SysOptionsMeta(type):
                 option.value = value
                 option.save()
                 mcs._del_cache(option_key)
+                transaction.on_commit(lambda: mcs._del_cache(option_key))
         except SysOptionsModel.DoesNotExist:
             mcs._init_option()
             return mcs._increment(option_key)
@@ -229,20 +334,38 @@ class _SysOptionsMeta(type):
     def languages(cls, value):
         cls._set_option(OptionKeys.languages, value)
 
+    @property
+    def judge_lanes(cls):
+        return cls._get_option(OptionKeys.judge_lanes)
+
+    @judge_lanes.setter
+    def judge_lanes(cls, value):
+        cls._set_option(OptionKeys.judge_lanes, value)
+
+    @property
+    def language_registry(cls):
+        # 语言配置的索引，和选项共用进程内的缓存，语言修改之后重新生成
+        _local_cache.check_version()
+        registry = _local_cache.values.get(_LANGUAGE_REGISTRY_KEY)
+        if registry is None:
+            registry = LanguageRegistry(cls.languages)
+            _local_cache.values[_LANGUAGE_REGISTRY_KEY] = registry
+        return registry
+
     # 问题模块中的序列化器会用到下面的属性
     @property
     def spj_languages(cls):
         # spj的默认语言是和系统的默认语言有关
         # 遍历本类的语言属性，获取含有spj的item
-        return [item for item in cls.languages if "spj" in item]
+        return cls.language_registry.spj_languages
 
     @property
     def language_names(cls):
-        return [item["name"] for item in languages]
+        return list(cls.language_registry.names)
 
     @property
     def spj_language_names(cls):
-        return [item["name"] for item in cls.languages if "spj" in item]
+        return list(cls.language_registry.spj_names)
 
     def reset_languages(cls):
         # 重新设置语言
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('problem', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProblemStatisticEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('submission_number', models.IntegerField(default=0)),
+                ('accepted_number', models.IntegerField(default=0)),
+                ('statistic_info', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('problem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='problem.Problem')),
+            ],
+            options={
+                'db_table': 'problem_statistic_event',
+                'ordering': ('id',),
+            },
+        ),
+    ]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# 把UserProfile里面的acm_problems_status和oi_problems_status转换成UserProblemStatus
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# AC的状态，和submission.models.JudgeStatus.ACCEPTED一致
+ACCEPTED = 0
+BATCH_SIZE = 1000
+
+
+def forwards(apps, schema_editor):
+    UserProfile = apps.get_model("account", "UserProfile")
+    Problem = apps.get_model("problem", "Problem")
+    UserProblemStatus = apps.get_model("problem", "UserProblemStatus")
+    # 题目id -> 比赛id，已经删除的题目不再转换
+    problem_contest = dict(Problem.objects.values_list("id", "contest_id"))
+    batch = []
+    for profile in UserProfile.objects.only("user_id", "acm_problems_status", "oi_problems_status").iterator():
+        rows = {}
+        for problems_status in (profile.acm_problems_status or {}, profile.oi_problems_status or {}):
+            for key in ("problems", "contest_problems"):
+                for problem_id, info in problems_status.get(key, {}).items():
+                    problem_id = int(problem_id)
+                    if problem_id not in problem_contest:
+                        continue
+                    # 题目的规则改过的话可能在两个字段里面都有，保留AC的那一个
+                    if problem_id in rows and rows[problem_id].status == ACCEPTED:
+                        continue
+                    rows[problem_id] = UserProblemStatus(user_id=profile.user_id, problem_id=problem_id,
+                                                         contest_id=problem_contest[problem_id],
+                                                         status=info["status"], score=info.get("score", 0))
+        batch.extend(rows.values())
+        if len(batch) >= BATCH_SIZE:
+            UserProblemStatus.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        UserProblemStatus.objects.bulk_create(batch)
+
+
+def backwards(apps, schema_editor):
+    UserProfile = apps.get_model("account", "UserProfile")
+    UserProblemStatus = apps.get_model("problem", "UserProblemStatus")
+    profiles = {}
+    for item in UserProblemStatus.objects.select_related("problem").order_by("user_id").iterator():
+        profile = profiles.setdefault(item.user_id, {"acm_problems_status": {}, "oi_problems_status": {}})
+        key = "contest_problems" if item.contest_id else "problems"
+        info = {"status": item.status, "_id": item.problem._id}
+        if item.problem.rule_type == "ACM":
+            profile["acm_problems_status"].setdefault(key, {})[str(item.problem_id)] = info
+        else:
+            info["score"] = item.score
+            profile["oi_problems_status"].setdefault(key, {})[str(item.problem_id)] = info
+    for user_id, fields in profiles.items():
+        UserProfile.objects.filter(user_id=user_id).update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0001_initial'),
+        ('problem', '0003_userproblemstatus'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
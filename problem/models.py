@@ -89,3 +89,37 @@ class Problem(models.Model):
         #  计数器，每次ac一题，数目+1，增加通过的数目，当self.accepted_number=1时，是首次AC
         self.accepted_number = models.F("accepted_number") + 1
         self.save(update_fields=["accepted_number"])
+
+
+class ProblemStatisticEvent(models.Model):
+    # 题目统计信息的增量事件，评判完成的时候和用户信息在同一个事务里面写入，只插入不更新，不需要锁题目
+    # 由judge/statistics.py里面的flush_problem_statistics定期合并到题目的计数器里面，合并之后删除
+    id = models.BigAutoField(primary_key=True)
+    problem = models.ForeignKey(Problem, on_delete=models.CASCADE)
+    submission_number = models.IntegerField(default=0)
+    accepted_number = models.IntegerField(default=0)
+    # 每种评判结果的数目的变化，格式和Problem.statistic_info一样，例如{"0": 1, "-1": -1}
+    statistic_info = JSONField(default=dict)
+    create_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "problem_statistic_event"
+        ordering = ("id",)
+
+
+class UserProblemStatus(models.Model):
+    # 用户做题的状态，代替之前UserProfile里面的acm_problems_status和oi_problems_status两个json字段，
+    # 每个用户每道题目一行，评判完成的时候只更新这一行，题目列表只查询当前页的题目
+    # 比赛的题目也是单独的Problem，contest就是题目所在的比赛，普通题目是null
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    problem = models.ForeignKey(Problem, on_delete=models.CASCADE)
+    contest = models.ForeignKey(Contest, null=True, on_delete=models.CASCADE)
+    # 最好的评判结果，AC之后就不再改变
+    status = models.IntegerField()
+    # OI题目的得分，ACM题目是0
+    score = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "user_problem_status"
+        unique_together = (("user", "problem"),)
+        index_together = (("user", "contest"),)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*-encoding:UTF-8-*-
+# 按照内容寻址的测试用例存储
+#
+# /data/test_case/blobs/ab/ab12...   测试用例文件按照内容的sha256存放，相同内容的文件只存一份
+# /data/test_case/test_case_id/      测试用例清单：info文件和指向blob的硬链接（1.in，1.out……），
+#                                    info["blobs"]记录了每个文件对应的blob
+#
+# 评测机还是按照test_case_id/info和test_case_id/1.in读取测试用例，不需要任何修改，
+# 同步到评测机的时候使用rsync -H保留硬链接，相同的文件也只传输一次。
+# test_case_id是清单内容（info和每个文件的sha256）的摘要，重复上传、导入相同的测试用例得到的是同一个test_case_id，
+# 多道题目（例如复制到比赛的题目）可以共用一个test_case_id，引用计数就是使用这个test_case_id的题目数，
+# blob的引用计数就是文件的硬链接数，只剩下blobs里面这一个链接的时候就可以删除了。
+# 创建清单（已经存在的话更新修改时间）和删除清单、回收文件都在存储目录的文件锁里面进行，
+# 删除的时候重新检查引用和修改时间，不会删除刚刚被add返回、还没有保存到题目的测试用例。
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from myutils.shortcuts import rand_str
+from .models import Problem
+
+# 上传之后还没有保存到题目的测试用例，在这段时间（秒）之内不会因为没有被题目引用而被删除
+UNREFERENCED_GRACE_PERIOD = 24 * 60 * 60
+# test_case_id的格式，测试用例目录下面的blobs、临时目录这些都不是测试用例
+TEST_CASE_ID_RE = re.compile(r"^[a-zA-Z0-9]{32}$")
+
+
+def is_valid_test_case_id(test_case_id):
+    return bool(test_case_id and TEST_CASE_ID_RE.match(test_case_id))
+
+
+class TestCaseStore(object):
+    def __init__(self, base_dir=None):
+        self._base_dir = base_dir
+
+    @property
+    def base_dir(self):
+        return self._base_dir or settings.TEST_CASE_DIR
+
+    @property
+    def blob_dir(self):
+        return os.path.join(self.base_dir, "blobs")
+
+    @contextmanager
+    def _lock(self):
+        # 同一台机器上所有进程共用的排它锁，不能嵌套使用
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(os.path.join(self.base_dir, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def put_blob(self, content):
+        # 保存一个测试用例文件，返回内容的sha256，已经存在的话不再重复写入
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            # 更新修改时间，避免在创建清单之前被gc当成没有引用的文件删除
+            os.utime(path)
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再rename，其他进程不会看到写了一半的文件
+        tmp_path = f"{path}.{rand_str()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o640)
+        os.rename(tmp_path, path)
+        return digest
+
+    def add(self, test_case_info, blobs):
+        """
+        创建测试用例清单
+        :param test_case_info: 写入info文件的测试用例信息
+        :param blobs: 文件名 -> put_blob返回的sha256
+        :return: test_case_id
+        """
+        test_case_info = dict(test_case_info, blobs=blobs)
+        manifest = json.dumps(test_case_info, sort_keys=True)
+        test_case_id = hashlib.sha256(manifest.encode("utf-8")).hexdigest()[:32]
+        test_case_dir = os.path.join(self.base_dir, test_case_id)
+        with self._lock():
+            if os.path.isdir(test_case_dir):
+                # 相同的测试用例已经存在，更新修改时间，避免在保存题目之前被当成没有引用的测试用例删除
+                os.utime(test_case_dir)
+                return test_case_id
+
+        tmp_dir = os.path.join(self.base_dir, f"tmp-{rand_str()}")
+        os.mkdir(tmp_dir)
+        try:
+            for name, digest in blobs.items():
+                os.link(self._blob_path(digest), os.path.join(tmp_dir, name))
+            with open(os.path.join(tmp_dir, "info"), "w", encoding="utf-8") as f:
+                f.write(json.dumps(test_case_info, indent=4))
+            os.chmod(os.path.join(tmp_dir, "info"), 0o640)
+            os.chmod(tmp_dir, 0o710)
+            with self._lock():
+                if os.path.isdir(test_case_dir):
+                    # 同时上传相同的测试用例，另一个请求已经创建好了
+                    os.utime(test_case_dir)
+                else:
+                    os.rename(tmp_dir, test_case_dir)
+        finally:
+            # 已经rename的话临时目录不存在了，什么都不做
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return test_case_id
+
+    def add_dir(self, path):
+        # 将一个普通的测试用例目录（info和测试用例文件）存入，返回test_case_id，用于FPS导入和旧数据的转换
+        with open(os.path.join(path, "info"), encoding="utf-8") as f:
+            test_case_info = json.load(f)
+        test_case_info.pop("blobs", None)
+        blobs = {}
+        for entry in os.scandir(path):
+            if entry.is_file() and entry.name != "info":
+                with open(entry.path, "rb") as f:
+                    blobs[entry.name] = self.put_blob(f.read())
+        return self.add(test_case_info, blobs)
+
+    def is_referenced(self, test_case_id):
+        return Problem.objects.filter(test_case_id=test_case_id).exists()
+
+    def release(self, test_case_id):
+        # 题目删除、清理没有归属的测试用例的时候调用，没有其他题目使用这个测试用例的话就删除清单和不再被引用的文件
+        # 引用和修改时间在锁里面检查，和add互斥，刚刚被add返回的测试用例不会被删除
+        # 不是test_case_id格式的（例如blobs、../x）不能当成测试用例目录删除
+        if not is_valid_test_case_id(test_case_id):
+            return
+        test_case_dir = os.path.join(self.base_dir, test_case_id)
+        with self._lock():
+            if self.is_referenced(test_case_id):
+                return
+            try:
+                if time.time() - os.stat(test_case_dir).st_mtime < UNREFERENCED_GRACE_PERIOD:
+                    return
+            except OSError:
+                return
+            self._delete(test_case_id)
+
+    def delete(self, test_case_id):
+        # 删除清单，然后回收这个清单引用的、已经没有其他清单引用的文件
+        if not is_valid_test_case_id(test_case_id):
+            raise ValueError(f"Invalid test case id: {test_case_id}")
+        with self._lock():
+            self._delete(test_case_id)
+
+    def _delete(self, test_case_id):
+        test_case_dir = os.path.join(self.base_dir, test_case_id)
+        if not os.path.isdir(test_case_dir):
+            return
+        # 旧的测试用例目录没有blobs，直接删除就可以了
+        try:
+            with open(os.path.join(test_case_dir, "info"), encoding="utf-8") as f:
+                digests = set(json.load(f).get("blobs", {}).values())
+        except (OSError, ValueError):
+            digests = set()
+        shutil.rmtree(test_case_dir, ignore_errors=True)
+        for digest in digests:
+            self._collect_blob(digest)
+
+    def _collect_blob(self, digest):
+        path = self._blob_path(digest)
+        try:
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def gc(self):
+        # 删除所有没有被任何清单引用的文件，返回删除的个数
+        # 最近写入的文件可能正在创建清单，暂时不删除，写了一半的临时文件也一起清理
+        count = 0
+        if not os.path.isdir(self.blob_dir):
+            return count
+        now = time.time()
+        with self._lock():
+            for prefix in os.scandir(self.blob_dir):
+                for entry in os.scandir(prefix.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if stat.st_nlink == 1 and now - stat.st_mtime > UNREFERENCED_GRACE_PERIOD:
+                        os.remove(entry.path)
+                        count += 1
+        return count
+
+
+test_case_store = TestCaseStore()
@@ -1,6 +1,7 @@
 from django.test import TestCase
 import copy
 import hashlib
+import json
 import os
 import shutil
 from datetime import timedelta
@@ -11,11 +12,13 @@ from django.conf import settings
 from myutils.api.tests import APITestCase
 
 from .models import ProblemTag
-from .models import Problem, ProblemRuleType
+from .models import Problem, ProblemRuleType, ProblemStatisticEvent, UserProblemStatus
 from contest.models import Contest
 # 导入默认的比赛数据
 from contest.tests import DEFAULT_CONTEST_DATA
+from judge.statistics import flush_problem_statistics
 
+from .test_case_store import test_case_store
 from .views.viadmin import TestCaseAPI
 from .utils import parse_problem_template
 
@@ -163,6 +166,29 @@ class TestCaseUploadAPITest(APITestCase):
                 with open(os.path.join(test_case_dir, name), "r", encoding="utf-8") as f:
                     self.assertEqual(f.read(), name + "\n" + name + "\n" + "end")
 
+    def test_upload_same_test_case_zip(self):
+        # 相同的测试用例重复上传得到的是同一个test_case_id，文件只保存一份
+        ids = []
+        for _ in range(2):
+            with open(self.make_test_case_zip(), "rb") as f:
+                resp = self.client.post(self.url, data={"spj": "false", "file": f}, format="multipart")
+                self.assertSuccess(resp)
+                ids.append(resp.data["data"]["id"])
+        self.assertEqual(ids[0], ids[1])
+        test_case_dir = os.path.join(settings.TEST_CASE_DIR, ids[0])
+        with open(os.path.join(test_case_dir, "info"), encoding="utf-8") as f:
+            blob = test_case_store._blob_path(json.load(f)["blobs"]["1.in"])
+        self.assertTrue(os.path.samefile(blob, os.path.join(test_case_dir, "1.in")))
+
+        # 刚刚上传、还没有保存到题目的测试用例不会被释放
+        test_case_store.release(ids[0])
+        self.assertTrue(os.path.exists(test_case_dir))
+
+        # 没有题目使用之后删除清单，只被它引用的文件也一起删除
+        test_case_store.delete(ids[0])
+        self.assertFalse(os.path.exists(test_case_dir))
+        self.assertFalse(os.path.exists(blob))
+
 
 class ProblemAdminAPITest(APITestCase):
     # 管理员管理题目
@@ -226,7 +252,7 @@ class ProblemAPITest(ProblemCreateTestBase):
         self.url = self.reverse("problem_api")
         admin = self.create_admin(login=False)
         self.problem = self.add_problem(DEFAULT_PROBLEM_DATA, admin)
-        self.create_user("test", "test123")
+        self.user = self.create_user("test", "test123")
 
     # 普通用户的权限就仅限于查看题目列表，每次查10条和查看单个题目信息
     def test_get_problem_list(self):
@@ -238,6 +264,35 @@ class ProblemAPITest(ProblemCreateTestBase):
         resp = self.client.get(self.url + "?problem_id=" + self.problem._id)
         self.assertSuccess(resp)
 
+    def test_get_problem_list_with_status(self):
+        # 做过的题目有my_status
+        UserProblemStatus.objects.create(user=self.user, problem=self.problem, status=0)
+        resp = self.client.get(f"{self.url}?limit=10")
+        self.assertSuccess(resp)
+        self.assertEqual(resp.data["data"]["results"][0]["my_status"], 0)
+
+
+class ProblemStatisticsFlushTest(ProblemCreateTestBase):
+    # 题目统计信息的增量事件合并测试
+    def setUp(self):
+        admin = self.create_admin(login=False)
+        self.problem = self.add_problem(DEFAULT_PROBLEM_DATA, admin)
+
+    def test_flush_problem_statistics(self):
+        ProblemStatisticEvent.objects.create(problem=self.problem, submission_number=1, accepted_number=1,
+                                             statistic_info={"0": 1})
+        ProblemStatisticEvent.objects.create(problem=self.problem, submission_number=1, statistic_info={"-1": 1})
+        ProblemStatisticEvent.objects.create(problem=self.problem, accepted_number=1,
+                                             statistic_info={"-1": -1, "0": 1})
+        self.assertEqual(flush_problem_statistics(), 3)
+        problem = Problem.objects.get(id=self.problem.id)
+        self.assertEqual(problem.submission_number, 2)
+        self.assertEqual(problem.accepted_number, 2)
+        self.assertEqual(problem.statistic_info, {"0": 2, "-1": 0})
+        # 已经合并的事件不会再合并一次
+        self.assertFalse(ProblemStatisticEvent.objects.exists())
+        self.assertEqual(flush_problem_statistics(), 0)
+
 
 class ContestProblemAdminTest(APITestCase):
     def setUp(self):
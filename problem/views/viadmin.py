@@ -3,7 +3,6 @@
 import hashlib
 import json
 import os
-import shutil
 import tempfile
 import zipfile
 from wsgiref.util import FileWrapper
@@ -24,6 +23,7 @@ from myutils.constants import Difficulty
 from myutils.shortcuts import rand_str, natural_sort_key
 from myutils.tasks import delete_files
 from ..models import Problem, ProblemRuleType, ProblemTag
+from ..test_case_store import test_case_store
 from ..serializers import (CreateContestProblemSerializer, CompileSPJSerializer,
                            CreateProblemSerializer, EditProblemSerializer, EditContestProblemSerializer,
                            ProblemAdminSerializer, TestCaseUploadForm, ContestProblemMakePublicSerializer,
@@ -56,26 +56,21 @@ class TestCaseZipProcessor(object):
         if not test_case_list:
             raise APIError("Empty file")
 
-        # 创建测试用例文件夹同时更改文件夹权限
-        test_case_id = rand_str()
-        test_case_dir = os.path.join(settings.TEST_CASE_DIR, test_case_id)    # /data/test_case/test_case_id
-        os.mkdir(test_case_dir)
-        os.chmod(test_case_dir, 0o710)
-
         # 设置缓存
         size_cache = {}     # 如果是spj，作为input_size
         md5_cache = {}
+        # 文件名 -> 文件内容的sha256，测试用例文件按照内容存放，相同的文件只存一份
+        blobs = {}
 
         for item in test_case_list:
-            with open(os.path.join(test_case_dir, item), "wb") as f:
-                # 拼接路径,例如：/data/test_case/test_case_id/1.in
-                content = zip_file.read(f"{dir}{item}").replace(b"\r\n", b"\n")
-                # 设置内容的大小
-                size_cache[item] = len(content)     # 最终如果是spj, 用于内容的输入大小说明
-                if item.endswith(".out"):
-                    # 这个是对于普通评判来说，因为特殊评判没有.out文件，同时要生成摘要保存在字典先
-                    md5_cache[item] = hashlib.md5(content.rstrip()).hexdigest()
-                f.write(content)            # 1.in \n 1.in\n
+            # 拼接路径,例如：{dir}1.in
+            content = zip_file.read(f"{dir}{item}").replace(b"\r\n", b"\n")
+            # 设置内容的大小
+            size_cache[item] = len(content)     # 最终如果是spj, 用于内容的输入大小说明
+            if item.endswith(".out"):
+                # 这个是对于普通评判来说，因为特殊评判没有.out文件，同时要生成摘要保存在字典先
+                md5_cache[item] = hashlib.md5(content.rstrip()).hexdigest()
+            blobs[item] = test_case_store.put_blob(content)            # 1.in \n 1.in\n
 
         # 设置测试用例备用
         test_case_info = {"spj": spj, "test_cases": {}}
@@ -102,16 +97,9 @@ class TestCaseZipProcessor(object):
                 info.append(data)
                 test_case_info["test_cases"][str(index + 1)] = data
 
-        # 真正打开Info文件的时候，将test_case_info写入到info文件里面去
-        with open(os.path.join(test_case_dir, "info"), "w", encoding="utf-8") as f:
-            f.write(json.dumps(test_case_info, indent=4))
-
-        # 对于每个文件# /data/test_case/test_case_id都更改权限
-        #               -1.in
-        #               -1.out
-        #               -info
-        for item in os.listdir(test_case_dir):
-            os.chmod(os.path.join(test_case_dir, item), 0o640)
+        # 创建测试用例清单：/data/test_case/test_case_id/info和指向文件的硬链接
+        # test_case_id是清单内容的摘要，相同的测试用例重复上传得到的是同一个test_case_id
+        test_case_id = test_case_store.add(test_case_info, blobs)
 
         #返回信息文件和测试用例ID
         return info, test_case_id
@@ -372,10 +360,9 @@ class ProblemAPI(ProblemBase):
         ensure_created_by(problem, request.user)
         if Submission.objects.filter(problem=problem).exists():
             return self.error("Can't delete the problem as it has submissions")
-        d = os.path.join(settings.TEST_CASE_DIR, problem.test_case_id)
-        if os.path.isdir(d):
-            shutil.rmtree(d, ignore_errors=True)
         problem.delete()
+        # 测试用例可能被其他题目共用，没有题目再使用的时候才删除
+        test_case_store.release(problem.test_case_id)
         return self.success()
 
 
@@ -507,10 +494,9 @@ class ContestProblemAPI(ProblemBase):
         ensure_created_by(problem.contest, request.user)
         if Submission.objects.filter(problem=problem).exists():
             return self.error("Can't delete the problem as it has submissions")
-        d = os.path.join(settings.TEST_CASE_DIR, problem.test_case_id)
-        if os.path.isdir(d):
-            shutil.rmtree(d, ignore_errors=True)
         problem.delete()
+        # 测试用例可能被其他题目共用，没有题目再使用的时候才删除
+        test_case_store.release(problem.test_case_id)
         return self.success()
 
 
@@ -659,7 +645,7 @@ class ImportProblemAPI(CSRFExemptAPIView, TestCaseZipProcessor):            # ==
                         else:
                             problem_info = serializer.data
                             for item in problem_info["template"].keys():
-                                if item not in SysOptions.language_names:
+                                if item not in SysOptions.language_registry.name_set:
                                     return self.error(f"Unsupported language {item}")
 
                         problem_info["display_id"] = problem_info["display_id"][:24]
@@ -767,10 +753,10 @@ class FPSProblemImport(CSRFExemptAPIView):                              # ======
         helper = FPSHelper()
         with transaction.atomic():
             for _problem in problems:
-                test_case_id = rand_str()
-                test_case_dir = os.path.join(settings.TEST_CASE_DIR, test_case_id)
-                os.mkdir(test_case_dir)
-                helper.save_test_case(_problem, test_case_dir)
+                # 先写到临时目录，再存入测试用例存储，相同的测试用例只保存一份
+                with tempfile.TemporaryDirectory() as test_case_dir:
+                    helper.save_test_case(_problem, test_case_dir)
+                    test_case_id = test_case_store.add_dir(test_case_dir)
                 problem_data = helper.save_image(_problem, settings.UPLOAD_DIR, settings.UPLOAD_PREFIX)
                 s = FPSProblemSerializer(data=problem_data)
                 if not s.is_valid():
@@ -5,9 +5,14 @@ import random
 from django.db.models import Q, Count
 from myutils.api import APIView
 from account.decorators import check_contest_permission
-from ..models import ProblemTag, Problem, ProblemRuleType
+from ..models import ProblemTag, Problem, UserProblemStatus
 from ..serializers import ProblemSerializer, TagSerializer, ProblemSafeSerializer
-from contest.models import ContestRuleType
+
+
+def _problems_status(user, problem_ids):
+    # 用户做这些题目的状态：题目id -> 评判结果，没有做过的题目不在里面
+    return dict(UserProblemStatus.objects.filter(user=user, problem_id__in=problem_ids)
+                .values_list("problem_id", "status"))
 
 
 class ProblemTagAPI(APIView):
@@ -32,11 +37,8 @@ class PickOneAPI(APIView):
 class ProblemAPI(APIView):
     @staticmethod
     def _add_problem_status(request, queryset_values):
-        # 内置添加问题状态方法，如果是一个登录的用户，要更新他的显示信息，例如：oi_problems_status等
+        # 内置添加问题状态方法，如果是一个登录的用户，要添加他做这些题目的状态my_status
         if request.user.is_authenticated():
-            profile = request.user.userprofile
-            acm_problems_status = profile.acm_problems_status.get("problems", {})
-            oi_problems_status = profile.oi_problems_status.get("problems", {})
             # paginate data，queryset_values就是经过序列化的题目数据problem_data
             # 获取result，如果结果为空，problems的状态就是query_values(problem_data)
             results = queryset_values.get("results")
@@ -44,11 +46,10 @@ class ProblemAPI(APIView):
                 problems = results
             else:
                 problems = [queryset_values, ]
+            # 只查询当前页的题目的状态
+            problems_status = _problems_status(request.user, [problem["id"] for problem in problems])
             for problem in problems:
-                if problem["rule_type"] == ProblemRuleType.ACM:
-                    problem["my_status"] = acm_problems_status.get(str(problem["id"]), {}).get("status")
-                else:
-                    problem["my_status"] = oi_problems_status.get(str(problem["id"]), {}).get("status")
+                problem["my_status"] = problems_status.get(problem["id"])
 
     def get(self, request):
         # 用户获取问题详情页：获取列表和获取单个信息
@@ -96,13 +97,9 @@ class ContestProblemAPI(APIView):
     def _add_problem_status(self, request, queryset_values):
         # 添加问题状态
         if request.user.is_authenticated():
-            profile = request.user.userprofile
-            if self.contest.rule_type == ContestRuleType.ACM:
-                problems_status = profile.acm_problems_status.get("contest_problems", {})
-            else:
-                problems_status = profile.oi_problems_status.get("contest_problems", {})
+            problems_status = _problems_status(request.user, [problem["id"] for problem in queryset_values])
             for problem in queryset_values:
-                problem["my_status"] = problems_status.get(str(problem["id"]), {}).get("status")
+                problem["my_status"] = problems_status.get(problem["id"])
 
     @check_contest_permission(check_type="problems")
     def get(self, request):
@@ -91,3 +91,27 @@ class SubmissionAPITest(SubmissionPrepare):
                                          "data": "Python3 is now allowed in the problem"})
         judge_task.assert_not_called()
 
+    def test_get_submission_progress(self, judge_task):
+        # ACM题目普通用户看不到info，但是可以看到评判进度：已经完成的测试用例个数
+        self.submission.user_id = self.user.id
+        self.submission.result = 7
+        self.submission.info = {"progress": [{"test_case": "1", "result": 0}, {"test_case": "2", "result": 0}]}
+        self.submission.save()
+        resp = self.client.get(self.url, data={"id": self.submission.id})
+        self.assertSuccess(resp)
+        self.assertNotIn("info", resp.data["data"])
+        self.assertEqual(resp.data["data"]["progress"], 2)
+
+
+@mock.patch("submission.views.viadmin.judge_batch")
+class SubmissionRejudgeAPITest(SubmissionPrepare):
+    def setUp(self):
+        self._create_problem_and_submission()
+        self.create_super_admin()
+        self.url = self.reverse("submission_rejudge_api")
+
+    def test_rejudge_problem(self, judge_batch):
+        # 重判一道题的所有提交，批量发送给评测机
+        resp = self.client.get(self.url, data={"problem_id": self.problem.id})
+        self.assertSuccess(resp)
+        judge_batch.assert_called_once_with([self.submission.id], str(self.problem.id))
@@ -2,9 +2,11 @@
 # -*-encoding:UTF-8-*-
 
 from account.decorators import super_admin_required
+from judge.dispatcher import judge_batch
 from judge.tasks import judge_task
 # from judge.dispatcher import JudgeDispatcher
 from myutils.api import APIView
+from myutils.constants import JudgeLane
 from ..models import Submission
 
 
@@ -13,6 +15,16 @@ class SubmissionRejudgeAPI(APIView):
     @super_admin_required
     def get(self, request):
         id = request.GET.get("id")
+        problem_id = request.GET.get("problem_id")
+        if problem_id:
+            # 重判一道题（不是比赛题目）的所有提交，批量发送给评测机
+            submissions = Submission.objects.filter(problem_id=problem_id, contest_id__isnull=True)
+            submission_ids = list(submissions.order_by("create_time").values_list("id", flat=True))
+            if not submission_ids:
+                return self.error("Problem has no submissions")
+            submissions.update(statistic_info={})
+            judge_batch(submission_ids, problem_id)
+            return self.success()
         # 获取重新评测的提交信息ID
         if not id:
             return self.error("Parameter error, id is required")
@@ -23,5 +35,6 @@ class SubmissionRejudgeAPI(APIView):
         submission.statistic_info = {}
         submission.save()
 
-        judge_task.delay(submission.id, submission.problem.id)
+        # 重判的优先级最低，不影响比赛和平时的提交
+        judge_task.delay(submission.id, submission.problem.id, lane=JudgeLane.REJUDGE)
         return self.success()
@@ -31,12 +31,7 @@ class SubmissionAPI(APIView):
         can_consume, wait = user_bucket.consume()
         if not can_consume:
             return "Please wait %d seconds" % (int(wait))
-
-        # ip_bucket = TokenBucket(key=request.session["ip"],
-        #                         redis_conn=cache, **SysOptions.throttling["ip"])
-        # can_consume, wait = ip_bucket.consume()
-        # if not can_consume:
-        #     return "Captcha is required"
+        # 提交只按用户限流，同一个机房的用户共用一个ip
 
     @check_contest_permission(check_type="problems")
     def check_contest_permission(self, request):
@@ -119,6 +114,8 @@ class SubmissionAPI(APIView):
             submission_data = SubmissionModelSerializer(submission).data
         else:
             submission_data = SubmissionSafeModelSerializer(submission).data
+            # 不能看到每个测试用例的结果，但是可以看到评判进度：已经完成的测试用例个数
+            submission_data["progress"] = len(submission.info.get("progress", []))
         # 是否有权限取消共享
         submission_data["can_unshare"] = submission.check_user_permission(request.user, check_share=False)
         return self.success(submission_data)